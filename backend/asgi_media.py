@@ -0,0 +1,443 @@
+import asyncio
+import mimetypes
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import parse_qs, unquote
+from media_catalog import MediaCatalog
+from media_utils import VIDEOS_FOLDER, PHOTOS_FOLDER, AUDIO_FOLDER, TEMP_FOLDER, THUMBNAILS_FOLDER, PROXIES_FOLDER, catalog, hash_file, resolve_thumbnail_filename
+
+# Media routes answered directly at the ASGI layer, by URL segment
+MEDIA_ROUTES = {
+    'videos': VIDEOS_FOLDER,
+    'photos': PHOTOS_FOLDER,
+    'audio': AUDIO_FOLDER,
+    'temp': TEMP_FOLDER,
+    'thumbnails': THUMBNAILS_FOLDER,
+    'proxies': PROXIES_FOLDER
+}
+
+# Bytes read per chunk when the server has no zero-copy send
+READ_CHUNK_SIZE = 256 * 1024
+
+# ASGI extension for handing a file descriptor to the server (sendfile)
+ZEROCOPY_EXTENSION = 'http.response.zerocopysend'
+
+# Stored media carry a millisecond timestamp in their name and are never
+# rewritten, so browsers may keep them forever. Thumbnails and sprites are
+# named after their video only and may be regenerated in place, and temp files
+# (e.g. output.mp4) can be replaced under the same name; both are revalidated
+# against their content-derived ETag.
+IMMUTABLE_CACHE_CONTROL = b'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = b'no-cache'
+TEMP_CACHE_CONTROL = b'private, no-cache'
+
+# Ranges accepted in one Range header; more are answered with the whole file
+MAX_RANGES = 16
+
+# Files up to this size without a catalogued hash are hashed for their ETag
+ETAG_HASH_MAX_SIZE = 4 * 1024 * 1024
+
+# (path, size, mtime_ns) -> content hash, for files hashed on demand
+_etag_hashes = {}
+_ETAG_HASHES_MAX_ENTRIES = 4096
+
+def compute_etag(route, filename, file_path, stats):
+    """Build a strong, content-derived ETag for a media file
+
+    Catalogued media use the SHA-256 recorded at upload. Small files such
+    as thumbnails are hashed on first request and remembered until they
+    change; large uncatalogued files fall back to size and mtime.
+    """
+    content_hash = None
+    if route in ('videos', 'photos', 'audio'):
+        entry = catalog.get(route, filename)
+        if MediaCatalog.is_current(entry, stats):
+            content_hash = entry.get('contentHash')
+
+    if content_hash is None and stats.st_size <= ETAG_HASH_MAX_SIZE:
+        key = (file_path, stats.st_size, stats.st_mtime_ns)
+        content_hash = _etag_hashes.get(key)
+        if content_hash is None:
+            content_hash = hash_file(file_path)
+            if len(_etag_hashes) >= _ETAG_HASHES_MAX_ENTRIES:
+                _etag_hashes.clear()
+            _etag_hashes[key] = content_hash
+
+    if content_hash:
+        return f'"{content_hash[:32]}"'
+    return f'"{stats.st_size:x}-{stats.st_mtime_ns:x}"'
+
+# In-memory cache for small, hot files (grid thumbnails, sprites, small
+# photos): total byte budget and the largest file worth keeping
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get('MEDIA_CACHE_BYTES', 64 * 1024 * 1024))
+MEDIA_CACHE_MAX_FILE_SIZE = 1024 * 1024
+CACHEABLE_ROUTES = ('thumbnails', 'photos')
+
+class SmallFileCache:
+    """Byte-budgeted LRU cache of file contents and their response headers
+
+    Entries remember the size and mtime of the file they were read from and
+    are dropped as soon as a request sees different os.stat() results.
+    """
+
+    def __init__(self, max_bytes, max_file_size):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def accepts(self, stats):
+        return 0 < stats.st_size <= min(self.max_file_size, self.max_bytes)
+
+    def get(self, file_path, stats):
+        """Get the entry for a file if it is cached and unchanged, or None"""
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is None:
+                return None
+            if entry['size'] != stats.st_size or entry['mtimeNs'] != stats.st_mtime_ns:
+                self._discard(file_path)
+                return None
+            self._entries.move_to_end(file_path)
+            return entry
+
+    def put(self, file_path, stats, body, **fields):
+        """Cache a file's contents, evicting the least recently used entries"""
+        if len(body) != stats.st_size or not self.accepts(stats):
+            return
+        with self._lock:
+            self._discard(file_path)
+            self._entries[file_path] = dict(fields, body=body, size=stats.st_size,
+                                            mtimeNs=stats.st_mtime_ns)
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+    def _discard(self, file_path):
+        entry = self._entries.pop(file_path, None)
+        if entry is not None:
+            self._bytes -= len(entry['body'])
+
+def _read_file(file_path):
+    with open(file_path, 'rb') as file:
+        return file.read()
+
+def etag_matches(header, etag):
+    """Check an If-None-Match header against an ETag (weak comparison)"""
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    candidates = [tag.strip() for tag in header.split(',')]
+    return any(tag[2:] == etag if tag.startswith('W/') else tag == etag for tag in candidates)
+
+def parse_range_header(header, size):
+    """Parse an HTTP Range header into byte ranges
+
+    Args:
+        header (str): Range header value, e.g. 'bytes=0-499,1000-'
+        size (int): Size of the file in bytes
+
+    Overlapping and adjacent ranges are merged, so a response never sends
+    the same bytes twice.
+
+    Returns:
+        list: Sorted (start, end) tuples with inclusive ends, None if the
+        header is malformed or asks for too much (serve the whole file), or
+        [] if no range is satisfiable
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec:
+        return None
+    specs = spec.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for part in specs:
+        start_text, sep, end_text = part.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if start_text == '':
+                # Suffix range: the last N bytes
+                length = int(end_text)
+                if length <= 0:
+                    continue
+                start, end = max(size - length, 0), size - 1
+            else:
+                start = int(start_text)
+                end = int(end_text) if end_text else size - 1
+                if end_text and end < start:
+                    return None
+                if start >= size:
+                    # Unsatisfiable, but other ranges may still be served
+                    continue
+                end = min(end, size - 1)
+        except ValueError:
+            return None
+        ranges.append((start, end))
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    if len(specs) > 1 and sum(end - start + 1 for start, end in merged) >= size:
+        # Several ranges covering the whole file: a plain 200 is smaller
+        return None
+    return merged
+
+def _read_at(file, offset, count):
+    file.seek(offset)
+    return file.read(count)
+
+class MediaFileApp:
+    """ASGI responder for the media file routes
+
+    GET/HEAD requests for /api/<videos|photos|audio|temp|thumbnails|proxies>/<filename>
+    are answered here instead of going through Flask and the WSGI thread
+    bridge. Single and multiple byte ranges (206) are supported. When the
+    server offers the zero-copy send extension, file bodies are handed over
+    as a file descriptor so they can go out with sendfile(). Small thumbnails
+    and photos are served from an in-memory LRU cache. Everything else is
+    passed to the wrapped application.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.cache = SmallFileCache(MEDIA_CACHE_MAX_BYTES, MEDIA_CACHE_MAX_FILE_SIZE)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+            parts = scope['path'].split('/')
+            # ['', 'api', '<route>', '<filename>']
+            if len(parts) == 4 and parts[1] == 'api' and parts[2] in MEDIA_ROUTES and parts[3]:
+                await self.serve_media(scope, send, parts[2], unquote(parts[3]))
+                return
+        await self.app(scope, receive, send)
+
+    async def serve_media(self, scope, send, route, filename):
+        """Serve one file from a media route"""
+        headers = {key.decode('latin-1').lower(): value.decode('latin-1')
+                   for key, value in scope.get('headers', [])}
+        extra_headers = []
+
+        if route == 'temp':
+            cache_control = TEMP_CACHE_CONTROL
+        elif route == 'thumbnails':
+            cache_control = REVALIDATE_CACHE_CONTROL
+        else:
+            cache_control = IMMUTABLE_CACHE_CONTROL
+
+        if route == 'thumbnails':
+            query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+            size = query.get('size', [None])[0]
+            filename = resolve_thumbnail_filename(
+                filename,
+                size=size,
+                fmt=query.get('format', [None])[0],
+                accept=headers.get('accept', '')
+            )
+            if size:
+                extra_headers.append((b'vary', b'Accept'))
+
+        folder = MEDIA_ROUTES[route]
+        file_path = os.path.join(folder, filename)
+        # Same rule as send_from_directory: never leave the media folder
+        if (os.path.basename(filename) != filename or filename.startswith('.')
+                or not os.path.isfile(file_path)):
+            await self.send_simple(send, 404, b'Not Found')
+            return
+
+        stats = os.stat(file_path)
+        size = stats.st_size
+        cacheable = route in CACHEABLE_ROUTES and self.cache.accepts(stats)
+        cached = self.cache.get(file_path, stats) if cacheable else None
+        if cached is None:
+            loop = asyncio.get_running_loop()
+            etag = await loop.run_in_executor(None, compute_etag, route, filename, file_path, stats)
+            validator_headers = [
+                (b'last-modified', formatdate(stats.st_mtime, usegmt=True).encode('latin-1')),
+                (b'etag', etag.encode('latin-1'))
+            ]
+            content_type = (mimetypes.guess_type(filename)[0] or 'application/octet-stream').encode('latin-1')
+            body = None
+            if cacheable:
+                body = await loop.run_in_executor(None, _read_file, file_path)
+                if len(body) != size:
+                    # Rewritten since os.stat(); stream it from disk instead
+                    body = None
+                else:
+                    self.cache.put(file_path, stats, body, etag=etag,
+                                   validatorHeaders=validator_headers, contentType=content_type)
+        else:
+            etag = cached['etag']
+            validator_headers = cached['validatorHeaders']
+            content_type = cached['contentType']
+            body = cached['body']
+
+        base_headers = [
+            # Same CORS policy as the Flask app (flask_cors defaults)
+            (b'access-control-allow-origin', b'*'),
+            (b'accept-ranges', b'bytes'),
+            (b'cache-control', cache_control)
+        ] + validator_headers + extra_headers
+
+        if self.not_modified(headers, etag, stats):
+            await send({'type': 'http.response.start', 'status': 304, 'headers': base_headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        ranges = None
+        range_header = headers.get('range')
+        if range_header and self.if_range_matches(headers.get('if-range'), etag, stats):
+            ranges = parse_range_header(range_header, size)
+            if ranges == []:
+                await send({
+                    'type': 'http.response.start',
+                    'status': 416,
+                    'headers': base_headers + [
+                        (b'content-range', f"bytes */{size}".encode('latin-1')),
+                        (b'content-length', b'0')
+                    ]
+                })
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+
+        head_only = scope['method'] == 'HEAD'
+
+        if not ranges:
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': base_headers + [
+                    (b'content-type', content_type),
+                    (b'content-length', str(size).encode('latin-1'))
+                ]
+            })
+            await self.send_file_parts(scope, send, file_path, [(b'', 0, size)], head_only, body=body)
+            return
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            await send({
+                'type': 'http.response.start',
+                'status': 206,
+                'headers': base_headers + [
+                    (b'content-type', content_type),
+                    (b'content-range', f"bytes {start}-{end}/{size}".encode('latin-1')),
+                    (b'content-length', str(end - start + 1).encode('latin-1'))
+                ]
+            })
+            await self.send_file_parts(scope, send, file_path, [(b'', start, end - start + 1)], head_only, body=body)
+            return
+
+        # Several ranges: multipart/byteranges with a part header before each range
+        boundary = uuid.uuid4().hex
+        parts = []
+        for start, end in ranges:
+            part_header = (
+                f"\r\n--{boundary}\r\n"
+                f"Content-Type: {content_type.decode('latin-1')}\r\n"
+                f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+            ).encode('latin-1')
+            parts.append((part_header, start, end - start + 1))
+        closing = f"\r\n--{boundary}--\r\n".encode('latin-1')
+        total = sum(len(header) + count for header, _, count in parts) + len(closing)
+
+        await send({
+            'type': 'http.response.start',
+            'status': 206,
+            'headers': base_headers + [
+                (b'content-type', f"multipart/byteranges; boundary={boundary}".encode('latin-1')),
+                (b'content-length', str(total).encode('latin-1'))
+            ]
+        })
+        await self.send_file_parts(scope, send, file_path, parts, head_only, closing, body=body)
+
+    @staticmethod
+    def not_modified(headers, etag, stats):
+        """Evaluate If-None-Match (or, without it, If-Modified-Since)"""
+        if 'if-none-match' in headers:
+            return etag_matches(headers['if-none-match'], etag)
+        if_modified_since = headers.get('if-modified-since')
+        if not if_modified_since:
+            return False
+        try:
+            return int(stats.st_mtime) <= int(parsedate_to_datetime(if_modified_since).timestamp())
+        except (TypeError, ValueError):
+            return False
+
+    @staticmethod
+    def if_range_matches(if_range, etag, stats):
+        """Check an If-Range ETag or date; a stale validator means the full file is sent"""
+        if not if_range:
+            return True
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            # Only strong ETags may be used with If-Range
+            return if_range == etag
+        try:
+            return int(parsedate_to_datetime(if_range).timestamp()) >= int(stats.st_mtime)
+        except (TypeError, ValueError):
+            return False
+
+    async def send_file_parts(self, scope, send, file_path, parts, head_only, trailer=b'', body=None):
+        """Send (prefix, offset, count) slices of a file as the response body
+
+        When the file's contents are already in memory (body), the slices are
+        cut from it and the file is not opened.
+        """
+        if head_only:
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        if body is not None:
+            for prefix, offset, count in parts:
+                await send({'type': 'http.response.body', 'body': prefix + body[offset:offset + count],
+                            'more_body': True})
+            await send({'type': 'http.response.body', 'body': trailer})
+            return
+
+        zerocopy = ZEROCOPY_EXTENSION in scope.get('extensions', {})
+        loop = asyncio.get_running_loop()
+        with open(file_path, 'rb') as file:
+            for prefix, offset, count in parts:
+                if prefix:
+                    await send({'type': 'http.response.body', 'body': prefix, 'more_body': True})
+                if zerocopy:
+                    await send({
+                        'type': ZEROCOPY_EXTENSION,
+                        'file': file,
+                        'offset': offset,
+                        'count': count,
+                        'more_body': True
+                    })
+                    continue
+                remaining = count
+                while remaining > 0:
+                    chunk = await loop.run_in_executor(
+                        None, _read_at, file, offset, min(READ_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    offset += len(chunk)
+                    remaining -= len(chunk)
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': trailer})
+
+    @staticmethod
+    async def send_simple(send, status, body):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', b'text/plain; charset=utf-8'),
+                (b'content-length', str(len(body)).encode('latin-1'))
+            ]
+        })
+        await send({'type': 'http.response.body', 'body': body})
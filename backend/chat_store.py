@@ -0,0 +1,236 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Session used by clients that don't send a session ID
+DEFAULT_SESSION = 'default'
+
+# Messages kept per session; older ones fall out of the ring buffer
+MAX_MESSAGES_PER_SESSION = 200
+
+# Sessions kept in memory; the least recently active one is dropped first
+MAX_SESSIONS = 100
+
+# Append-only chat logs, one JSONL file per session. Once a log grows past
+# COMPACT_AFTER_LINES it is rewritten as a summary record followed by the
+# last COMPACT_KEEP_MESSAGES messages.
+CHAT_LOG_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat_logs')
+COMPACT_AFTER_LINES = 500
+COMPACT_KEEP_MESSAGES = 50
+SUMMARY_MAX_CHARS = 4000
+SUMMARY_LINE_CHARS = 200
+
+# Completed exchanges handed to a new chat client for its context
+REHYDRATE_EXCHANGES = 20
+
+def safe_session_name(session_id):
+    """Map a session ID to a name that is safe to use in file paths"""
+    if session_id and len(session_id) <= 64 and all(c.isalnum() or c in '-_' for c in session_id):
+        return session_id
+    return hashlib.sha1((session_id or '').encode('utf-8')).hexdigest()
+
+def summarize_messages(previous_summary, messages):
+    """Fold messages into a bounded plain-text digest of the conversation
+
+    Each message contributes one truncated line; when the digest grows past
+    SUMMARY_MAX_CHARS its oldest lines are dropped.
+    """
+    lines = previous_summary.split('\n') if previous_summary else []
+    for message in messages:
+        speaker = 'User' if message.get('role') == 'user' else 'Assistant'
+        text = ' '.join(str(message.get('content', '')).split())
+        if len(text) > SUMMARY_LINE_CHARS:
+            text = text[:SUMMARY_LINE_CHARS - 3] + '...'
+        lines.append(f"{speaker}: {text}")
+    while lines and sum(len(line) + 1 for line in lines) > SUMMARY_MAX_CHARS:
+        lines.pop(0)
+    return '\n'.join(lines)
+
+class ChatSession:
+    """Bounded chat history of one session
+
+    Messages live in a ring buffer. Request IDs index the user/assistant
+    pair they belong to, and the latest assistant message is kept as a
+    direct pointer so polling never scans the history.
+    """
+
+    def __init__(self, session_id, max_messages=MAX_MESSAGES_PER_SESSION):
+        self.session_id = session_id
+        self.messages = deque(maxlen=max_messages)
+        self.requests = {}
+        self.latest_assistant = None
+        self.updated_at = time.time()
+        # Digest of messages compacted out of the log
+        self.summary = None
+        self.log_lines = 0
+
+    def append(self, message):
+        if len(self.messages) == self.messages.maxlen:
+            self._forget(self.messages[0])
+        self.messages.append(message)
+        self.updated_at = time.time()
+
+        request_id = message.get('request_id')
+        if request_id:
+            self.requests.setdefault(request_id, {})[message['role']] = message
+        if message['role'] == 'assistant':
+            self.latest_assistant = message
+
+    def _forget(self, message):
+        """Drop the request index entry of a message leaving the ring buffer"""
+        pair = self.requests.get(message.get('request_id'))
+        if pair is not None and pair.get(message['role']) is message:
+            del pair[message['role']]
+            if not pair:
+                del self.requests[message['request_id']]
+
+class ChatStore:
+    """Chat histories keyed by session ID, with bounded memory
+
+    With a log folder, every message is also appended to the session's
+    JSONL log, so histories survive restarts and sessions evicted from
+    memory are reloaded on their next use.
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, max_messages=MAX_MESSAGES_PER_SESSION,
+                 log_folder=CHAT_LOG_FOLDER):
+        self.max_sessions = max_sessions
+        self.max_messages = max_messages
+        self.log_folder = log_folder
+        if log_folder:
+            os.makedirs(log_folder, exist_ok=True)
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _log_path(self, session_id):
+        return os.path.join(self.log_folder, f"{safe_session_name(session_id)}.jsonl")
+
+    def _session(self, session_id, create=False):
+        session = self._sessions.get(session_id)
+        if session is None and self.log_folder and os.path.exists(self._log_path(session_id)):
+            session = self._load(session_id)
+        elif session is None and create:
+            session = ChatSession(session_id, self.max_messages)
+        if session is None:
+            return None
+
+        self._sessions[session_id] = session
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        return session
+
+    def _load(self, session_id):
+        """Rebuild a session from its log"""
+        session = ChatSession(session_id, self.max_messages)
+        try:
+            with open(self._log_path(session_id), 'r', encoding='utf-8') as f:
+                for line in f:
+                    session.log_lines += 1
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn last line from a crash; skip it
+                        continue
+                    if record.get('role') == 'summary':
+                        session.summary = record.get('content')
+                    else:
+                        session.append(record)
+        except Exception as e:
+            print(f"Error loading chat log for session {session_id}: {e}")
+        return session
+
+    def _write(self, session, message):
+        """Append a message to the session's log, compacting it when it gets long"""
+        if not self.log_folder:
+            return
+        try:
+            with open(self._log_path(session.session_id), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(message) + '\n')
+            session.log_lines += 1
+            if session.log_lines > COMPACT_AFTER_LINES:
+                self._compact(session)
+        except Exception as e:
+            print(f"Error writing chat log for session {session.session_id}: {e}")
+
+    def _compact(self, session):
+        """Rewrite a log as a summary record plus its most recent messages"""
+        log_path = self._log_path(session.session_id)
+        messages = []
+        with open(log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get('role') != 'summary':
+                    messages.append(record)
+
+        older, kept = messages[:-COMPACT_KEEP_MESSAGES], messages[-COMPACT_KEEP_MESSAGES:]
+        session.summary = summarize_messages(session.summary, older)
+
+        temp_path = log_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'role': 'summary', 'content': session.summary,
+                                'timestamp': time.time()}) + '\n')
+            for message in kept:
+                f.write(json.dumps(message) + '\n')
+        os.replace(temp_path, log_path)
+        session.log_lines = 1 + len(kept)
+        print(f"Compacted chat log of session {session.session_id}: "
+              f"{len(older)} messages summarized, {len(kept)} kept")
+
+    def append(self, session_id, message):
+        """Add a message to a session's history, creating the session if needed"""
+        with self._lock:
+            session = self._session(session_id, create=True)
+            session.append(message)
+            self._write(session, message)
+        return message
+
+    def history(self, session_id):
+        """Get a session's messages, oldest first"""
+        with self._lock:
+            session = self._session(session_id)
+            return list(session.messages) if session else []
+
+    def latest_assistant(self, session_id):
+        """Get a session's most recent assistant message, or None"""
+        with self._lock:
+            session = self._session(session_id)
+            return session.latest_assistant if session else None
+
+    def get_request(self, session_id, request_id):
+        """Get the {'user': ..., 'assistant': ...} messages of one request, or None"""
+        with self._lock:
+            session = self._session(session_id)
+            pair = session.requests.get(request_id) if session else None
+            return dict(pair) if pair else None
+
+    def context(self, session_id, max_exchanges=REHYDRATE_EXCHANGES):
+        """Get what a new chat client needs to pick up a session
+
+        Returns:
+            dict: 'summary' of compacted history (or None) and 'messages', the
+            last completed user/assistant exchanges as {role, content}, or
+            None if the session has no history
+        """
+        with self._lock:
+            session = self._session(session_id)
+            if session is None:
+                return None
+            messages = []
+            for message in session.messages:
+                if message['role'] != 'user':
+                    continue
+                pair = session.requests.get(message.get('request_id'), {})
+                if 'assistant' in pair:
+                    messages.append({'role': 'user', 'content': message['content']})
+                    messages.append({'role': 'assistant', 'content': pair['assistant']['content']})
+            messages = messages[-2 * max_exchanges:]
+            if not messages and not session.summary:
+                return None
+            return {'summary': session.summary, 'messages': messages}
@@ -0,0 +1,377 @@
+import os
+import re
+import subprocess
+import time
+from media_utils import catalog, get_media_metadata, get_keyframes, can_copy_audio, register_media_file, VIDEOS_FOLDER, AUDIO_FOLDER
+
+# Commands matched with at least this confidence run directly on the media
+# job queue; anything less goes to the chat client (and Gemini)
+FAST_PATH_CONFIDENCE = 0.9
+
+# A rule that accounts for the whole message is certain; one that only
+# matches part of it may be missing extra instructions
+FULL_MATCH_CONFIDENCE = 1.0
+PARTIAL_MATCH_CONFIDENCE = 0.5
+
+# Seconds a chat request waits for a fast-path edit before replying that it
+# is still processing; the result is then pushed like any other reply
+FAST_PATH_WAIT = 120
+
+# Seconds a trim start may be off a keyframe and still be cut with a stream copy
+KEYFRAME_TOLERANCE = 0.001
+
+# Politeness and filler that don't change what an edit means
+LEADING_FILLER = re.compile(r"^(?:please|pls|ok|okay|now|can you|could you|would you|will you|"
+                            r"i want to|i want you to|i'd like to|i would like to|let's|go ahead and)\s+")
+TRAILING_FILLER = re.compile(r"\s+(?:please|pls|for me|thanks|thank you)$")
+
+# Grammar pieces shared by the rules below
+VIDEO = r"(?:(?:the|this|my|current|selected) (?:video|clip) |it )?"
+OF_VIDEO = r"(?: of (?:the|this|my) (?:video|clip))?"
+TIME_UNITS = r"(?:seconds?|secs?|s|minutes?|mins?|m)"
+AUDIO_EXTENSIONS_PATTERN = r"(?:mp3|wav|ogg|aac|m4a)"
+
+# Named aspect ratios, and the short side of converted videos
+ASPECT_PRESETS = {
+    'instagram': '9:16',
+    'instagram story': '9:16',
+    'instagram reel': '9:16',
+    'instagram reels': '9:16',
+    'instagram square': '1:1',
+    'instagram post': '4:5',
+    'tiktok': '9:16',
+    'youtube shorts': '9:16',
+    'shorts': '9:16',
+    'reels': '9:16',
+    'story': '9:16',
+    'square': '1:1',
+    'vertical': '9:16',
+    'portrait': '9:16',
+    'landscape': '16:9',
+    'horizontal': '16:9',
+    'widescreen': '16:9'
+}
+ASPECT_SHORT_SIDE = 1080
+
+# Encoder settings for edits that have to re-encode
+H264_ARGS = ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '20', '-pix_fmt', 'yuv420p']
+AAC_ARGS = ['-c:a', 'aac', '-b:a', '192k']
+
+# Output containers: video codecs that can be stream-copied into each, and
+# the encoder arguments used otherwise
+FORMAT_VIDEO_CODECS = {
+    '.mp4': ({'h264', 'hevc', 'mpeg4', 'av1'}, H264_ARGS),
+    '.mov': ({'h264', 'hevc', 'mpeg4', 'prores'}, H264_ARGS),
+    '.mkv': ({'h264', 'hevc', 'mpeg4', 'vp8', 'vp9', 'av1'}, H264_ARGS),
+    '.webm': ({'vp8', 'vp9', 'av1'}, ['-c:v', 'libvpx-vp9', '-crf', '32', '-b:v', '0', '-row-mt', '1']),
+    '.avi': ({'mpeg4'}, ['-c:v', 'mpeg4', '-q:v', '3'])
+}
+FORMAT_AUDIO_ARGS = {
+    '.mp4': AAC_ARGS,
+    '.mov': AAC_ARGS,
+    '.mkv': AAC_ARGS,
+    '.webm': ['-c:a', 'libopus', '-b:a', '128k'],
+    '.avi': ['-c:a', 'libmp3lame', '-q:a', '2']
+}
+
+class CommandError(Exception):
+    """Raised when a recognized command can't be carried out
+
+    The message is meant for the user and is sent as the chat reply.
+    """
+
+# Registered commands: (name, compiled patterns, plan builder)
+_commands = []
+
+def command(name, *patterns):
+    """Register an edit command with the engine
+
+    The decorated builder is called as builder(params, video_path, audio_path)
+    with the named groups of the matching pattern. It returns an edit plan
+    (see run_plan), None if it lacks what it needs and the chat client should
+    handle the message instead, or raises CommandError.
+
+    Args:
+        name (str): Command name, e.g. 'trim'
+        patterns (str): Regular expressions over the normalized message
+    """
+    def decorator(builder):
+        _commands.append((name, [re.compile(pattern) for pattern in patterns], builder))
+        return builder
+    return decorator
+
+def normalize_message(message):
+    """Lowercase a message and strip whitespace, punctuation and filler around the command"""
+    text = ' '.join((message or '').lower().split()).rstrip('.!?').strip()
+    while True:
+        stripped = TRAILING_FILLER.sub('', LEADING_FILLER.sub('', text)).strip(' ,')
+        if stripped == text:
+            return text
+        text = stripped
+
+def match_command(message):
+    """Find the command a chat message asks for
+
+    Returns:
+        dict: 'name', 'builder', 'params' (named groups) and 'confidence',
+        or None if no rule matches
+    """
+    text = normalize_message(message)
+    partial = None
+    for name, patterns, builder in _commands:
+        for pattern in patterns:
+            match = pattern.fullmatch(text)
+            if match:
+                return {'name': name, 'builder': builder, 'params': match.groupdict(),
+                        'confidence': FULL_MATCH_CONFIDENCE}
+            match = pattern.search(text) if partial is None else None
+            if match:
+                partial = {'name': name, 'builder': builder, 'params': match.groupdict(),
+                           'confidence': PARTIAL_MATCH_CONFIDENCE}
+    return partial
+
+def plan_command(message, video_path, audio_path=None):
+    """Turn a chat message into an edit plan if it can skip the chat client
+
+    Args:
+        message (str): The user's chat message
+        video_path (str): Path of the selected video, or None
+        audio_path (str): Path of the selected audio file, or None
+
+    Returns:
+        dict: Edit plan for run_plan, or None if the message should go to the
+        chat client
+
+    Raises:
+        CommandError: The message is a clear command that can't be carried out
+    """
+    match = match_command(message)
+    if match is None:
+        return None
+    print(f"[DEBUG] Command engine matched '{match['name']}' with confidence {match['confidence']}")
+    if match['confidence'] < FAST_PATH_CONFIDENCE or not video_path:
+        return None
+    plan = match['builder'](match['params'], video_path, audio_path)
+    if plan is not None:
+        plan['command'] = match['name']
+        plan['confidence'] = match['confidence']
+    return plan
+
+def run_plan(plan):
+    """Run an edit plan with ffmpeg and add the output to the media library
+
+    Meant to run on the media job queue. The output is written under a
+    hidden name next to the other videos and renamed once complete.
+
+    Args:
+        plan (dict): 'input' (source video path), 'args' (ffmpeg arguments
+            without the output), 'suffix' and 'ext' of the output name, and
+            'summary' (what was done, for the reply)
+
+    Returns:
+        dict: Media item of the output, as returned by register_media_file
+
+    Raises:
+        CommandError: ffmpeg failed
+    """
+    name = os.path.splitext(os.path.basename(plan['input']))[0]
+    name = re.sub(r'^\d+-', '', name)
+    timestamp = int(time.time() * 1000)
+    filename = f"{name}{plan['suffix']}{plan['ext']}"
+    output_path = os.path.join(VIDEOS_FOLDER, f"{timestamp}-{filename}")
+    temp_path = os.path.join(VIDEOS_FOLDER, f".{timestamp}-{filename}")
+
+    cmd = ['ffmpeg', '-y'] + plan['args'] + [temp_path]
+    print(f"[DEBUG] Running fast-path {plan.get('command')}: {' '.join(cmd)}")
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        stdout, stderr = process.communicate(timeout=3600)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        stdout, stderr = process.communicate()
+    if process.returncode != 0 or not os.path.exists(temp_path):
+        print(f"Error running {plan.get('command')}: {stderr.decode(errors='replace') if stderr else 'Unknown error'}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise CommandError("I couldn't finish that edit because ffmpeg reported an error.")
+
+    os.replace(temp_path, output_path)
+    return register_media_file(output_path, filename, timestamp)
+
+def _seconds(params, name, default_unit=None):
+    """Read a time matched by _time() as seconds, or None if it wasn't matched"""
+    clock = params.get(f"{name}_clock")
+    if clock:
+        seconds = 0.0
+        for part in clock.split(':'):
+            seconds = seconds * 60 + float(part)
+        return seconds
+    value = params.get(name)
+    if value is None:
+        return None
+    unit = params.get(f"{name}_unit") or default_unit or 's'
+    return float(value) * (60 if unit.startswith('m') else 1)
+
+def _time(name, unit_required=True):
+    """Pattern for a time like '10 seconds', '1.5 min' or '0:45', with named groups"""
+    unit = rf"\s*(?P<{name}_unit>{TIME_UNITS})" + ('' if unit_required else '?')
+    return rf"(?:(?P<{name}>\d+(?:\.\d+)?){unit}|(?P<{name}_clock>\d{{1,2}}(?::\d{{2}}){{1,2}}(?:\.\d+)?))"
+
+@command(
+    'trim',
+    rf"(?:trim|clip|shorten|keep) {VIDEO}(?:down )?(?:to )?(?:just |only )?(?:the )?(?P<edge>first|last) {_time('length')}{OF_VIDEO}",
+    rf"(?:trim|cut|clip|keep) {VIDEO}(?:from |between )?{_time('start', unit_required=False)} ?(?:to|and|until|-) ?{_time('end')}",
+    rf"(?:remove|drop|skip|cut off) (?:the )?(?P<skip>first) {_time('length')}{OF_VIDEO}",
+    # 'trim 10 seconds' could mean keeping or removing them; leave it to the chat
+    rf"(?:trim|shorten) {VIDEO}(?:down )?to {_time('length')}(?: long)?"
+)
+def build_trim(params, video_path, audio_path):
+    duration = (get_media_metadata(video_path) or {}).get('duration')
+    length = _seconds(params, 'length')
+    if params.get('skip'):
+        if not duration:
+            return None
+        start, end = length, duration
+    elif params.get('edge') == 'last':
+        if not duration:
+            return None
+        start, end = max(0.0, duration - length), duration
+    elif length is not None:
+        start, end = 0.0, length
+    else:
+        end = _seconds(params, 'end')
+        start = _seconds(params, 'start', default_unit=params.get('end_unit'))
+
+    if duration:
+        if start >= duration:
+            raise CommandError(f"The video is only {duration:.1f} seconds long, so I can't start a trim at {start:g} seconds.")
+        end = min(end, duration) if end is not None else duration
+    if end is None or end <= start:
+        raise CommandError("The end of the trim has to come after its start.")
+
+    # A start on a keyframe (per the index warmed by /prepare) can be cut
+    # exactly with a stream copy; anything else is re-encoded
+    keyframes = get_keyframes(video_path, probe=False) or []
+    if start == 0 or any(abs(keyframe - start) <= KEYFRAME_TOLERANCE for keyframe in keyframes):
+        return {
+            'input': video_path,
+            'args': ['-ss', f"{start:g}", '-i', video_path, '-t', f"{end - start:g}",
+                     '-map', '0:v:0', '-map', '0:a:0?', '-c', 'copy', '-avoid_negative_ts', 'make_zero'],
+            'suffix': '_trimmed',
+            'ext': os.path.splitext(video_path)[1].lower(),
+            'summary': f"trimmed the video to {start:g}-{end:g} seconds"
+        }
+
+    return {
+        'input': video_path,
+        'args': ['-ss', f"{start:g}", '-i', video_path, '-t', f"{end - start:g}",
+                 '-map', '0:v:0', '-map', '0:a:0?'] + H264_ARGS + AAC_ARGS + ['-movflags', '+faststart'],
+        'suffix': '_trimmed',
+        'ext': '.mp4',
+        'summary': f"trimmed the video to {start:g}-{end:g} seconds"
+    }
+
+_PRESETS_PATTERN = '|'.join(sorted(ASPECT_PRESETS, key=len, reverse=True))
+
+@command(
+    'aspect',
+    rf"(?P<verb>convert|change|make|turn|format|reformat|resize|crop) {VIDEO}(?:to|into|for|as) (?:an? )?"
+    rf"(?:(?P<preset>{_PRESETS_PATTERN})|(?P<ratio>\d{{1,2}}:\d{{1,2}}))"
+    rf"(?: format| aspect ratio| aspect| ratio| video| size)?",
+    rf"(?P<verb>make|crop) {VIDEO}(?P<preset>square|vertical|portrait|landscape|widescreen)",
+    rf"(?P<verb>change|set) (?:the )?aspect ratio{OF_VIDEO} to (?P<ratio>\d{{1,2}}:\d{{1,2}})"
+)
+def build_aspect(params, video_path, audio_path):
+    ratio = params.get('ratio') or ASPECT_PRESETS[params['preset']]
+    ratio_width, ratio_height = (int(part) for part in ratio.split(':'))
+    if not ratio_width or not ratio_height:
+        raise CommandError(f"{ratio} isn't a valid aspect ratio.")
+
+    metadata = get_media_metadata(video_path) or {}
+    if metadata.get('width') and metadata.get('height'):
+        if abs(metadata['width'] / metadata['height'] - ratio_width / ratio_height) < 0.01:
+            raise CommandError(f"The video is already {ratio}.")
+
+    if ratio_width >= ratio_height:
+        height = ASPECT_SHORT_SIDE
+        width = round(ASPECT_SHORT_SIDE * ratio_width / ratio_height / 2) * 2
+    else:
+        width = ASPECT_SHORT_SIDE
+        height = round(ASPECT_SHORT_SIDE * ratio_height / ratio_width / 2) * 2
+
+    # Cropping fills the frame; otherwise the whole picture is kept and padded
+    if params.get('verb') == 'crop':
+        video_filter = f"scale={width}:{height}:force_original_aspect_ratio=increase,crop={width}:{height},setsar=1"
+    else:
+        video_filter = (f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1")
+
+    audio_args = ['-c:a', 'copy'] if can_copy_audio(video_path, 'output.mp4') else AAC_ARGS
+    preset = params.get('preset') or ''
+    return {
+        'input': video_path,
+        'args': ['-i', video_path, '-map', '0:v:0', '-map', '0:a:0?', '-vf', video_filter]
+                + H264_ARGS + audio_args + ['-movflags', '+faststart'],
+        'suffix': '_instagram' if preset.startswith('instagram') else f"_{ratio_width}x{ratio_height}",
+        'ext': '.mp4',
+        'summary': f"converted the video to {ratio}"
+    }
+
+_AUDIO_NAME = rf"(?:(?:this|the selected|selected|the uploaded|my) (?:audio|music|song|track)(?: file)?|[\w .-]+?\.{AUDIO_EXTENSIONS_PATTERN})"
+
+@command(
+    'replace_audio',
+    rf"(?:replace|swap|change|switch) (?:the )?(?:audio|sound|music|soundtrack)(?: track)?"
+    rf"(?: (?:of|in) (?:the|this|my) (?:video|clip))? (?:with|to|for) (?P<audio>{_AUDIO_NAME})",
+    rf"use (?P<audio>{_AUDIO_NAME}) as (?:the )?(?:audio|sound|music|soundtrack)(?: track)?{OF_VIDEO}"
+)
+def build_replace_audio(params, video_path, audio_path):
+    audio_name = params['audio']
+    if re.search(rf"\.{AUDIO_EXTENSIONS_PATTERN}$", audio_name):
+        entry = catalog.find_by_name(audio_name.strip(), media_type='audio')
+        if entry:
+            audio_path = os.path.join(AUDIO_FOLDER, entry['filename'])
+    if not audio_path or not os.path.exists(audio_path):
+        # Leave guessing at a substitute file to the chat handling
+        return None
+    return replace_audio_plan(video_path, audio_path)
+
+def replace_audio_plan(video_path, audio_path):
+    """Edit plan replacing a video's soundtrack with an audio file"""
+    ext = os.path.splitext(video_path)[1].lower()
+    audio_name = re.sub(r'^\d+-', '', os.path.basename(audio_path))
+    audio_args = ['-c:a', 'copy'] if can_copy_audio(audio_path, f"output{ext}") else []
+    return {
+        'input': video_path,
+        'args': ['-i', video_path, '-i', audio_path, '-map', '0:v:0', '-map', '1:a:0',
+                 '-c:v', 'copy'] + audio_args + ['-shortest'],
+        'suffix': '_with_audio',
+        'ext': ext,
+        'summary': f"replaced the audio with {audio_name}"
+    }
+
+_FORMATS_PATTERN = '|'.join(ext[1:] for ext in FORMAT_VIDEO_CODECS)
+
+@command(
+    'format',
+    rf"(?:convert|export|save|change|transcode|remux|turn) {VIDEO}(?:to|into|as) (?:an? )?(?:\.)?(?P<format>{_FORMATS_PATTERN})(?: format| file| video| container)?",
+    rf"(?:make|give me|create) (?:an? )?(?P<format>{_FORMATS_PATTERN}) (?:version|copy){OF_VIDEO}"
+)
+def build_format(params, video_path, audio_path):
+    ext = f".{params['format']}"
+    if os.path.splitext(video_path)[1].lower() == ext:
+        raise CommandError(f"The video is already {params['format'].upper()}.")
+
+    # Stream-copy whatever the new container can hold as is
+    metadata = get_media_metadata(video_path) or {}
+    copyable_codecs, video_args = FORMAT_VIDEO_CODECS[ext]
+    if metadata.get('videoCodec') in copyable_codecs:
+        video_args = ['-c:v', 'copy']
+    audio_args = ['-c:a', 'copy'] if can_copy_audio(video_path, f"output{ext}") else FORMAT_AUDIO_ARGS[ext]
+    return {
+        'input': video_path,
+        'args': ['-i', video_path, '-map', '0:v:0', '-map', '0:a:0?'] + video_args + audio_args,
+        'suffix': '',
+        'ext': ext,
+        'summary': f"converted the video to {params['format'].upper()}"
+    }
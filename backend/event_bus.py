@@ -0,0 +1,133 @@
+import asyncio
+import json
+import threading
+import time
+from urllib.parse import parse_qs
+
+# Events buffered per subscriber; a client that falls this far behind loses
+# its oldest undelivered events rather than growing the queue
+SUBSCRIBER_QUEUE_SIZE = 256
+
+# Topics a subscriber gets when it doesn't ask for specific ones
+DEFAULT_TOPICS = ('chat', 'jobs', 'media')
+
+# Shortest session ID accepted for a chat subscription. The ID is the only
+# credential for a session's events, so it must be a random secret (the
+# frontend sends 32 hex characters) rather than something guessable
+MIN_SESSION_ID_LENGTH = 32
+
+class EventBus:
+    """Fan-out of server events to WebSocket subscribers
+
+    publish() may be called from any thread (Flask request threads, media
+    job workers); events are handed to the event loop each subscriber
+    lives on. Chat events carry a session ID and only reach subscribers of
+    that session; job and media events go to everyone.
+    """
+
+    def __init__(self):
+        # id(subscriber) -> subscriber record
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, session_id=None, topics=DEFAULT_TOPICS):
+        """Register a subscriber on the running event loop
+
+        Returns:
+            dict: Subscriber record; read events from its 'queue'
+        """
+        subscriber = {
+            'queue': asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE),
+            'loop': asyncio.get_running_loop(),
+            'session': session_id,
+            'topics': set(topics)
+        }
+        with self._lock:
+            self._subscribers[id(subscriber)] = subscriber
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.pop(id(subscriber), None)
+
+    def publish(self, event_type, data, session_id=None):
+        """Send an event ('<topic>.<name>') to every interested subscriber"""
+        topic = event_type.split('.', 1)[0]
+        event = {'type': event_type, 'data': data, 'timestamp': time.time()}
+        with self._lock:
+            targets = [sub for sub in self._subscribers.values()
+                       if topic in sub['topics']
+                       and (session_id is None or sub['session'] == session_id)]
+        for subscriber in targets:
+            try:
+                subscriber['loop'].call_soon_threadsafe(_enqueue, subscriber['queue'], event)
+            except RuntimeError:
+                # The subscriber's loop has shut down
+                self.unsubscribe(subscriber)
+
+def _enqueue(queue, event):
+    """Put an event on a subscriber queue, dropping the oldest if it is full"""
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(event)
+
+# Process-wide bus used by the server, media jobs and media ingest
+events = EventBus()
+
+class EventSocketApp:
+    """ASGI WebSocket endpoint at /api/events pushing EventBus events
+
+    Query parameters: session=<chat session ID> to receive that session's
+    chat messages, topics=chat,jobs,media to limit what is sent. Events are
+    JSON text frames: {"type": "chat.message", "data": {...}, "timestamp": ...}.
+    Everything else is passed to the wrapped application.
+
+    The session ID works as a bearer secret: anyone who presents it gets
+    that session's chat events. IDs shorter than MIN_SESSION_ID_LENGTH are
+    refused, so only random IDs like the frontend's can subscribe.
+    """
+
+    def __init__(self, app, bus=events):
+        self.app = app
+        self.bus = bus
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'websocket' and scope['path'] == '/api/events':
+            await self.serve_events(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+    async def serve_events(self, scope, receive, send):
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        session_id = query.get('session', [None])[0]
+        topics = [t for t in query.get('topics', [','.join(DEFAULT_TOPICS)])[0].split(',') if t]
+        if session_id is not None and len(session_id) < MIN_SESSION_ID_LENGTH:
+            print("Event subscriber refused: session ID too short to be a secret")
+            # 1008: policy violation
+            await send({'type': 'websocket.close', 'code': 1008})
+            return
+
+        await send({'type': 'websocket.accept'})
+        subscriber = self.bus.subscribe(session_id, topics)
+        print(f"Event subscriber connected (session={session_id}, topics={topics})")
+
+        async def forward():
+            while True:
+                event = await subscriber['queue'].get()
+                await send({'type': 'websocket.send', 'text': json.dumps(event, default=str)})
+
+        forwarder = asyncio.create_task(forward())
+        try:
+            # Nothing is expected from the client; wait for it to go away
+            while True:
+                message = await receive()
+                if message['type'] == 'websocket.disconnect':
+                    break
+        finally:
+            forwarder.cancel()
+            self.bus.unsubscribe(subscriber)
+            print(f"Event subscriber disconnected (session={session_id})")
@@ -0,0 +1,280 @@
+import json
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from chat_store import safe_session_name
+
+# Chat client script, run once per session in --stdio mode
+CLIENT_SCRIPT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client.py'))
+
+# Per-session working directories; tools that write relative paths (e.g.
+# output.mp4) land in their session's folder instead of a shared one
+SESSIONS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sessions')
+
+# Client processes kept alive at once, and how long an idle one is kept
+MAX_WORKERS = int(os.environ.get('MCP_WORKERS', 4))
+WORKER_IDLE_SECONDS = 10 * 60
+
+# Seconds to wait for a reply to one query; the client gets a budget
+# QUERY_REPLY_MARGIN shorter, so it answers (if only with "try again")
+# before the worker gives up on it
+QUERY_TIMEOUT = 60
+QUERY_REPLY_MARGIN = 5
+
+# Placeholder holding a session's pool slot while its process starts
+_STARTING = object()
+
+class WorkerBusyError(Exception):
+    """Raised when no worker becomes available in time"""
+
+class MCPWorker:
+    """A long-lived chat client process serving one session
+
+    The process keeps its MCP server connection and Gemini chat session
+    between messages and runs in the session's own working directory. A
+    new process is first sent the session's earlier history, so it picks up
+    where the previous one stopped.
+    Output lines are collected by a reader thread, so replies can be awaited
+    with a timeout on any platform.
+    """
+
+    def __init__(self, session_id, server_path, history=None):
+        self.session_id = session_id
+        self.cwd = os.path.join(SESSIONS_FOLDER, safe_session_name(session_id))
+        os.makedirs(self.cwd, exist_ok=True)
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+        self._lines = queue.Queue()
+
+        self.process = subprocess.Popen(
+            [sys.executable, CLIENT_SCRIPT, server_path, "--stdio"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1,  # Line buffered
+            cwd=self.cwd
+        )
+        threading.Thread(target=self._read_stream, args=(self.process.stdout, self._lines),
+                         daemon=True, name=f"mcp-stdout-{self.process.pid}").start()
+        threading.Thread(target=self._drain_stderr, daemon=True,
+                         name=f"mcp-stderr-{self.process.pid}").start()
+        if history:
+            self.process.stdin.write(json.dumps({'history': history}) + "\n")
+            self.process.stdin.flush()
+        print(f"Started MCP worker {self.process.pid} for session {session_id} in {self.cwd}")
+
+    @staticmethod
+    def _read_stream(stream, lines):
+        for line in stream:
+            lines.put(line.rstrip('\n'))
+        lines.put(None)  # End of output
+
+    def _drain_stderr(self):
+        for line in self.process.stderr:
+            print(f"[MCP worker {self.process.pid} stderr] {line.rstrip()}")
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def ask(self, query, context=None, timeout=QUERY_TIMEOUT):
+        """Send one query and collect the reply
+
+        Returns:
+            tuple: (lines between the response markers, other output lines,
+            whether the response start marker was seen)
+        """
+        budget = max(1, timeout - QUERY_REPLY_MARGIN)
+        self.process.stdin.write(json.dumps({'query': query, 'context': context, 'budget': budget}) + "\n")
+        self.process.stdin.flush()
+
+        response_lines = []
+        other_lines = []
+        in_response_block = False
+        deadline = time.time() + timeout
+        while True:
+            try:
+                line = self._lines.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                # A client stuck mid-query would answer the next one; replace it
+                print(f"[DEBUG] MCP worker {self.process.pid} timed out, stopping it")
+                self.stop()
+                break
+            if line is None:
+                print(f"[DEBUG] MCP worker {self.process.pid} exited with code {self.process.poll()}")
+                break
+
+            line = line.strip()
+            if not line:
+                continue
+            print(f"[DEBUG] Got line: '{line}'")
+            if line == "Response: RESPONSE_START":
+                in_response_block = True
+            elif line == "RESPONSE_END":
+                break
+            elif in_response_block:
+                response_lines.append(line)
+            else:
+                other_lines.append(line)
+        self.last_used = time.time()
+        return response_lines, other_lines, in_response_block
+
+    def stop(self, remove_folder=False):
+        if self.is_alive():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if remove_folder:
+            shutil.rmtree(self.cwd, ignore_errors=True)
+
+class MCPWorkerPool:
+    """Session-scoped chat client processes, bounded by MAX_WORKERS
+
+    Each session gets its own worker, so different sessions are served in
+    parallel while one session's messages run one at a time, in order.
+    When the pool is full, the least recently used idle worker is stopped.
+    Slots are reserved under the pool lock, but processes are started and
+    stopped outside it, so a cold start never holds up other sessions.
+    """
+
+    def __init__(self, server_path=None, max_workers=MAX_WORKERS, history_provider=None):
+        self.server_path = os.path.abspath(server_path) if server_path else None
+        self.max_workers = max_workers
+        # Callable returning a session's history for a new worker (or None)
+        self.history_provider = history_provider
+        self._workers = {}
+        self._condition = threading.Condition()
+
+    def configure(self, server_path):
+        self.server_path = os.path.abspath(server_path)
+
+    def acquire(self, session_id, timeout=QUERY_TIMEOUT):
+        """Get the session's worker with its lock held; call release() afterwards"""
+        if self.server_path is None:
+            raise RuntimeError("MCP server path not set")
+        deadline = time.time() + timeout
+        victims = []
+        try:
+            with self._condition:
+                victims += self._reap_idle()
+                while True:
+                    worker = self._workers.get(session_id)
+                    if worker not in (None, _STARTING) and not worker.is_alive():
+                        del self._workers[session_id]
+                        worker = None
+                    if worker is None and len(self._workers) >= self.max_workers:
+                        victims += self._evict_one()
+                    if worker is None and len(self._workers) < self.max_workers:
+                        self._workers[session_id] = _STARTING
+                        break
+                    if worker not in (None, _STARTING) and worker.lock.acquire(blocking=False):
+                        return worker
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise WorkerBusyError("All chat workers are busy")
+                    self._condition.wait(remaining)
+        finally:
+            self._stop_workers(victims)
+        return self._start_worker(session_id, hold=True)
+
+    def prepare(self, session_id):
+        """Start the session's worker ahead of its first query, if a slot is free
+
+        Never evicts another session's worker and never waits: the process is
+        started on a background thread, and a full pool is left alone (the
+        worker is then started by the next acquire()).
+
+        Returns:
+            bool: Whether the session has a live or starting worker
+        """
+        if self.server_path is None:
+            return False
+        with self._condition:
+            worker = self._workers.get(session_id)
+            if worker is _STARTING:
+                return True
+            if worker is not None and worker.is_alive():
+                worker.last_used = time.time()
+                return True
+            if worker is not None:
+                del self._workers[session_id]
+            if len(self._workers) >= self.max_workers:
+                return False
+            self._workers[session_id] = _STARTING
+        threading.Thread(target=self._start_in_background, args=(session_id,), daemon=True,
+                         name=f"mcp-prepare-{session_id}").start()
+        return True
+
+    def _start_in_background(self, session_id):
+        try:
+            self._start_worker(session_id)
+        except Exception as e:
+            print(f"Error starting MCP worker for session {session_id}: {e}")
+
+    def _start_worker(self, session_id, hold=False):
+        """Start the process for a slot reserved with _STARTING, outside the pool lock
+
+        With hold=True the worker's lock is taken before other threads can see it.
+        """
+        try:
+            history = self.history_provider(session_id) if self.history_provider else None
+            worker = MCPWorker(session_id, self.server_path, history)
+        except Exception:
+            with self._condition:
+                if self._workers.get(session_id) is _STARTING:
+                    del self._workers[session_id]
+                self._condition.notify_all()
+            raise
+        if hold:
+            worker.lock.acquire()
+        with self._condition:
+            self._workers[session_id] = worker
+            self._condition.notify_all()
+        return worker
+
+    @staticmethod
+    def _stop_workers(workers):
+        for worker in workers:
+            worker.stop(remove_folder=True)
+
+    def release(self, worker):
+        worker.last_used = time.time()
+        worker.lock.release()
+        with self._condition:
+            self._condition.notify_all()
+
+    def _evict_one(self):
+        """Free the slot of the least recently used idle worker, if there is one
+
+        Returns:
+            list: The removed worker, to be stopped once the pool lock is released
+        """
+        idle = [w for w in self._workers.values() if w is not _STARTING and not w.lock.locked()]
+        if not idle:
+            return []
+        victim = min(idle, key=lambda w: w.last_used)
+        del self._workers[victim.session_id]
+        return [victim]
+
+    def _reap_idle(self):
+        """Free the slots of workers idle for too long; returns them for stopping"""
+        cutoff = time.time() - WORKER_IDLE_SECONDS
+        victims = []
+        for session_id, worker in list(self._workers.items()):
+            if worker is not _STARTING and not worker.lock.locked() and worker.last_used < cutoff:
+                del self._workers[session_id]
+                victims.append(worker)
+        return victims
+
+    def shutdown(self):
+        with self._condition:
+            workers = [w for w in self._workers.values() if w is not _STARTING]
+            self._workers.clear()
+        for worker in workers:
+            worker.stop()
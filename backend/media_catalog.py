@@ -0,0 +1,225 @@
+import json
+import os
+import threading
+
+class MediaCatalog:
+    """Persistent index of stored media files and the data derived from them
+
+    Entries are keyed by media type and stored filename. Each entry records
+    the file's size and mtime when its derived data (e.g. ffprobe metadata)
+    was computed, so callers can tell when that data is stale.
+    """
+
+    def __init__(self, catalog_path):
+        self.catalog_path = catalog_path
+        self._lock = threading.RLock()
+        self._entries = {}
+        # contentHash -> entry key, for duplicate detection
+        self._hash_index = {}
+        # Lowercased stored filename, original name and stem -> entry keys,
+        # for resolving the file names users type into chat
+        self._name_index = {}
+        # Media ID -> entry keys (IDs are timestamps, so they are only unique per type)
+        self._id_index = {}
+        self._load()
+
+    @staticmethod
+    def _key(media_type, filename):
+        return f"{media_type}/{filename}"
+
+    def _load(self):
+        """Load the catalog from disk, starting empty if it is missing or corrupt"""
+        if not os.path.exists(self.catalog_path):
+            return
+        try:
+            with open(self.catalog_path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+        except Exception as e:
+            print(f"Error loading media catalog {self.catalog_path}: {e}")
+            self._entries = {}
+        self._rebuild_indexes()
+
+    def _rebuild_indexes(self):
+        self._hash_index = {entry['contentHash']: key for key, entry in self._entries.items()
+                            if entry.get('contentHash')}
+        self._name_index = {}
+        self._id_index = {}
+        for key, entry in self._entries.items():
+            self._index_names(key, entry)
+            if entry.get('id'):
+                self._id_index.setdefault(entry['id'], set()).add(key)
+
+    @staticmethod
+    def _name_keys(entry):
+        """Names an entry can be found by: stored filename, original name and its stem"""
+        filename = entry['filename'].lower()
+        name = (entry.get('name') or filename).lower()
+        return {filename, name, os.path.splitext(name)[0]}
+
+    def _index_names(self, key, entry):
+        for name in self._name_keys(entry):
+            self._name_index.setdefault(name, set()).add(key)
+
+    def _unindex_names(self, key, names):
+        for name in names:
+            keys = self._name_index.get(name)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._name_index[name]
+
+    def save(self):
+        """Write the catalog to disk atomically"""
+        with self._lock:
+            temp_path = self.catalog_path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f)
+            os.replace(temp_path, self.catalog_path)
+
+    def get(self, media_type, filename):
+        """Get a copy of an entry, or None if the file is not catalogued"""
+        with self._lock:
+            entry = self._entries.get(self._key(media_type, filename))
+            return dict(entry) if entry else None
+
+    def update(self, media_type, filename, persist=True, **fields):
+        """Create or update an entry and persist the catalog
+
+        Pass persist=False when updating many entries in a row and call
+        save() once afterwards.
+
+        Returns:
+            dict: A copy of the updated entry
+        """
+        with self._lock:
+            key = self._key(media_type, filename)
+            is_new = key not in self._entries
+            entry = self._entries.setdefault(key, {
+                'type': media_type,
+                'filename': filename
+            })
+            old_hash = entry.get('contentHash')
+            old_names = self._name_keys(entry)
+            old_id = entry.get('id')
+            entry.update(fields)
+            if is_new:
+                self._index_names(key, entry)
+            elif old_names != self._name_keys(entry):
+                self._unindex_names(key, old_names)
+                self._index_names(key, entry)
+            if old_id != entry.get('id'):
+                if old_id:
+                    self._id_index.get(old_id, set()).discard(key)
+                if entry.get('id'):
+                    self._id_index.setdefault(entry['id'], set()).add(key)
+            if old_hash != entry.get('contentHash'):
+                if old_hash and self._hash_index.get(old_hash) == self._key(media_type, filename):
+                    del self._hash_index[old_hash]
+                if entry.get('contentHash'):
+                    self._hash_index[entry['contentHash']] = self._key(media_type, filename)
+            if persist:
+                self.save()
+            return dict(entry)
+
+    def add_unique(self, media_type, filename, content_hash, folder, **fields):
+        """Add an entry unless another file of the type has the same contents
+
+        The hash lookup and the insert happen under one lock hold, so two
+        concurrent copies of a file can't both be added. An entry whose file
+        is no longer in folder doesn't count.
+
+        Returns:
+            dict: A copy of the existing entry, or None if the new one was added
+        """
+        with self._lock:
+            key = self._hash_index.get(content_hash)
+            existing = self._entries.get(key) if key else None
+            if (existing and existing.get('type') == media_type and existing['filename'] != filename
+                    and os.path.exists(os.path.join(folder, existing['filename']))):
+                return dict(existing)
+            self.update(media_type, filename, contentHash=content_hash, **fields)
+            return None
+
+    def remove(self, media_type, filename):
+        """Drop an entry; returns True if it existed"""
+        with self._lock:
+            removed = self._entries.pop(self._key(media_type, filename), None)
+            if removed is not None:
+                self._rebuild_indexes()
+                self.save()
+            return removed is not None
+
+    def prune(self, media_type, existing_filenames):
+        """Drop entries of a media type whose files no longer exist"""
+        existing = set(existing_filenames)
+        with self._lock:
+            stale = [key for key, entry in self._entries.items()
+                     if entry.get('type') == media_type and entry.get('filename') not in existing]
+            for key in stale:
+                del self._entries[key]
+            if stale:
+                self._rebuild_indexes()
+                self.save()
+            return len(stale)
+
+    def find_by_hash(self, content_hash):
+        """Get a copy of the entry whose file has the given content hash, or None"""
+        with self._lock:
+            key = self._hash_index.get(content_hash)
+            entry = self._entries.get(key) if key else None
+            return dict(entry) if entry else None
+
+    def find_by_id(self, media_id, media_type=None):
+        """Get a copy of the entry with the given media ID, or None"""
+        with self._lock:
+            for key in self._id_index.get(str(media_id), ()):
+                entry = self._entries[key]
+                if media_type is None or entry.get('type') == media_type:
+                    return dict(entry)
+        return None
+
+    def find_by_name(self, name, media_type=None):
+        """Resolve a user-supplied file name to the entry it most likely means
+
+        The name is matched, case-insensitively, against stored filenames,
+        original names (without the timestamp prefix) and then name stems.
+        Among several matches, ones with the same extension win, then the
+        most recent.
+
+        Returns:
+            dict: A copy of the best matching entry, or None
+        """
+        name = os.path.basename(name or '').lower()
+        stem, ext = os.path.splitext(name)
+        with self._lock:
+            for lookup in (name, stem):
+                matches = [self._entries[key] for key in self._name_index.get(lookup, ())
+                           if media_type is None or self._entries[key].get('type') == media_type]
+                if matches:
+                    best = max(matches, key=lambda entry: (
+                        entry['filename'].lower().endswith(ext),
+                        entry.get('lastModified') or 0
+                    ))
+                    return dict(best)
+        return None
+
+    def latest(self, media_type):
+        """Get a copy of the most recently added entry of a media type, or None"""
+        with self._lock:
+            candidates = [entry for entry in self._entries.values() if entry.get('type') == media_type]
+            if not candidates:
+                return None
+            return dict(max(candidates, key=lambda entry: entry.get('lastModified') or 0))
+
+    def entries(self, media_type=None):
+        """List copies of all entries, optionally limited to one media type"""
+        with self._lock:
+            return [dict(entry) for entry in self._entries.values()
+                    if media_type is None or entry.get('type') == media_type]
+
+    @staticmethod
+    def is_current(entry, stats):
+        """Check whether an entry was computed from the file described by os.stat() results"""
+        return (entry is not None and
+                entry.get('size') == stats.st_size and
+                entry.get('mtimeNs') == stats.st_mtime_ns)
@@ -0,0 +1,131 @@
+import itertools
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from event_bus import events
+
+# Number of background media jobs (sprite sheets, ...) that may run at once.
+# ffmpeg is already multi-threaded, so keep this small.
+MAX_WORKERS = int(os.environ.get('MEDIA_JOB_WORKERS', 2))
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='media-job')
+
+# Finished job records kept around for status queries
+MAX_JOB_HISTORY = 500
+
+# Keys of finished jobs remembered for once=True; past this many the least
+# recently used is forgotten, and at worst that job runs one more time
+MAX_FINISHED_KEYS = 4096
+
+# Job records by ID, plus the ID of the queued/running job for each key so
+# the same derivative is never scheduled twice
+_jobs = {}
+_active_keys = {}
+_finished_keys = OrderedDict()
+# Sequence numbers that keep job IDs unique; drawn under _jobs_lock
+_job_numbers = itertools.count(1)
+_jobs_lock = threading.Lock()
+# Notified whenever a job finishes
+_jobs_finished = threading.Condition(_jobs_lock)
+
+def submit_job(kind, func, *args, key=None, once=False, **kwargs):
+    """Queue a function to run on the background media worker pool
+
+    Args:
+        kind (str): Job category, e.g. 'sprite'
+        func (callable): Function to run
+        key (str): Optional de-duplication key; if a job with the same key is
+            already queued or running, its ID is returned instead
+        once (bool): Skip the job if a job with the same key already ran in
+            this process, whatever its outcome
+
+    Returns:
+        str: The job ID, or None if the job was skipped
+    """
+    with _jobs_lock:
+        if key is not None and key in _active_keys:
+            return _active_keys[key]
+        if once and key in _finished_keys:
+            _finished_keys.move_to_end(key)
+            return None
+
+        job_id = f"{kind}-{int(time.time() * 1000)}-{next(_job_numbers)}"
+        _jobs[job_id] = {
+            'id': job_id,
+            'kind': kind,
+            'key': key,
+            'status': 'queued',
+            'result': None,
+            'error': None,
+            'createdAt': int(time.time() * 1000)
+        }
+        if key is not None:
+            _active_keys[key] = job_id
+
+        # Forget the oldest finished jobs once the history is full
+        finished = [jid for jid, job in _jobs.items() if job['status'] in ('done', 'failed')]
+        for old_id in finished[:max(0, len(finished) - MAX_JOB_HISTORY)]:
+            del _jobs[old_id]
+        snapshot = dict(_jobs[job_id])
+
+    events.publish('jobs.queued', snapshot)
+    _executor.submit(_run_job, job_id, func, args, kwargs)
+    return job_id
+
+def _run_job(job_id, func, args, kwargs):
+    """Execute a queued job and record its outcome
+
+    The record is only changed under _jobs_lock, and events carry copies
+    taken under it, so readers never see a half-updated job.
+    """
+    with _jobs_lock:
+        job = _jobs[job_id]
+        job['status'] = 'running'
+        snapshot = dict(job)
+    events.publish('jobs.running', snapshot)
+    status, result, error = 'failed', None, None
+    try:
+        result = func(*args, **kwargs)
+        status = 'done'
+    except Exception as e:
+        print(f"Background job {job_id} failed: {e}")
+        traceback.print_exc()
+        error = str(e)
+    finally:
+        with _jobs_lock:
+            job['status'] = status
+            job['result'] = result
+            job['error'] = error
+            job['finishedAt'] = int(time.time() * 1000)
+            if job['key'] is not None:
+                _finished_keys[job['key']] = True
+                _finished_keys.move_to_end(job['key'])
+                while len(_finished_keys) > MAX_FINISHED_KEYS:
+                    _finished_keys.popitem(last=False)
+                if _active_keys.get(job['key']) == job_id:
+                    del _active_keys[job['key']]
+            _jobs_finished.notify_all()
+            snapshot = dict(job)
+        events.publish(f"jobs.{snapshot['status']}", snapshot)
+
+def get_job(job_id):
+    """Get a copy of the status record of a job, or None if the ID is unknown"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
+
+def wait_for_job(job_id, timeout=None):
+    """Block until a job is done or failed, or the timeout passes
+
+    Returns:
+        dict: A copy of the job record (check its 'status'), or None if the
+        ID is unknown
+    """
+    with _jobs_finished:
+        _jobs_finished.wait_for(
+            lambda: job_id not in _jobs or _jobs[job_id]['status'] in ('done', 'failed'), timeout)
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
@@ -10,9 +10,13 @@ VIDEOS_FOLDER = os.path.join(UPLOADS_FOLDER, 'videos')
 PHOTOS_FOLDER = os.path.join(UPLOADS_FOLDER, 'photos')
 AUDIO_FOLDER = os.path.join(UPLOADS_FOLDER, 'audio')
 THUMBNAILS_FOLDER = os.path.join(UPLOADS_FOLDER, 'thumbnails')
+HLS_FOLDER = os.path.join(UPLOADS_FOLDER, 'hls')
+PROXIES_FOLDER = os.path.join(UPLOADS_FOLDER, 'proxies')
+PEAKS_FOLDER = os.path.join(UPLOADS_FOLDER, 'peaks')
+KEYFRAMES_FOLDER = os.path.join(UPLOADS_FOLDER, 'keyframes')
 
 # Create necessary directories if they don't exist
-for folder in [UPLOADS_FOLDER, TEMP_FOLDER, VIDEOS_FOLDER, PHOTOS_FOLDER, AUDIO_FOLDER, THUMBNAILS_FOLDER]:
+for folder in [UPLOADS_FOLDER, TEMP_FOLDER, VIDEOS_FOLDER, PHOTOS_FOLDER, AUDIO_FOLDER, THUMBNAILS_FOLDER, HLS_FOLDER, PROXIES_FOLDER, PEAKS_FOLDER, KEYFRAMES_FOLDER]:
     if not os.path.exists(folder):
         os.makedirs(folder)
         print(f"Created directory: {folder}")
@@ -22,8 +26,75 @@ VIDEO_EXTENSIONS = ['.mp4', '.mov', '.avi', '.webm', '.mkv']
 PHOTO_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
 AUDIO_EXTENSIONS = ['.mp3', '.wav', '.ogg', '.aac', '.m4a']
 
+# Thumbnail derivative widths (in pixels) and formats generated next to the
+# full-size thumbnail. Selected with ?size=small|large on /api/thumbnails.
+THUMBNAIL_SIZES = {
+    'small': 320,   # media grid
+    'large': 1280   # preview poster
+}
+THUMBNAIL_FORMATS = ['webp', 'jpg']
+
+# Scrubbing sprite sheets: one tile every SPRITE_INTERVAL seconds, laid out
+# SPRITE_COLUMNS wide. Long videos get a wider interval so a sheet never has
+# more than SPRITE_MAX_TILES tiles.
+SPRITE_INTERVAL = 5
+SPRITE_COLUMNS = 10
+SPRITE_MAX_TILES = 200
+SPRITE_TILE_WIDTH = 160
+SPRITE_TILE_HEIGHT = 90
+
+# HLS packaging: every uploaded video is packaged in the background when
+# HLS_PACKAGING is enabled; otherwise on the first request for its playlist.
+# Renditions are (height, video kbps, audio kbps); only rungs no taller than
+# the source are produced.
+HLS_PACKAGING = os.environ.get('HLS_PACKAGING', '').lower() in ('1', 'true', 'yes')
+HLS_RENDITIONS = [
+    (1080, 5000, 192),
+    (720, 2800, 128),
+    (480, 1400, 128),
+    (360, 800, 96)
+]
+HLS_SEGMENT_SECONDS = 4
+HLS_MASTER_PLAYLIST = 'master.m3u8'
+
+# Editing proxies: a low-resolution copy of every video with a keyframe every
+# PROXY_KEYFRAME_INTERVAL frames and no B-frames, so the editor can preview
+# and seek cheaply. Renders always use the original.
+PROXY_HEIGHT = 540
+PROXY_KEYFRAME_INTERVAL = 12
+
+# Waveform peaks: audio is decoded once to mono PEAKS_SAMPLE_RATE and reduced
+# to 8-bit min/max pairs at several resolutions. PEAKS_LEVELS lists samples
+# per peak from the coarsest (zoom=0) to the finest level.
+PEAKS_SAMPLE_RATE = 8000
+PEAKS_LEVELS = [65536, 16384, 4096, 1024, 256]
+PEAKS_MAGIC = b'PEAK'
+PEAKS_VERSION = 1
+
 # Import subprocess for running ffmpeg
 import subprocess
+import math
+import json
+import hashlib
+import struct
+from media_jobs import submit_job
+from event_bus import events
+from media_catalog import MediaCatalog
+
+try:
+    import numpy as np
+except ImportError:  # Waveform peaks are skipped without numpy
+    np = None
+
+# Folders whose files are tracked in the media catalog, by media type
+MEDIA_FOLDERS = {
+    'videos': VIDEOS_FOLDER,
+    'photos': PHOTOS_FOLDER,
+    'audio': AUDIO_FOLDER
+}
+
+# Catalog of stored media and their cached ffprobe metadata
+catalog = MediaCatalog(os.path.join(UPLOADS_FOLDER, 'catalog.json'))
 
 def get_media_type(filename):
     """Determine media type based on file extension"""
@@ -39,17 +110,59 @@ def get_media_type(filename):
         # Default to video if unknown
         return 'videos'
 
-def generate_thumbnail(video_path, timestamp=2):
+def _derivative_outputs(base_name, formats):
+    """Filter chains and output arguments writing every THUMBNAIL_SIZES
+    derivative, fed from the filter labels [s0], [s1], ..."""
+    filters = []
+    outputs = []
+    for i, (size_name, width) in enumerate(THUMBNAIL_SIZES.items()):
+        # Never upscale: small sources keep their own width
+        format_labels = [f"[{size_name}_{fmt}]" for fmt in formats]
+        filters.append(f"[s{i}]scale=w='min({width},iw)':h=-2,split={len(formats)}{''.join(format_labels)}")
+        
+        for fmt, format_label in zip(formats, format_labels):
+            derivative_path = os.path.join(THUMBNAILS_FOLDER, f"{base_name}-thumbnail-{size_name}.{fmt}")
+            outputs += ['-map', format_label, '-frames:v', '1']
+            if fmt == 'webp':
+                outputs += ['-c:v', 'libwebp', '-quality', '75']
+            else:
+                outputs += ['-q:v', '4']
+            outputs += ['-f', 'image2', derivative_path]
+    return filters, outputs
+
+def _thumbnail_command(video_path, thumbnail_path, base_name, timestamp, formats):
+    """Build a single ffmpeg command that writes the full-size thumbnail and
+    every configured derivative size/format from one decoded frame"""
+    # One branch for the full-size JPEG plus one branch per derivative size
+    labels = [f"[s{i}]" for i in range(len(THUMBNAIL_SIZES))]
+    derivative_filters, derivative_outputs = _derivative_outputs(base_name, formats)
+    filters = [f"[0:v]split={len(labels) + 1}[full]{''.join(labels)}"] + derivative_filters
+    outputs = ['-map', '[full]', '-frames:v', '1', '-q:v', '2', '-f', 'image2', thumbnail_path] + derivative_outputs
+    
+    return [
+        'ffmpeg', '-y', '-ss', str(timestamp),
+        '-i', video_path, '-filter_complex', ';'.join(filters)
+    ] + outputs
+
+def generate_thumbnail(video_path, timestamp=None):
     """Generate a thumbnail for a video file using ffmpeg
     
+    The full-size JPEG is written together with the smaller derivatives
+    listed in THUMBNAIL_SIZES in a single ffmpeg pass.
+    
     Args:
         video_path (str): Path to the video file
-        timestamp (int): Timestamp in seconds to capture for the thumbnail
+        timestamp (float): Timestamp in seconds to capture for the thumbnail;
+            defaults to 2s, or the midpoint of clips shorter than 4s
         
     Returns:
         str: Path to the generated thumbnail, or None if generation failed
     """
     try:
+        if timestamp is None:
+            duration = get_media_duration(video_path)
+            timestamp = min(2, duration / 2) if duration else 0
+        
         # Extract filename without extension
         video_filename = os.path.basename(video_path)
         base_name = os.path.splitext(video_filename)[0]
@@ -61,32 +174,693 @@ def generate_thumbnail(video_path, timestamp=2):
         # Ensure thumbnails directory exists
         os.makedirs(THUMBNAILS_FOLDER, exist_ok=True)
         
-        # Use ffmpeg to generate the thumbnail
-        # -y: Overwrite output file if it exists
-        # -ss: Seek to timestamp
-        # -i: Input file
-        # -vframes 1: Extract one frame
-        # -q:v 2: Quality (lower is better, 2-31 range)
-        # -f image2: Force image2 format
+        # Try WebP + JPEG derivatives first, then JPEG only for ffmpeg
+        # builds without libwebp
+        stderr = None
+        for formats in (THUMBNAIL_FORMATS, ['jpg']):
+            cmd = _thumbnail_command(video_path, thumbnail_path, base_name, timestamp, formats)
+            
+            # Run the command with a timeout
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = process.communicate(timeout=30)
+            
+            # Check if thumbnail was created successfully
+            if process.returncode == 0 and os.path.exists(thumbnail_path) and os.path.getsize(thumbnail_path) > 0:
+                return f"/api/thumbnails/{thumbnail_filename}"
+        
+        print(f"Error creating thumbnail: {stderr.decode() if stderr else 'Unknown error'}")
+        return None
+    except Exception as e:
+        print(f"Error generating thumbnail: {str(e)}")
+        return None
+
+def generate_thumbnail_derivatives(thumbnail_path):
+    """Write the THUMBNAIL_SIZES derivatives of an existing full-size thumbnail
+    
+    Videos thumbnailed before derivatives existed get them this way, scaled
+    from the stored JPEG rather than decoded from the video again.
+    
+    Args:
+        thumbnail_path (str): Path to the full-size '-thumbnail.jpg' file
+        
+    Returns:
+        bool: True if the derivatives were written
+    """
+    try:
+        base_name = os.path.basename(thumbnail_path)[:-len('-thumbnail.jpg')]
+        labels = [f"[s{i}]" for i in range(len(THUMBNAIL_SIZES))]
+        
+        # Same WebP + JPEG, then JPEG-only fallback as generate_thumbnail
+        stderr = None
+        for formats in (THUMBNAIL_FORMATS, ['jpg']):
+            filters, outputs = _derivative_outputs(base_name, formats)
+            filters = [f"[0:v]split={len(labels)}{''.join(labels)}"] + filters
+            cmd = ['ffmpeg', '-y', '-i', thumbnail_path, '-filter_complex', ';'.join(filters)] + outputs
+            
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = process.communicate(timeout=30)
+            if process.returncode == 0:
+                return True
+        
+        print(f"Error creating thumbnail derivatives: {stderr.decode() if stderr else 'Unknown error'}")
+        return False
+    except Exception as e:
+        print(f"Error generating thumbnail derivatives: {str(e)}")
+        return False
+
+def schedule_thumbnail_derivatives(thumbnail_path, once=False):
+    """Queue derivative generation for an existing thumbnail on the background workers"""
+    return submit_job('thumbnail-derivatives', generate_thumbnail_derivatives, thumbnail_path,
+                      key=f"thumbnail-derivatives:{os.path.basename(thumbnail_path)}", once=once)
+
+def schedule_thumbnail(video_path, once=False):
+    """Queue thumbnail generation for a video on the background workers"""
+    # Keyed on the filename, which is what the thumbnail files are named after
+    return submit_job('thumbnail', generate_thumbnail, video_path,
+                      key=f"thumbnail:{os.path.basename(video_path)}", once=once)
+
+def resolve_thumbnail_filename(filename, size=None, fmt=None, accept=''):
+    """Pick the stored thumbnail file that best matches a request
+    
+    Args:
+        filename (str): Requested thumbnail filename (the full-size JPEG name)
+        size (str): Derivative size name from THUMBNAIL_SIZES, or None for full size
+        fmt (str): Preferred image format ('webp' or 'jpg'), or None to negotiate
+        accept (str): The request's Accept header, used when fmt is not given
+        
+    Returns:
+        str: Filename inside THUMBNAILS_FOLDER to serve
+    """
+    if not size or size not in THUMBNAIL_SIZES or not filename.endswith('-thumbnail.jpg'):
+        return filename
+    
+    base_name = filename[:-len('-thumbnail.jpg')]
+    if fmt in ('jpeg', 'jpg'):
+        candidates = ['jpg']
+    elif fmt == 'webp' or 'image/webp' in (accept or ''):
+        candidates = ['webp', 'jpg']
+    else:
+        candidates = ['jpg']
+    
+    for candidate in candidates:
+        derivative = f"{base_name}-thumbnail-{size}.{candidate}"
+        if os.path.exists(os.path.join(THUMBNAILS_FOLDER, derivative)):
+            return derivative
+    
+    # Derivatives not generated yet - fall back to the full-size thumbnail
+    return filename
+
+def _parse_frame_rate(rate):
+    """Convert an ffprobe rational like '30000/1001' to a float, or None"""
+    try:
+        numerator, _, denominator = rate.partition('/')
+        value = float(numerator) / float(denominator or 1)
+        return round(value, 3) if value > 0 else None
+    except (AttributeError, ValueError, ZeroDivisionError):
+        return None
+
+def probe_media(media_path):
+    """Extract technical metadata from a media file with ffprobe
+    
+    Args:
+        media_path (str): Path to the media file
+        
+    Returns:
+        dict: duration (seconds), width, height, videoCodec, audioCodec,
+        frameRate, bitRate, formatName, hasVideo and hasAudio, or None if
+        ffprobe failed
+    """
+    try:
+        cmd = [
+            'ffprobe', '-v', 'error', '-print_format', 'json',
+            '-show_format', '-show_streams', media_path
+        ]
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=30)
+        if result.returncode != 0:
+            print(f"Error probing {media_path}: {result.stderr}")
+            return None
+        
+        probe = json.loads(result.stdout or '{}')
+        streams = probe.get('streams', [])
+        media_format = probe.get('format', {})
+        # Cover art is reported as a video stream; ignore it
+        video = next((st for st in streams if st.get('codec_type') == 'video'
+                      and not st.get('disposition', {}).get('attached_pic')), None)
+        audio = next((st for st in streams if st.get('codec_type') == 'audio'), None)
+        
+        duration = media_format.get('duration') or (video or audio or {}).get('duration')
+        bit_rate = media_format.get('bit_rate')
+        return {
+            'duration': round(float(duration), 3) if duration else None,
+            'width': video.get('width') if video else None,
+            'height': video.get('height') if video else None,
+            'videoCodec': video.get('codec_name') if video else None,
+            'audioCodec': audio.get('codec_name') if audio else None,
+            'frameRate': _parse_frame_rate(video.get('avg_frame_rate')) if video else None,
+            'bitRate': int(bit_rate) if bit_rate else None,
+            'formatName': media_format.get('format_name'),
+            'hasVideo': video is not None,
+            'hasAudio': audio is not None
+        }
+    except Exception as e:
+        print(f"Error probing {media_path}: {e}")
+        return None
+
+def get_media_metadata(file_path, probe=True):
+    """Get ffprobe metadata for a file, probing only when the cache is stale
+    
+    Files in the catalogued media folders are cached in the catalog and
+    re-probed when their size or mtime changes; anything else is probed
+    directly.
+    
+    Args:
+        file_path (str): Path to the media file
+        probe (bool): Run ffprobe if nothing current is cached; with False
+            only cached metadata is returned
+        
+    Returns:
+        dict: Metadata as returned by probe_media, or None
+    """
+    try:
+        stats = os.stat(file_path)
+    except OSError:
+        return None
+    
+    folder = os.path.dirname(os.path.abspath(file_path))
+    media_type = next((t for t, f in MEDIA_FOLDERS.items() if f == folder), None)
+    if media_type is None:
+        return probe_media(file_path) if probe else None
+    
+    filename = os.path.basename(file_path)
+    entry = catalog.get(media_type, filename)
+    if MediaCatalog.is_current(entry, stats) and 'metadata' in entry:
+        return entry['metadata']
+    if not probe:
+        return None
+    
+    metadata = probe_media(file_path)
+    if metadata is not None:
+        fields = {'size': stats.st_size, 'mtimeNs': stats.st_mtime_ns, 'metadata': metadata}
+        if entry is not None and not MediaCatalog.is_current(entry, stats):
+            # The file changed, so its content hash and keyframe count are stale as well
+            fields['contentHash'] = None
+            fields['keyframeCount'] = None
+        catalog.update(media_type, filename, **fields)
+    return metadata
+
+def schedule_metadata(file_path, stats):
+    """Queue an ffprobe run for a catalogued file whose metadata isn't cached
+    
+    The key includes the file's size and mtime, so a failed probe isn't
+    retried until the file changes.
+    """
+    key = f"metadata:{file_path}:{stats.st_size}:{stats.st_mtime_ns}"
+    return submit_job('metadata', get_media_metadata, file_path, key=key, once=True)
+
+def get_media_duration(file_path):
+    """Get a media file's duration in seconds from its metadata, or None"""
+    metadata = get_media_metadata(file_path)
+    return metadata.get('duration') if metadata else None
+
+# Audio codecs that can be stream-copied into each output container
+AUDIO_COPY_CODECS = {
+    '.mp4': {'aac', 'mp3', 'alac'},
+    '.mov': {'aac', 'mp3', 'alac', 'pcm_s16le'},
+    '.mkv': {'aac', 'mp3', 'opus', 'vorbis', 'flac', 'pcm_s16le'},
+    '.webm': {'opus', 'vorbis'}
+}
+
+def can_copy_audio(audio_path, output_path):
+    """Check whether an audio file's codec can be muxed into output_path without re-encoding"""
+    metadata = get_media_metadata(audio_path)
+    codec = metadata.get('audioCodec') if metadata else None
+    ext = os.path.splitext(output_path)[1].lower()
+    return codec in AUDIO_COPY_CODECS.get(ext, set())
+
+def probe_keyframes(video_path):
+    """List the keyframe timestamps of a video's first video stream
+    
+    Only packet headers are read (nothing is decoded), so this is quick even
+    for long videos.
+    
+    Returns:
+        list: Keyframe times in seconds, ascending, or None if ffprobe failed
+    """
+    try:
+        cmd = [
+            'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+            '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', video_path
+        ]
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=120)
+        if result.returncode != 0:
+            print(f"Error probing keyframes of {video_path}: {result.stderr}")
+            return None
+        keyframes = set()
+        for line in result.stdout.splitlines():
+            pts_time, _, flags = line.partition(',')
+            if 'K' in flags and pts_time not in ('', 'N/A'):
+                keyframes.add(round(float(pts_time), 3))
+        return sorted(keyframes)
+    except Exception as e:
+        print(f"Error probing keyframes of {video_path}: {e}")
+        return None
+
+def get_keyframes_filename(video_filename):
+    """Get the keyframe index filename for a stored video"""
+    return f"{os.path.splitext(video_filename)[0]}-keyframes.json"
+
+def get_keyframes(file_path, probe=True):
+    """Get a stored video's keyframe index
+    
+    The index lives in a sidecar file in KEYFRAMES_FOLDER, stamped with the
+    size and mtime of the video it was built from; long videos have
+    thousands of keyframes, so the catalog only records their count.
+    
+    Args:
+        file_path (str): Path of a file in the videos folder
+        probe (bool): Build the index if it isn't current; with False only an
+            existing index is returned
+        
+    Returns:
+        list: Keyframe times in seconds, or None
+    """
+    try:
+        stats = os.stat(file_path)
+    except OSError:
+        return None
+    filename = os.path.basename(file_path)
+    index_filename = get_keyframes_filename(filename)
+    index_path = os.path.join(KEYFRAMES_FOLDER, index_filename)
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if MediaCatalog.is_current(index, stats):
+            return index['keyframes']
+    except (OSError, ValueError, KeyError):
+        pass
+    if not probe:
+        return None
+    
+    keyframes = probe_keyframes(file_path)
+    if keyframes is not None:
+        temp_path = os.path.join(KEYFRAMES_FOLDER, f".{index_filename}")
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'size': stats.st_size, 'mtimeNs': stats.st_mtime_ns, 'keyframes': keyframes}, f)
+        os.replace(temp_path, index_path)
+        if catalog.get('videos', filename) is not None:
+            catalog.update('videos', filename, keyframeCount=len(keyframes))
+    return keyframes
+
+def _format_vtt_time(seconds):
+    """Format seconds as a WebVTT timestamp (HH:MM:SS.mmm)"""
+    millis = int(round(seconds * 1000))
+    hours, millis = divmod(millis, 3600000)
+    minutes, millis = divmod(millis, 60000)
+    secs, millis = divmod(millis, 1000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}.{millis:03d}"
+
+def get_sprite_paths(video_filename):
+    """Get the sprite sheet and WebVTT filenames for a stored video"""
+    base_name = os.path.splitext(video_filename)[0]
+    return f"{base_name}-sprite.jpg", f"{base_name}-sprite.vtt"
+
+def generate_sprite_sheet(video_path, interval=SPRITE_INTERVAL):
+    """Generate a tiled scrubbing sprite sheet and its WebVTT index
+    
+    All tiles are written into a single JPEG in one ffmpeg pass. The VTT file
+    maps each time range to a tile using #xywh= media fragments, so players
+    can show scrubbing previews from one cached image.
+    
+    Args:
+        video_path (str): Path to the video file
+        interval (int): Seconds between captured frames
+        
+    Returns:
+        str: API path of the generated VTT file, or None if generation failed
+    """
+    try:
+        duration = get_media_duration(video_path)
+        if not duration or duration <= 0:
+            print(f"Skipping sprite sheet, unknown duration: {video_path}")
+            return None
+        
+        # Widen the interval for long videos to keep the sheet bounded
+        interval = max(interval, math.ceil(duration / SPRITE_MAX_TILES))
+        tile_count = max(1, math.ceil(duration / interval))
+        columns = min(SPRITE_COLUMNS, tile_count)
+        rows = math.ceil(tile_count / columns)
+        
+        sprite_filename, vtt_filename = get_sprite_paths(os.path.basename(video_path))
+        sprite_path = os.path.join(THUMBNAILS_FOLDER, sprite_filename)
+        vtt_path = os.path.join(THUMBNAILS_FOLDER, vtt_filename)
+        os.makedirs(THUMBNAILS_FOLDER, exist_ok=True)
+        
+        # Letterbox every frame into a fixed tile so offsets are predictable
+        video_filter = (
+            f"fps=1/{interval},"
+            f"scale={SPRITE_TILE_WIDTH}:{SPRITE_TILE_HEIGHT}:force_original_aspect_ratio=decrease,"
+            f"pad={SPRITE_TILE_WIDTH}:{SPRITE_TILE_HEIGHT}:(ow-iw)/2:(oh-ih)/2,"
+            f"tile={columns}x{rows}"
+        )
         cmd = [
-            'ffmpeg', '-y', '-ss', str(timestamp), 
-            '-i', video_path, '-vframes', '1', 
-            '-q:v', '2', '-f', 'image2', thumbnail_path
+            'ffmpeg', '-y', '-i', video_path, '-an', '-vf', video_filter,
+            '-frames:v', '1', '-q:v', '5', '-f', 'image2', sprite_path
+        ]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate(timeout=600)
+        
+        if process.returncode != 0 or not os.path.exists(sprite_path):
+            print(f"Error creating sprite sheet: {stderr.decode() if stderr else 'Unknown error'}")
+            return None
+        
+        # Write the VTT index last so its presence means the sheet is complete
+        cues = ["WEBVTT", ""]
+        for index in range(tile_count):
+            start = index * interval
+            end = min((index + 1) * interval, duration)
+            x = (index % columns) * SPRITE_TILE_WIDTH
+            y = (index // columns) * SPRITE_TILE_HEIGHT
+            cues.append(f"{_format_vtt_time(start)} --> {_format_vtt_time(end)}")
+            cues.append(f"{sprite_filename}#xywh={x},{y},{SPRITE_TILE_WIDTH},{SPRITE_TILE_HEIGHT}")
+            cues.append("")
+        
+        temp_vtt_path = vtt_path + '.tmp'
+        with open(temp_vtt_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(cues))
+        os.replace(temp_vtt_path, vtt_path)
+        
+        print(f"Sprite sheet generated: {sprite_path} ({tile_count} tiles, every {interval}s)")
+        return f"/api/thumbnails/{vtt_filename}"
+    except Exception as e:
+        print(f"Error generating sprite sheet: {str(e)}")
+        return None
+
+def schedule_sprite_sheet(video_path, once=False):
+    """Queue sprite sheet generation for a video on the background workers"""
+    return submit_job('sprite', generate_sprite_sheet, video_path, key=f"sprite:{video_path}", once=once)
+
+def get_sprite_info(video_filename):
+    """Describe a video's sprite sheet for API responses, or None if not ready"""
+    sprite_filename, vtt_filename = get_sprite_paths(video_filename)
+    if not os.path.exists(os.path.join(THUMBNAILS_FOLDER, vtt_filename)):
+        return None
+    return {
+        'path': f"/api/thumbnails/{sprite_filename}",
+        'vttPath': f"/api/thumbnails/{vtt_filename}",
+        'tileWidth': SPRITE_TILE_WIDTH,
+        'tileHeight': SPRITE_TILE_HEIGHT
+    }
+
+def get_hls_folder(video_filename):
+    """Get the folder holding the HLS package of a stored video"""
+    return os.path.join(HLS_FOLDER, os.path.splitext(video_filename)[0])
+
+def select_hls_renditions(source_height):
+    """Pick the rungs of HLS_RENDITIONS that don't upscale the source
+    
+    A source shorter than the lowest rung gets a single rendition at its own
+    (even) height.
+    """
+    renditions = [rung for rung in HLS_RENDITIONS if not source_height or rung[0] <= source_height]
+    if not renditions:
+        _, video_kbps, audio_kbps = HLS_RENDITIONS[-1]
+        renditions = [(max(2, source_height - source_height % 2), video_kbps, audio_kbps)]
+    return renditions
+
+def generate_hls_package(video_path):
+    """Package a video as HLS with an adaptive-bitrate rendition ladder
+    
+    All renditions are encoded in one ffmpeg pass from a single decode, with
+    keyframes forced on segment boundaries so players can switch between
+    them. The package is written to a temporary folder and moved into place
+    when complete, so a master playlist on disk always has all its segments.
+    
+    Args:
+        video_path (str): Path to the stored video
+        
+    Returns:
+        str: Path of the master playlist, or None if packaging failed
+    """
+    try:
+        metadata = get_media_metadata(video_path) or {}
+        if not metadata.get('hasVideo'):
+            print(f"Skipping HLS packaging, no video stream: {video_path}")
+            return None
+        
+        renditions = select_hls_renditions(metadata.get('height'))
+        has_audio = metadata.get('hasAudio')
+        
+        package_folder = get_hls_folder(os.path.basename(video_path))
+        work_folder = os.path.join(HLS_FOLDER, f".{os.path.basename(package_folder)}.tmp")
+        shutil.rmtree(work_folder, ignore_errors=True)
+        os.makedirs(work_folder)
+        
+        # One decode, split into a scaled branch per rendition
+        filter_graph = f"[0:v]split={len(renditions)}" + ''.join(f"[v{i}]" for i in range(len(renditions)))
+        for i, (height, _, _) in enumerate(renditions):
+            filter_graph += f";[v{i}]scale=-2:{height}[v{i}out]"
+        
+        cmd = ['ffmpeg', '-y', '-i', video_path, '-filter_complex', filter_graph]
+        stream_map = []
+        for i, (height, video_kbps, audio_kbps) in enumerate(renditions):
+            cmd += [
+                '-map', f'[v{i}out]', f'-c:v:{i}', 'libx264',
+                f'-b:v:{i}', f'{video_kbps}k',
+                f'-maxrate:v:{i}', f'{int(video_kbps * 1.1)}k',
+                f'-bufsize:v:{i}', f'{video_kbps * 2}k'
+            ]
+            if has_audio:
+                cmd += ['-map', '0:a:0', f'-c:a:{i}', 'aac', f'-b:a:{i}', f'{audio_kbps}k']
+                stream_map.append(f"v:{i},a:{i}")
+            else:
+                stream_map.append(f"v:{i}")
+        cmd += [
+            '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-sc_threshold', '0',
+            '-force_key_frames', f'expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})',
+            '-f', 'hls', '-hls_time', str(HLS_SEGMENT_SECONDS),
+            '-hls_playlist_type', 'vod', '-hls_flags', 'independent_segments',
+            '-hls_segment_filename', os.path.join(work_folder, 'v%v', 'segment_%03d.ts'),
+            '-master_pl_name', HLS_MASTER_PLAYLIST,
+            '-var_stream_map', ' '.join(stream_map),
+            os.path.join(work_folder, 'v%v', 'index.m3u8')
         ]
         
-        # Run the command with a timeout
         process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate(timeout=30)
+        stdout, stderr = process.communicate(timeout=3600)
         
-        # Check if thumbnail was created successfully
-        if os.path.exists(thumbnail_path) and os.path.getsize(thumbnail_path) > 0:
-            return f"/api/thumbnails/{thumbnail_filename}"
-        else:
-            print(f"Error creating thumbnail: {stderr.decode() if stderr else 'Unknown error'}")
+        if process.returncode != 0 or not os.path.exists(os.path.join(work_folder, HLS_MASTER_PLAYLIST)):
+            print(f"Error packaging HLS: {stderr.decode() if stderr else 'Unknown error'}")
+            shutil.rmtree(work_folder, ignore_errors=True)
             return None
+        
+        shutil.rmtree(package_folder, ignore_errors=True)
+        os.replace(work_folder, package_folder)
+        print(f"HLS package generated: {package_folder} ({', '.join(f'{r[0]}p' for r in renditions)})")
+        return os.path.join(package_folder, HLS_MASTER_PLAYLIST)
     except Exception as e:
-        print(f"Error generating thumbnail: {str(e)}")
+        print(f"Error generating HLS package: {str(e)}")
+        return None
+
+def schedule_hls_package(video_path, once=False):
+    """Queue HLS packaging for a video on the background workers"""
+    return submit_job('hls', generate_hls_package, video_path, key=f"hls:{video_path}", once=once)
+
+def get_hls_path(video_filename, media_id):
+    """Get the API path of a video's master playlist, or None if not packaged"""
+    if not os.path.exists(os.path.join(get_hls_folder(video_filename), HLS_MASTER_PLAYLIST)):
         return None
+    return f"/api/videos/{media_id}/{HLS_MASTER_PLAYLIST}"
+
+def get_proxy_filename(video_filename):
+    """Get the proxy filename for a stored video"""
+    return f"{os.path.splitext(video_filename)[0]}-proxy.mp4"
+
+def generate_proxy(video_path):
+    """Generate a low-resolution, short-GOP editing proxy for a video
+    
+    The proxy is scaled to at most PROXY_HEIGHT lines (never upscaled) and
+    encoded for fast decoding and seeking rather than for size.
+    
+    Args:
+        video_path (str): Path to the stored video
+        
+    Returns:
+        str: API path of the proxy, or None if generation failed
+    """
+    try:
+        proxy_filename = get_proxy_filename(os.path.basename(video_path))
+        proxy_path = os.path.join(PROXIES_FOLDER, proxy_filename)
+        # Hidden while being written so it is never served half-finished
+        temp_path = os.path.join(PROXIES_FOLDER, f".{proxy_filename}")
+        os.makedirs(PROXIES_FOLDER, exist_ok=True)
+        
+        cmd = [
+            'ffmpeg', '-y', '-i', video_path,
+            '-map', '0:v:0', '-map', '0:a:0?',
+            '-vf', f"scale=-2:'min({PROXY_HEIGHT},trunc(ih/2)*2)'",
+            '-c:v', 'libx264', '-preset', 'veryfast', '-tune', 'fastdecode', '-crf', '28',
+            '-g', str(PROXY_KEYFRAME_INTERVAL), '-keyint_min', str(PROXY_KEYFRAME_INTERVAL),
+            '-bf', '0', '-sc_threshold', '0', '-pix_fmt', 'yuv420p',
+            '-c:a', 'aac', '-b:a', '96k',
+            '-movflags', '+faststart', '-f', 'mp4', temp_path
+        ]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate(timeout=3600)
+        
+        if process.returncode != 0 or not os.path.exists(temp_path):
+            print(f"Error creating proxy: {stderr.decode() if stderr else 'Unknown error'}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
+        
+        os.replace(temp_path, proxy_path)
+        print(f"Proxy generated: {proxy_path}")
+        return f"/api/proxies/{proxy_filename}"
+    except Exception as e:
+        print(f"Error generating proxy: {str(e)}")
+        return None
+
+def schedule_proxy(video_path, once=False):
+    """Queue editing proxy generation for a video on the background workers"""
+    return submit_job('proxy', generate_proxy, video_path, key=f"proxy:{video_path}", once=once)
+
+def get_proxy_path(video_filename):
+    """Get the API path of a video's editing proxy, or None if not ready"""
+    proxy_filename = get_proxy_filename(video_filename)
+    if not os.path.exists(os.path.join(PROXIES_FOLDER, proxy_filename)):
+        return None
+    return f"/api/proxies/{proxy_filename}"
+
+def get_peaks_filename(media_filename):
+    """Get the waveform peaks filename for a stored audio or video file"""
+    return f"{os.path.splitext(media_filename)[0]}-peaks.dat"
+
+def generate_peaks(media_path):
+    """Compute multi-resolution waveform peaks for a file's audio track
+    
+    The audio is decoded once by ffmpeg and streamed through numpy in
+    blocks, so memory stays flat even for hour-long files. The result is
+    stored as a small binary file:
+    
+        'PEAK', version (u8), sample rate (u32), level count (u8),
+        per level: samples per peak (u32), peak count (u32),
+        then per level: interleaved int8 min/max pairs
+    
+    Args:
+        media_path (str): Path to the stored audio or video file
+        
+    Returns:
+        str: Path of the peaks file, or None if generation failed
+    """
+    if np is None:
+        print("Skipping waveform peaks, numpy is not installed")
+        return None
+    try:
+        finest = PEAKS_LEVELS[-1]
+        cmd = [
+            'ffmpeg', '-v', 'error', '-i', media_path, '-vn', '-ac', '1',
+            '-ar', str(PEAKS_SAMPLE_RATE), '-f', 's16le', '-'
+        ]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        
+        mins, maxs = [], []
+        try:
+            while True:
+                # Whole peaks per read; only the last block can be short
+                data = process.stdout.read(finest * 1024 * 2)
+                if not data:
+                    break
+                samples = np.frombuffer(data[:len(data) - len(data) % 2], dtype='<i2')
+                whole = len(samples) - len(samples) % finest
+                if whole:
+                    blocks = samples[:whole].reshape(-1, finest)
+                    mins.append(blocks.min(axis=1))
+                    maxs.append(blocks.max(axis=1))
+                if whole < len(samples):
+                    mins.append(samples[whole:].min(keepdims=True))
+                    maxs.append(samples[whole:].max(keepdims=True))
+            process.wait(timeout=60)
+        finally:
+            # A failed read or a hung ffmpeg must not leave the process behind
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            process.stdout.close()
+        
+        if process.returncode != 0 or not mins:
+            print(f"Error decoding audio for waveform peaks: {media_path}")
+            return None
+        
+        # 16-bit samples to 8-bit peaks
+        finest_mins = (np.concatenate(mins) >> 8).astype(np.int8)
+        finest_maxs = (np.concatenate(maxs) >> 8).astype(np.int8)
+        
+        header = struct.pack('<4sBIB', PEAKS_MAGIC, PEAKS_VERSION, PEAKS_SAMPLE_RATE, len(PEAKS_LEVELS))
+        levels = []
+        for samples_per_peak in PEAKS_LEVELS:
+            starts = np.arange(0, len(finest_mins), samples_per_peak // finest)
+            pairs = np.empty((len(starts), 2), dtype=np.int8)
+            pairs[:, 0] = np.minimum.reduceat(finest_mins, starts)
+            pairs[:, 1] = np.maximum.reduceat(finest_maxs, starts)
+            header += struct.pack('<II', samples_per_peak, len(starts))
+            levels.append(pairs.tobytes())
+        
+        peaks_path = os.path.join(PEAKS_FOLDER, get_peaks_filename(os.path.basename(media_path)))
+        temp_path = peaks_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(header)
+            for level in levels:
+                f.write(level)
+        os.replace(temp_path, peaks_path)
+        
+        print(f"Waveform peaks generated: {peaks_path} ({len(finest_mins)} peaks at the finest level)")
+        return peaks_path
+    except Exception as e:
+        print(f"Error generating waveform peaks: {str(e)}")
+        return None
+
+def schedule_peaks(media_path, once=False):
+    """Queue waveform peak generation on the background workers"""
+    if np is None:
+        return None
+    return submit_job('peaks', generate_peaks, media_path, key=f"peaks:{media_path}", once=once)
+
+def load_peaks(media_filename, zoom=0):
+    """Read one resolution level from a stored peaks file
+    
+    Args:
+        media_filename (str): Stored filename of the audio or video file
+        zoom (int): Level index, 0 (coarsest) to len(PEAKS_LEVELS) - 1
+        
+    Returns:
+        dict: sampleRate, samplesPerPeak, zoom, levels and data (flat list of
+        min/max pairs scaled to -128..127), or None if there are no peaks
+    """
+    peaks_path = os.path.join(PEAKS_FOLDER, get_peaks_filename(media_filename))
+    if not os.path.exists(peaks_path):
+        return None
+    with open(peaks_path, 'rb') as f:
+        magic, version, sample_rate, level_count = struct.unpack('<4sBIB', f.read(10))
+        if magic != PEAKS_MAGIC or version != PEAKS_VERSION:
+            return None
+        level_table = [struct.unpack('<II', f.read(8)) for _ in range(level_count)]
+        zoom = min(max(zoom, 0), level_count - 1)
+        f.seek(sum(count * 2 for _, count in level_table[:zoom]), os.SEEK_CUR)
+        samples_per_peak, count = level_table[zoom]
+        data = f.read(count * 2)
+    return {
+        'sampleRate': sample_rate,
+        'samplesPerPeak': samples_per_peak,
+        'zoom': zoom,
+        'levels': level_count,
+        'data': list(struct.unpack(f'<{len(data)}b', data))
+    }
+
+def get_peaks_path(media_filename, media_id):
+    """Get the API path of a file's waveform peaks, or None if not ready"""
+    if not os.path.exists(os.path.join(PEAKS_FOLDER, get_peaks_filename(media_filename))):
+        return None
+    return f"/api/audio/{media_id}/peaks"
 
 def get_file_path_from_url(url):
     """Convert an API URL to a file system path"""
@@ -120,8 +894,351 @@ def get_file_path_from_url(url):
         
     return url
 
+# Chunk size used when streaming uploads to disk and hashing files
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def parse_stored_filename(filename, stats):
+    """Split a stored filename into its timestamp, original name and media ID
+    
+    Args:
+        filename (str): Stored filename, normally '{timestamp}-{name}'
+        stats (os.stat_result): File stats, used when there is no timestamp prefix
+        
+    Returns:
+        tuple: (timestamp, original_name, file_id)
+    """
+    parts = filename.split('-', 1)
+    if len(parts) > 1 and parts[0].isdigit():
+        # Has timestamp in filename
+        timestamp = int(parts[0])
+        return timestamp, parts[1], str(timestamp)
+    
+    # No timestamp - use the file's modification time and the full filename
+    timestamp = int(stats.st_mtime * 1000)
+    return timestamp, filename, f"file-{timestamp}"
+
+def sync_catalog_entry(media_type, filename, stats=None, persist=True):
+    """Make sure a stored file has a catalog entry with its ID and names
+    
+    Returns:
+        bool: True if the entry was created or changed
+    """
+    entry = catalog.get(media_type, filename)
+    if entry is not None and entry.get('name'):
+        return False
+    if stats is None:
+        stats = os.stat(os.path.join(MEDIA_FOLDERS[media_type], filename))
+    timestamp, original_name, file_id = parse_stored_filename(filename, stats)
+    catalog.update(media_type, filename, persist=persist, id=file_id,
+                   name=original_name, lastModified=timestamp)
+    return True
+
+def sync_catalog():
+    """Catalog every file in the media folders and drop entries for deleted ones"""
+    changed = False
+    for media_type, folder in MEDIA_FOLDERS.items():
+        filenames = [f for f in os.listdir(folder)
+                     if not f.startswith('.') and os.path.isfile(os.path.join(folder, f))]
+        catalog.prune(media_type, filenames)
+        for filename in filenames:
+            changed = sync_catalog_entry(media_type, filename, persist=False) or changed
+    if changed:
+        catalog.save()
+
+def hash_file(file_path):
+    """Compute the SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def find_duplicate(media_type, content_hash, size):
+    """Find a stored file of the same type with identical contents
+    
+    Files catalogued before hashing existed are hashed lazily, and only when
+    their size matches, so the lookup stays cheap.
+    
+    Returns:
+        dict: The catalog entry of the existing file, or None
+    """
+    candidates = [catalog.find_by_hash(content_hash)]
+    candidates += [entry for entry in catalog.entries(media_type)
+                   if entry.get('size') == size and not entry.get('contentHash')]
+    
+    for entry in candidates:
+        if not entry or entry.get('type') != media_type:
+            continue
+        existing_path = os.path.join(MEDIA_FOLDERS[media_type], entry['filename'])
+        try:
+            stats = os.stat(existing_path)
+        except OSError:
+            continue
+        if stats.st_size != size:
+            continue
+        
+        existing_hash = entry.get('contentHash') if MediaCatalog.is_current(entry, stats) else None
+        if not existing_hash:
+            existing_hash = hash_file(existing_path)
+            catalog.update(media_type, entry['filename'], size=stats.st_size,
+                           mtimeNs=stats.st_mtime_ns, contentHash=existing_hash)
+        if existing_hash == content_hash:
+            return entry
+    return None
+
+def describe_media_file(media_type, filename):
+    """Build the API description of a stored media file from the catalog
+    
+    Unlike get_all_media, this never generates thumbnails or sprites.
+    """
+    file_path = os.path.join(MEDIA_FOLDERS[media_type], filename)
+    stats = os.stat(file_path)
+    timestamp, original_name, file_id = parse_stored_filename(filename, stats)
+    item = {
+        'id': file_id,
+        'name': original_name,
+        'path': f"/api/{media_type}/{filename}",
+        'type': media_type,
+        'size': stats.st_size,
+        'lastModified': timestamp,
+        'isTemp': False,
+        'metadata': get_media_metadata(file_path)
+    }
+    if media_type == 'videos':
+        thumbnail_filename = f"{os.path.splitext(filename)[0]}-thumbnail.jpg"
+        if os.path.exists(os.path.join(THUMBNAILS_FOLDER, thumbnail_filename)):
+            item['thumbnailPath'] = f"/api/thumbnails/{thumbnail_filename}"
+        sprite_info = get_sprite_info(filename)
+        if sprite_info:
+            item['sprite'] = sprite_info
+    return item
+
+def _copy_and_hash(stream, file_path):
+    """Stream an upload body to disk, hashing and counting it on the way
+    
+    Data goes to a hidden '.part' file next to file_path that is renamed
+    into place once complete, so readers never see a half-written file.
+    
+    Returns:
+        tuple: (sha256 hex digest, bytes written)
+    """
+    digest = hashlib.sha256()
+    size = 0
+    part_path = os.path.join(os.path.dirname(file_path), f".{os.path.basename(file_path)}.part")
+    try:
+        with open(part_path, 'wb') as out:
+            for chunk in iter(lambda: stream.read(COPY_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        os.replace(part_path, file_path)
+    except Exception:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return digest.hexdigest(), size
+
+def save_media_stream(stream, filename):
+    """Save a raw request body straight into its media folder
+    
+    Unlike save_media_file, nothing is spooled to a temporary file first:
+    the body is written once, hashed and sized as it arrives, and then
+    catalogued like any other upload.
+    
+    Args:
+        stream: Readable binary stream with the file contents
+        filename (str): Original filename of the upload
+        
+    Returns:
+        dict: Media item, as returned by register_media_file
+    """
+    filename = secure_filename(filename or '')
+    if not filename:
+        raise ValueError('No filename given')
+    
+    media_type = get_media_type(filename)
+    timestamp = int(time.time() * 1000)
+    file_path = os.path.join(MEDIA_FOLDERS[media_type], f"{timestamp}-{filename}")
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    
+    print(f"Streaming {media_type} upload to: {file_path}")
+    content_hash, written = _copy_and_hash(stream, file_path)
+    print(f"Streamed {written} bytes to {file_path}")
+    
+    return register_media_file(file_path, filename, timestamp, content_hash)
+
+def register_media_file(file_path, filename, timestamp, content_hash=None):
+    """Add a file already written to its media folder to the catalog
+    
+    This is the shared tail of every permanent upload path: duplicate check,
+    catalog entry, metadata probe, thumbnail and sprite scheduling.
+    
+    Args:
+        file_path (str): Path of the stored file ('{timestamp}-{filename}')
+        filename (str): Original (secured) filename
+        timestamp (int): Timestamp prefix used in the stored filename
+        content_hash (str): SHA-256 of the contents, computed here if None
+        
+    Returns:
+        dict: Media item for the API response. For duplicates the new file is
+        removed and the existing item is returned with 'duplicate': True and
+        its 'existingId'.
+    """
+    media_type = get_media_type(filename)
+    stored_filename = os.path.basename(file_path)
+    stats = os.stat(file_path)
+    if content_hash is None:
+        content_hash = hash_file(file_path)
+    
+    # find_duplicate may hash older files, so it runs outside the catalog
+    # lock; add_unique then re-checks and inserts atomically, catching a
+    # concurrent upload of the same contents
+    duplicate = find_duplicate(media_type, content_hash, stats.st_size)
+    if not duplicate:
+        duplicate = catalog.add_unique(media_type, stored_filename, content_hash, MEDIA_FOLDERS[media_type],
+                                       id=str(timestamp), name=filename, lastModified=timestamp,
+                                       size=stats.st_size, mtimeNs=stats.st_mtime_ns)
+    if duplicate:
+        os.remove(file_path)
+        result = describe_media_file(media_type, duplicate['filename'])
+        result['duplicate'] = True
+        result['existingId'] = result['id']
+        print(f"Duplicate upload of {duplicate['filename']}, discarded new copy")
+        return result
+    
+    print(f"File saved with size: {stats.st_size} bytes")
+    
+    # Result object to return
+    result = {
+        'id': str(timestamp),
+        'name': filename,
+        'path': f"/api/{media_type}/{stored_filename}",
+        'type': media_type,
+        'size': stats.st_size,
+        'lastModified': timestamp,
+        'isTemp': False,
+        # Probe once at ingest; the catalog caches it for later requests
+        'metadata': get_media_metadata(file_path)
+    }
+    
+    # Waveform peaks for audio files and video soundtracks
+    if media_type in ('audio', 'videos') and (result['metadata'] or {}).get('hasAudio'):
+        schedule_peaks(file_path)
+    
+    # Generate thumbnail for videos
+    if media_type == 'videos':
+        print(f"Generating thumbnail for video: {file_path}")
+        thumbnail_path = generate_thumbnail(file_path)
+        if thumbnail_path:
+            result['thumbnailPath'] = thumbnail_path
+            print(f"Thumbnail generated: {thumbnail_path}")
+        else:
+            print("Failed to generate thumbnail")
+        
+        # Scrubbing sprites and the editing proxy take longer, so build them
+        # in the background
+        schedule_sprite_sheet(file_path)
+        schedule_proxy(file_path)
+        if HLS_PACKAGING:
+            schedule_hls_package(file_path)
+    
+    events.publish('media.added', result)
+    return result
+
+def resolve_media_path(media_id, media_type=None):
+    """Map a media ID to its storage path through the catalog
+    
+    Returns:
+        str: Absolute path of the stored file, or None if the ID is unknown
+    """
+    entry = catalog.find_by_id(media_id, media_type)
+    if entry is None:
+        return None
+    return os.path.join(MEDIA_FOLDERS[entry['type']], entry['filename'])
+
+def resolve_media_context(context, media_type=None):
+    """Resolve a media item sent by the frontend ({id, path, ...}) to a storage path
+    
+    The ID is looked up in the catalog first; the API path is only used for
+    items the catalog doesn't know yet (e.g. temp files).
+    
+    Returns:
+        str: Path of the file, or None if it can't be resolved
+    """
+    if not context:
+        return None
+    if context.get('id'):
+        path = resolve_media_path(context['id'], media_type)
+        if path:
+            return path
+    path = get_file_path_from_url(context.get('path'))
+    if path and path != context.get('path') and os.path.exists(path):
+        return path
+    return None
+
+# Bytes read ahead into the page cache by warm_page_cache where the OS can't
+# be asked to do it in the background
+PREPARE_READAHEAD_BYTES = 256 * 1024 * 1024
+
+def warm_page_cache(file_path):
+    """Get a file's contents into the OS page cache ahead of its first read"""
+    with open(file_path, 'rb') as f:
+        if hasattr(os, 'posix_fadvise'):
+            # The kernel reads the file in the background
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            return
+        remaining = PREPARE_READAHEAD_BYTES
+        while remaining > 0:
+            chunk = f.read(min(COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+
+def prepare_media(file_path):
+    """Warm what the first edit of a file will need
+    
+    Probes and caches its metadata and (for videos) keyframe index, schedules
+    any missing sprite sheet, editing proxy and waveform peaks, and pulls the
+    file into the page cache.
+    
+    Args:
+        file_path (str): Path of a stored media file
+        
+    Returns:
+        dict: 'metadata' and, for videos, 'keyframes' (the number found)
+    """
+    filename = os.path.basename(file_path)
+    media_type = get_media_type(filename)
+    metadata = get_media_metadata(file_path)
+    result = {'metadata': metadata}
+    
+    if media_type == 'videos':
+        keyframes = get_keyframes(file_path)
+        result['keyframes'] = len(keyframes) if keyframes is not None else None
+        if not get_sprite_info(filename):
+            schedule_sprite_sheet(file_path, once=True)
+        if not get_proxy_path(filename):
+            schedule_proxy(file_path, once=True)
+    
+    if media_type in ('audio', 'videos') and (metadata or {}).get('hasAudio'):
+        if not os.path.exists(os.path.join(PEAKS_FOLDER, get_peaks_filename(filename))):
+            schedule_peaks(file_path, once=True)
+    
+    warm_page_cache(file_path)
+    return result
+
+def schedule_prepare(file_path):
+    """Queue prepare_media for a file; repeated hints for the same file share one job"""
+    return submit_job('prepare', prepare_media, file_path, key=f"prepare:{file_path}")
+
 def save_media_file(file, is_temp=False):
-    """Save a media file to the appropriate directory"""
+    """Save a media file to the appropriate directory
+    
+    Permanent uploads are hashed while they are written. If a file with the
+    same contents is already stored, the new copy is discarded and the
+    existing item is returned with 'duplicate': True and its 'existingId',
+    skipping thumbnail, sprite and probe work.
+    """
     filename = secure_filename(file.filename)
     media_type = get_media_type(filename)
     
@@ -132,32 +1249,24 @@ def save_media_file(file, is_temp=False):
     try:
         print(f"Attempting to save file: {filename}")
         
-        if is_temp:
-            # Save to temp directory
-            file_path = os.path.join(TEMP_FOLDER, unique_filename)
-            print(f"Saving temp file to: {file_path}")
-            file.save(file_path)
-            media_url = f"/api/temp/{unique_filename}"
-        else:
+        if not is_temp:
             # Save to appropriate media directory
-            if media_type == 'videos':
-                dest_folder = VIDEOS_FOLDER
-            elif media_type == 'photos':
-                dest_folder = PHOTOS_FOLDER
-            else:  # audio
-                dest_folder = AUDIO_FOLDER
-                
-            file_path = os.path.join(dest_folder, unique_filename)
+            file_path = os.path.join(MEDIA_FOLDERS[media_type], unique_filename)
             print(f"Saving {media_type} file to: {file_path}")
             
             # Ensure directory exists
             os.makedirs(os.path.dirname(file_path), exist_ok=True)
             
-            # Save the file
-            file.save(file_path)
-            media_url = f"/api/{media_type}/{unique_filename}"
-            
+            # Save the file, hashing it as it streams in
+            content_hash, written = _copy_and_hash(file.stream, file_path)
             print(f"File saved successfully: {file_path}")
+            
+            return register_media_file(file_path, filename, timestamp, content_hash)
+        
+        # Save to temp directory
+        file_path = os.path.join(TEMP_FOLDER, unique_filename)
+        print(f"Saving temp file to: {file_path}")
+        file.save(file_path)
         
         # Verify file exists
         if os.path.exists(file_path):
@@ -167,28 +1276,15 @@ def save_media_file(file, is_temp=False):
             print(f"WARNING: File does not exist after save: {file_path}")
             file_size = 0
         
-        # Result object to return
-        result = {
+        return {
             'id': str(timestamp),
             'name': filename,
-            'path': media_url,
+            'path': f"/api/temp/{unique_filename}",
             'type': media_type,
             'size': file_size,
             'lastModified': timestamp,
-            'isTemp': is_temp
+            'isTemp': True
         }
-        
-        # Generate thumbnail for videos
-        if media_type == 'videos' and not is_temp:
-            print(f"Generating thumbnail for video: {file_path}")
-            thumbnail_path = generate_thumbnail(file_path)
-            if thumbnail_path:
-                result['thumbnailPath'] = thumbnail_path
-                print(f"Thumbnail generated: {thumbnail_path}")
-            else:
-                print("Failed to generate thumbnail")
-                
-        return result
     except Exception as e:
         print(f"ERROR saving file {filename}: {str(e)}")
         # Re-raise the exception for handling in the route
@@ -229,26 +1325,24 @@ def get_all_media():
         media_list = []
         if not os.path.exists(directory):
             return media_list
+        
+        filenames = os.listdir(directory)
+        # Forget catalog entries for files deleted behind our back
+        catalog.prune(media_type, filenames)
+        catalog_changed = False
             
-        for filename in os.listdir(directory):
+        for filename in filenames:
+            # Hidden '.part' files are uploads still being written
+            if filename.startswith('.'):
+                continue
             if os.path.isfile(os.path.join(directory, filename)):
                 try:
                     file_path = os.path.join(directory, filename)
                     stats = os.stat(file_path)
                     
                     # Check if the filename has a timestamp prefix
-                    parts = filename.split('-', 1)
-                    
-                    if len(parts) > 1 and parts[0].isdigit():
-                        # Has timestamp in filename
-                        timestamp = int(parts[0])
-                        original_name = parts[1]
-                        file_id = str(timestamp)
-                    else:
-                        # No timestamp - use the file's modification time and the full filename
-                        timestamp = int(stats.st_mtime * 1000)
-                        original_name = filename
-                        file_id = f"file-{timestamp}"
+                    timestamp, original_name, file_id = parse_stored_filename(filename, stats)
+                    catalog_changed = sync_catalog_entry(media_type, filename, stats, persist=False) or catalog_changed
                     
                     # Create base media item
                     media_item = {
@@ -257,8 +1351,13 @@ def get_all_media():
                         'path': f"/api/{media_type}/{filename}",
                         'type': media_type,
                         'size': stats.st_size,
-                        'lastModified': timestamp
+                        'lastModified': timestamp,
+                        # Probing here would hold up the listing; uncached
+                        # files are probed in the background instead
+                        'metadata': get_media_metadata(file_path, probe=False)
                     }
+                    if media_item['metadata'] is None:
+                        schedule_metadata(file_path, stats)
                     
                     # Add thumbnail for videos
                     if media_type == 'videos':
@@ -267,18 +1366,53 @@ def get_all_media():
                         thumbnail_filename = f"{base_name}-thumbnail.jpg"
                         thumbnail_path = os.path.join(THUMBNAILS_FOLDER, thumbnail_filename)
                         
+                        small_path = os.path.join(THUMBNAILS_FOLDER, f"{base_name}-thumbnail-small.jpg")
+                        
                         if os.path.exists(thumbnail_path):
                             media_item['thumbnailPath'] = f"/api/thumbnails/{thumbnail_filename}"
+                            # Videos thumbnailed before derivatives existed get them in the
+                            # background; the full-size image is served until then
+                            if not os.path.exists(small_path):
+                                schedule_thumbnail_derivatives(thumbnail_path, once=True)
+                        else:
+                            # Generating here would hold up the listing; the item
+                            # gets its thumbnailPath once the job has written it
+                            schedule_thumbnail(file_path, once=True)
+                        
+                        sprite_info = get_sprite_info(filename)
+                        if sprite_info:
+                            media_item['sprite'] = sprite_info
+                        else:
+                            # Backfill older videos, but don't retry failures on every listing
+                            schedule_sprite_sheet(file_path, once=True)
+                        
+                        proxy_path = get_proxy_path(filename)
+                        if proxy_path:
+                            media_item['proxyPath'] = proxy_path
                         else:
-                            # Generate thumbnail if it doesn't exist
-                            thumbnail_url = generate_thumbnail(file_path)
-                            if thumbnail_url:
-                                media_item['thumbnailPath'] = thumbnail_url
+                            schedule_proxy(file_path, once=True)
+                        
+                        hls_path = get_hls_path(filename, file_id)
+                        if hls_path:
+                            media_item['hlsPath'] = hls_path
+                        elif HLS_PACKAGING:
+                            schedule_hls_package(file_path, once=True)
+                    
+                    # Waveform peaks for audio files and video soundtracks
+                    if media_type in ('audio', 'videos') and (media_item['metadata'] or {}).get('hasAudio'):
+                        peaks_path = get_peaks_path(filename, file_id)
+                        if peaks_path:
+                            media_item['peaksPath'] = peaks_path
+                        else:
+                            schedule_peaks(file_path, once=True)
                     
                     media_list.append(media_item)
                 except Exception as e:
                     print(f"Error processing {filename}: {e}")
         
+        if catalog_changed:
+            catalog.save()
+        
         # Sort by timestamp (newest first)
         media_list.sort(key=lambda x: x['lastModified'], reverse=True)
         return media_list
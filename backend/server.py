@@ -5,15 +5,23 @@ import threading
 import asyncio
 import time
 import subprocess
-import msvcrt
 import os
 import shutil
 import re
+import mimetypes
 from flask import Flask, request, jsonify, send_from_directory
 from flask_cors import CORS
 import uvicorn
 from a2wsgi import WSGIMiddleware
-from media_utils import save_media_file, delete_temp_file, clean_temp_files, get_all_media, VIDEOS_FOLDER, PHOTOS_FOLDER, AUDIO_FOLDER, TEMP_FOLDER, THUMBNAILS_FOLDER, get_file_path_from_url
+from asgi_media import MediaFileApp
+from event_bus import EventSocketApp, events
+from chat_store import ChatStore, DEFAULT_SESSION
+from mcp_workers import MCPWorkerPool, WorkerBusyError
+from command_engine import plan_command, run_plan, replace_audio_plan, CommandError, FAST_PATH_WAIT
+from media_jobs import submit_job, wait_for_job
+from static_assets import precompress_build, select_static_variant, static_cache_control
+from upload_sessions import create_session, get_session, write_chunk, abort_session, UploadError
+from media_utils import catalog, sync_catalog, sync_catalog_entry, register_media_file, resolve_media_context, save_media_file, save_media_stream, delete_temp_file, clean_temp_files, get_all_media, VIDEOS_FOLDER, PHOTOS_FOLDER, AUDIO_FOLDER, TEMP_FOLDER, THUMBNAILS_FOLDER, PROXIES_FOLDER, get_file_path_from_url, resolve_thumbnail_filename, get_media_duration, get_hls_folder, schedule_hls_package, HLS_MASTER_PLAYLIST, load_peaks, schedule_peaks, PEAKS_LEVELS, resolve_media_path, schedule_prepare
 
 # Function to handle output files and move them to the proper location
 def handle_output_file(output_path):
@@ -61,6 +69,9 @@ def handle_output_file(output_path):
         # Move the file to the videos folder
         shutil.move(output_path, new_path)
         print(f"[DEBUG] Moved output file from {output_path} to {new_path}")
+        sync_catalog_entry('videos', new_filename)
+        events.publish('media.added', {'type': 'videos', 'filename': new_filename,
+                                       'path': f"/api/videos/{new_filename}"})
         
         # Return the API path for this file
         return f"/api/videos/{new_filename}"
@@ -68,29 +79,105 @@ def handle_output_file(output_path):
         print(f"[DEBUG] Error moving output file: {e}")
         return None
 
+# Sprite sheet indexes are served from the thumbnails folder
+mimetypes.add_type('text/vtt', '.vtt')
+mimetypes.add_type('application/vnd.apple.mpegurl', '.m3u8')
+mimetypes.add_type('video/mp2t', '.ts')
+
 # Create Flask app
 app = Flask(__name__, static_folder='../frontend/build')
 CORS(app)
 # Clean any temporary files on startup
 clean_count = clean_temp_files()
 print(f"Cleaned {clean_count} temporary files on startup")
+# Index every stored file so name lookups never have to scan the folders
+sync_catalog()
+# Compressed variants of the frontend build, if they are missing or stale
+precompress_build(app.static_folder)
+
+# Chat history per browser session (bounded in memory, logged to chat_logs/)
+chat_store = ChatStore()
+
+def get_chat_session_id():
+    """Get the chat session of the current request (X-Session-Id header or ?session=)"""
+    session_id = request.headers.get('X-Session-Id') or request.args.get('session') or DEFAULT_SESSION
+    return session_id[:64]
 
-# Store chat history
-chat_history = []
+# One long-lived chat client per session (see mcp_workers), started with the
+# session's logged history; the MCP server script path is set from the
+# command line at startup
+mcp_pool = MCPWorkerPool(history_provider=chat_store.context)
+
+def post_assistant_message(session_id, request_id, content):
+    """Add an assistant reply to a session's history and push it to its subscribers"""
+    assistant_message = {
+        'role': 'assistant',
+        'content': content,
+        'timestamp': time.time(),
+        'request_id': request_id
+    }
+    chat_store.append(session_id, assistant_message)
+    events.publish('chat.message', assistant_message, session_id)
+    return assistant_message
 
-# MCP client process
-mcp_process = None
+def run_edit_plan(session_id, request_id, plan):
+    """Media job running a command engine plan and replying with its outcome"""
+    try:
+        result = run_plan(plan)
+    except Exception as e:
+        reply = str(e) if isinstance(e, CommandError) else f"I couldn't finish that edit: {str(e)}"
+        post_assistant_message(session_id, request_id, reply)
+        raise
+    # The API path in backticks lets the frontend load the result into the preview
+    post_assistant_message(session_id, request_id,
+                           f"I've successfully {plan['summary']} and put the result into `{result['path']}`.")
+    return result
 
-# Path to the MCP server script
-mcp_server_path = None
+def reply_without_client(session_id, request_id, message, plan=None, reply=None):
+    """Answer a chat message without the chat client
+    
+    Records the user message, then either runs an edit plan on the media job
+    queue (its reply is posted by run_edit_plan) or posts a fixed reply.
+    
+    Returns:
+        Response: The user message with its reply, or with 'processing' if
+        the edit is still running after FAST_PATH_WAIT
+    """
+    user_message = {
+        'role': 'user',
+        'content': message,
+        'timestamp': time.time(),
+        'request_id': request_id
+    }
+    chat_store.append(session_id, user_message)
+    if plan:
+        job_id = submit_job('edit', run_edit_plan, session_id, request_id, plan)
+        wait_for_job(job_id, timeout=FAST_PATH_WAIT)
+    else:
+        post_assistant_message(session_id, request_id, reply)
+    
+    exchange = chat_store.get_request(session_id, request_id)
+    if exchange and 'assistant' in exchange:
+        return jsonify({'user': user_message, 'assistant': exchange['assistant']})
+    return jsonify({'user': user_message, 'status': 'processing'})
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def serve(path):
-    if path != "" and os.path.exists(app.static_folder + '/' + path):
-        return send_from_directory(app.static_folder, path)
-    else:
-        return send_from_directory(app.static_folder, 'index.html')
+    """Serve the frontend build, preferring pre-compressed variants"""
+    if path == "" or not os.path.isfile(os.path.join(app.static_folder, path)):
+        path = 'index.html'
+    
+    served_path, encoding = select_static_variant(
+        app.static_folder, path, request.headers.get('Accept-Encoding', ''))
+    # send_from_directory answers If-None-Match/If-Modified-Since with a 304
+    response = send_from_directory(app.static_folder, served_path,
+                                   mimetype=mimetypes.guess_type(path)[0])
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = static_cache_control(path)
+    return response
 
 @app.route('/api/media', methods=['GET'])
 def get_all_media_files():
@@ -107,6 +194,31 @@ def get_video(filename):
     """Serve a video file"""
     return send_from_directory(VIDEOS_FOLDER, filename)
 
+@app.route('/api/videos/<media_id>/master.m3u8', methods=['GET'])
+def get_video_hls_master(media_id):
+    """Serve the HLS master playlist of a video
+    
+    Videos that haven't been packaged yet are queued for packaging and a 202
+    with the job ID is returned; clients fall back to the progressive file.
+    """
+    entry = catalog.find_by_id(media_id, 'videos')
+    if entry is None:
+        return jsonify({'error': 'Video not found'}), 404
+    
+    package_folder = get_hls_folder(entry['filename'])
+    if not os.path.exists(os.path.join(package_folder, HLS_MASTER_PLAYLIST)):
+        job_id = schedule_hls_package(os.path.join(VIDEOS_FOLDER, entry['filename']))
+        return jsonify({'status': 'packaging', 'jobId': job_id}), 202
+    return send_from_directory(package_folder, HLS_MASTER_PLAYLIST)
+
+@app.route('/api/videos/<media_id>/<rendition>/<filename>', methods=['GET'])
+def get_video_hls_file(media_id, rendition, filename):
+    """Serve a rendition playlist or segment of a video's HLS package"""
+    entry = catalog.find_by_id(media_id, 'videos')
+    if entry is None:
+        return jsonify({'error': 'Video not found'}), 404
+    return send_from_directory(get_hls_folder(entry['filename']), f"{rendition}/{filename}")
+
 @app.route('/api/photos/<filename>', methods=['GET'])
 def get_photo(filename):
     """Serve a photo file"""
@@ -117,15 +229,84 @@ def get_audio(filename):
     """Serve an audio file"""
     return send_from_directory(AUDIO_FOLDER, filename)
 
+@app.route('/api/audio/<media_id>/peaks', methods=['GET'])
+def get_audio_peaks(media_id):
+    """Serve waveform peaks of an audio file or a video's soundtrack
+    
+    ?zoom=0 is the coarsest level, higher values are more detailed. Files
+    without peaks yet are queued and a 202 with the job ID is returned.
+    """
+    try:
+        zoom = int(request.args.get('zoom', 0))
+    except ValueError:
+        return jsonify({'error': 'Invalid zoom level'}), 400
+    if zoom < 0 or zoom >= len(PEAKS_LEVELS):
+        return jsonify({'error': f'Zoom must be between 0 and {len(PEAKS_LEVELS) - 1}'}), 400
+    
+    # IDs are only unique per type; an audio file wins over a video
+    entry = catalog.find_by_id(media_id, 'audio') or catalog.find_by_id(media_id, 'videos')
+    if entry is None:
+        return jsonify({'error': 'Media not found'}), 404
+    
+    peaks = load_peaks(entry['filename'], zoom)
+    if peaks is None:
+        folder = AUDIO_FOLDER if entry['type'] == 'audio' else VIDEOS_FOLDER
+        job_id = schedule_peaks(os.path.join(folder, entry['filename']))
+        if job_id is None:
+            return jsonify({'error': 'Waveform peaks are not available (numpy is not installed)'}), 503
+        return jsonify({'status': 'generating', 'jobId': job_id}), 202
+    
+    peaks['id'] = media_id
+    return jsonify(peaks)
+
+@app.route('/api/media/<media_id>/prepare', methods=['POST'])
+def prepare_media_files(media_id):
+    """Warm a selected file for editing before the user asks for anything
+    
+    Queues metadata, keyframe index, proxy and page cache warm-up for the
+    file and starts the chat session's worker if the pool has room. This is
+    only a hint: it returns a 202 right away and repeated calls are cheap.
+    """
+    # IDs are only unique per type; the editor selects videos
+    file_path = resolve_media_path(media_id, 'videos') or resolve_media_path(media_id)
+    if file_path is None:
+        return jsonify({'error': 'Media not found'}), 404
+    
+    job_id = schedule_prepare(file_path)
+    try:
+        worker_ready = mcp_pool.prepare(get_chat_session_id())
+    except Exception as e:
+        print(f"[DEBUG] Could not start a chat worker ahead of time: {e}")
+        worker_ready = False
+    return jsonify({'id': media_id, 'jobId': job_id, 'workerReady': worker_ready}), 202
+
 @app.route('/api/temp/<filename>', methods=['GET'])
 def get_temp_file(filename):
     """Serve a temporary file"""
     return send_from_directory(TEMP_FOLDER, filename)
 
+@app.route('/api/proxies/<filename>', methods=['GET'])
+def get_proxy(filename):
+    """Serve a video's editing proxy"""
+    return send_from_directory(PROXIES_FOLDER, filename)
+
 @app.route('/api/thumbnails/<filename>', methods=['GET'])
 def get_thumbnail(filename):
-    """Serve a thumbnail file"""
-    return send_from_directory(THUMBNAILS_FOLDER, filename)
+    """Serve a thumbnail file
+    
+    ?size=small|large selects a scaled derivative and ?format=webp|jpg its
+    encoding; without ?format the Accept header decides.
+    """
+    served_filename = resolve_thumbnail_filename(
+        filename,
+        size=request.args.get('size'),
+        fmt=request.args.get('format'),
+        accept=request.headers.get('Accept', '')
+    )
+    response = send_from_directory(THUMBNAILS_FOLDER, served_filename)
+    if request.args.get('size'):
+        response.headers['Vary'] = 'Accept'
+    return response
 
 @app.route('/api/upload', methods=['POST'])
 def upload_media():
@@ -161,6 +342,87 @@ def upload_media():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/upload/stream', methods=['PUT', 'POST'])
+def upload_media_stream():
+    """Upload a media file sent as the raw request body
+    
+    The filename comes from the X-Filename header (URL-encoded) or the
+    ?filename= query parameter. The body is written directly to its final
+    location instead of being spooled by the multipart parser first.
+    """
+    from urllib.parse import unquote
+    filename = unquote(request.headers.get('X-Filename', '')) or request.args.get('filename', '')
+    if not filename:
+        return jsonify({'error': 'No filename given'}), 400
+    
+    try:
+        media_info = save_media_stream(request.stream, filename)
+        print(f"File uploaded successfully: {media_info}")
+        return jsonify(media_info)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error saving streamed upload: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+# Resumable chunked uploads:
+#   POST   /api/uploads        {filename, size} -> new session
+#   GET    /api/uploads/<id>   offset and received ranges, for resuming
+#   PATCH  /api/uploads/<id>   raw chunk body at the Upload-Offset header
+#   DELETE /api/uploads/<id>   abort
+# The session finalizes into the media library once every byte arrived.
+@app.route('/api/uploads', methods=['POST'])
+def create_upload_session():
+    """Start a resumable upload session"""
+    data = request.json or {}
+    try:
+        session = create_session(data.get('filename'), data.get('size'))
+        return jsonify(session), 201
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status_code
+
+@app.route('/api/uploads/<upload_id>', methods=['GET', 'HEAD'])
+def get_upload_session(upload_id):
+    """Get the resume offset of an upload session"""
+    try:
+        session = get_session(upload_id)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status_code
+    response = jsonify(session)
+    response.headers['Upload-Offset'] = str(session['offset'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/api/uploads/<upload_id>', methods=['PATCH'])
+def append_upload_chunk(upload_id):
+    """Write one chunk of a resumable upload"""
+    offset = request.headers.get('Upload-Offset', request.args.get('offset'))
+    try:
+        session = write_chunk(upload_id, offset, request.stream, request.content_length)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status_code
+    except Exception as e:
+        print(f"Error writing upload chunk: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+    response = jsonify(session)
+    response.headers['Upload-Offset'] = str(session['offset'])
+    return response
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def delete_upload_session(upload_id):
+    """Abort a resumable upload"""
+    try:
+        found = abort_session(upload_id)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status_code
+    if found:
+        return jsonify({'success': True})
+    return jsonify({'error': 'Upload session not found'}), 404
+
 @app.route('/api/upload/temp', methods=['POST'])
 def upload_temp_media():
     """Upload a temporary media file"""
@@ -195,74 +457,36 @@ def clean_all_temp_media():
 
 @app.route('/api/chat', methods=['GET'])
 def get_chat_history():
-    return jsonify(chat_history)
-
-# Helper function to convert API URLs to file system paths
-def convert_api_url_to_path(url):
-    """Convert an API URL like /api/videos/filename to a file system path"""
-    if not url or not isinstance(url, str):
-        return url
-        
-    # Handle video paths
-    if '/api/videos/' in url:
-        filename = url.split('/api/videos/')[-1]
-        return os.path.join(VIDEOS_FOLDER, filename)
-        
-    # Handle photo paths
-    if '/api/photos/' in url:
-        filename = url.split('/api/photos/')[-1]
-        return os.path.join(PHOTOS_FOLDER, filename)
-        
-    # Handle audio paths
-    if '/api/audio/' in url:
-        filename = url.split('/api/audio/')[-1]
-        return os.path.join(AUDIO_FOLDER, filename)
-        
-    # Handle temp paths
-    if '/api/temp/' in url:
-        filename = url.split('/api/temp/')[-1]
-        return os.path.join(TEMP_FOLDER, filename)
-        
-    return url
+    return jsonify(chat_store.history(get_chat_session_id()))
 
 @app.route('/api/chat', methods=['POST'])
 def send_message():
-    global mcp_process
-    
     data = request.json
+    session_id = get_chat_session_id()
     message = data.get('message', '')
     video_context = data.get('videoContext', None)
     audio_context = data.get('audioContext', None)
     print(f"\n[DEBUG] Received message: '{message}'")
     
-    # If we have video context, make sure to convert API paths to file system paths
+    # Resolve the selected media by ID through the catalog. The paths go to
+    # the client as structured context rather than being pasted into the
+    # prompt text and scraped back out with regexes.
+    video_path = resolve_media_context(video_context, 'videos')
+    audio_path = resolve_media_context(audio_context, 'audio')
+    media_context = {}
     if video_context:
-        print(f"[DEBUG] With video context: {video_context}")
-        
-        # Convert the URL path to a file system path
-        if 'path' in video_context and video_context['path']:
-            original_path = video_context['path']
-            file_system_path = convert_api_url_to_path(original_path)
-            
-            if file_system_path and file_system_path != original_path:
-                # Append the file path to the message
-                print(f"[DEBUG] Appended file system path to message: '{message} {file_system_path}'")
-                message = f"{message} {file_system_path}"
-            
-    # If we have audio context, make sure to convert API paths to file system paths
+        print(f"[DEBUG] With video context: {video_context} -> {video_path}")
+        media_context['video_id'] = video_context.get('id')
+        media_context['video_path'] = video_path
     if audio_context:
-        print(f"[DEBUG] With audio context: {audio_context}")
-        
-        # Convert the URL path to a file system path
-        if 'path' in audio_context and audio_context['path']:
-            original_audio_path = audio_context['path']
-            audio_file_system_path = convert_api_url_to_path(original_audio_path)
-            
-            if audio_file_system_path and audio_file_system_path != original_audio_path:
-                # Append the audio file path to the message
-                print(f"[DEBUG] Appended audio file system path to message: '{message} {audio_file_system_path}'")
-                message = f"{message} {audio_file_system_path}"
-            # No need for an elif clause here since we already append the path above
+        print(f"[DEBUG] With audio context: {audio_context} -> {audio_path}")
+        media_context['audio_id'] = audio_context.get('id')
+        media_context['audio_path'] = audio_path
+    
+    # Output a preprocessing rewrite asked the client to write, as (path,
+    # original filename, timestamp); registered once the client is done.
+    # An audio merge's path is also reported back if the reply is empty
+    rewrite_output = None
     
     if not message:
         return jsonify({'error': 'Empty message'}), 400
@@ -270,6 +494,17 @@ def send_message():
     # Generate a unique request ID for this message
     request_id = str(int(time.time() * 1000)) + '-' + str(hash(message) % 10000)
     
+    # Common edits the command engine can read unambiguously run straight on
+    # the media job queue, without a chat client or Gemini round trip
+    try:
+        plan, refusal = plan_command(message, video_path, audio_path), None
+    except CommandError as e:
+        plan, refusal = None, str(e)
+    if plan or refusal:
+        if plan:
+            print(f"[DEBUG] Fast path {plan['command']} (confidence {plan['confidence']}), skipping the chat client")
+        return reply_without_client(session_id, request_id, message, plan=plan, reply=refusal)
+    
     # Pre-process message to handle special cases like audio merging or format conversion
     print(f"[DEBUG] Starting message pre-processing for: '{message}'")
     
@@ -278,16 +513,15 @@ def send_message():
     has_audio_replacement = any(cmd in message.lower() for cmd in audio_cmd_patterns)
     print(f"[DEBUG] Has audio replacement command: {has_audio_replacement}")
     
-    # Handle audio replacement first, before any other processing
+    # Handle audio replacement first, before any other processing. The edit
+    # runs like a command engine plan, so its output is registered and the
+    # reply is pushed like any other
     if has_audio_replacement:
         print(f"[DEBUG] Pre-processing audio replacement command: {message}")
         import re
         
-        # Extract video path from message (it should already have been appended by the context processing)
-        video_paths = re.findall(r'[A-Za-z]:\\[^\s]+\.(?:mp4|mov|avi|mkv|webm)', message)
-        if video_paths:
-            video_path = video_paths[0]  # Use the first video path found
-            print(f"[DEBUG] Found video path in message: {video_path}")
+        if video_path:
+            print(f"[DEBUG] Using video from context: {video_path}")
             
             # Extract audio file name from message
             audio_file_match = re.search(r'with\s+([\w.-]+\.(?:mp3|wav|ogg|aac|m4a))', message.lower())
@@ -295,223 +529,62 @@ def send_message():
                 audio_filename = audio_file_match.group(1)
                 print(f"[DEBUG] Extracted audio filename from message: {audio_filename}")
                 
-                # Try to find the audio file in various locations
-                audio_paths = []
-                # Define search paths with absolute path variations
-                search_dirs = [
-                    os.path.join('backend', 'uploads', 'audio'),
-                    os.path.join('uploads', 'audio'),
-                    os.path.join('backend', 'uploads', 'videos'),
-                    os.path.join('uploads', 'videos'),
-                    os.path.join('backend', 'uploads'),
-                    'uploads',
-                    '.'
-                ]
-                
-                for search_dir in search_dirs:
-                    print(f"[DEBUG] Searching directory: {search_dir}")
-                    if os.path.exists(search_dir):
-                        for file in os.listdir(search_dir):
-                            print(f"[DEBUG] Checking file: {file}")
-                            # Get base name without extension
-                            audio_name, audio_ext = os.path.splitext(audio_filename.lower())
-                            file_lower = file.lower()
-                            
-                            # Check for exact match
-                            if audio_filename.lower() == file_lower:
-                                audio_paths.append(os.path.join(search_dir, file))
-                                print(f"[DEBUG] Found exact match: {os.path.join(search_dir, file)}")
-                            # Check for filename in any part of the filename (for timestamp prefixes)
-                            elif audio_filename.lower() in file_lower:
-                                audio_paths.append(os.path.join(search_dir, file))
-                                print(f"[DEBUG] Found audio filename in: {os.path.join(search_dir, file)}")
-                            # Check for timestamp-filename.ext pattern (e.g., 1234567890-audio.mp3)
-                            elif '-' in file_lower and audio_filename.lower() in file_lower.split('-', 1)[1]:
-                                audio_paths.append(os.path.join(search_dir, file))
-                                print(f"[DEBUG] Found match with timestamp prefix: {os.path.join(search_dir, file)}")
-                            # Check if the base name (without extension) is in the filename
-                            elif audio_name in file_lower and file_lower.endswith(audio_ext):
-                                audio_paths.append(os.path.join(search_dir, file))
-                                print(f"[DEBUG] Found match with base name: {os.path.join(search_dir, file)}")
-                
-                # Check uploaded audio files in the 'uploads/audio' directory specifically
-                if not audio_paths and os.path.exists('uploads/audio'):
-                    print(f"[DEBUG] No audio found yet, trying direct file listing of uploads/audio")
-                    try:
-                        # Get all audio files in the directory
-                        all_audio_files = [f for f in os.listdir('uploads/audio') 
-                                         if f.lower().endswith(('.mp3', '.wav', '.ogg', '.aac', '.m4a'))]
-                        
-                        # Sort by modification time (newest first)
-                        all_audio_files.sort(key=lambda x: os.path.getmtime(os.path.join('uploads/audio', x)) 
-                                              if os.path.exists(os.path.join('uploads/audio', x)) else 0, 
-                                              reverse=True)
-                        
-                        # Add the most recent audio file if we found any
-                        if all_audio_files:
-                            most_recent = os.path.join('uploads/audio', all_audio_files[0])
-                            audio_paths.append(most_recent)
-                            print(f"[DEBUG] Found most recently uploaded audio file: {most_recent}")
-                    except Exception as e:
-                        print(f"[DEBUG] Error checking recently uploaded audio: {e}")
-                
-                # Sort found files by modification time (newest first)
-                audio_paths.sort(key=lambda x: os.path.getmtime(x) if os.path.exists(x) else 0, reverse=True)
-                
-                if audio_paths:
-                    # Use the most recent matching file
-                    audio_path = audio_paths[0]
-                    print(f"[DEBUG] Using audio file: {audio_path}")
-                    
-                    # Get path information for the video
-                    video_dir = os.path.dirname(video_path)
-                    video_name = os.path.basename(video_path)
-                    video_name_no_ext, video_ext = os.path.splitext(video_name)
-                    
-                    # Generate output path with timestamp
-                    timestamp = int(time.time() * 1000)
-                    output_filename = f"{timestamp}-{video_name_no_ext}_with_audio{video_ext}"
-                    output_path = os.path.join(video_dir, output_filename)
-                    
-                    try:
-                        # Directly execute ffmpeg command
-                        ffmpeg_cmd = f"ffmpeg -i \"{video_path}\" -i \"{audio_path}\" -c:v copy -map 0:v:0 -map 1:a:0 -shortest \"{output_path}\""
-                        print(f"[DEBUG] Executing ffmpeg command: {ffmpeg_cmd}")
-                        
-                        result = subprocess.run(
-                            ffmpeg_cmd, 
-                            shell=True, 
-                            stdout=subprocess.PIPE, 
-                            stderr=subprocess.PIPE,
-                            text=True
-                        )
-                        
-                        if result.returncode == 0:
-                            success_msg = f"I've successfully replaced the audio in your video using {os.path.basename(audio_path)}."
-                            print(f"[DEBUG] Audio replacement successful: {output_path}")
-                            return jsonify({'assistant': {
-                                'role': 'assistant',
-                                'content': success_msg,
-                                'request_id': request_id,
-                                'timestamp': int(time.time() * 1000)
-                            }})
-                        else:
-                            error_msg = f"Error replacing audio: {result.stderr}"
-                            print(f"[DEBUG] ffmpeg error: {error_msg}")
-                            return jsonify({'assistant': {
-                                'role': 'assistant',
-                                'content': "I couldn't replace the audio in your video. There was a processing error.",
-                                'request_id': request_id,
-                                'timestamp': int(time.time() * 1000)
-                            }})
-                    except Exception as e:
-                        print(f"[DEBUG] Error executing ffmpeg: {str(e)}")
-                        return jsonify({'assistant': {
-                            'role': 'assistant',
-                            'content': f"I encountered an error while trying to replace the audio: {str(e)}",
-                            'request_id': request_id,
-                            'timestamp': int(time.time() * 1000)
-                        }})
+                # Unless the frontend already identified the file by ID, resolve
+                # the name through the catalog's filename index (original name,
+                # timestamp-stripped name, stem) instead of scanning the folders
+                audio_entry = None if audio_path else catalog.find_by_name(audio_filename, media_type='audio')
+                substitute = False
+                if audio_path:
+                    print(f"[DEBUG] Using audio file from context: {audio_path}")
+                elif audio_entry:
+                    audio_path = os.path.join(AUDIO_FOLDER, audio_entry['filename'])
+                    print(f"[DEBUG] Found audio file in catalog: {audio_path}")
                 else:
                     print(f"[DEBUG] Could not find specific audio file: {audio_filename}, looking for any audio file")
                     
-                    # Try to find ANY recently uploaded audio file
-                    audio_dirs = ['uploads/audio', 'uploads']
-                    for audio_dir in audio_dirs:
-                        if os.path.exists(audio_dir):
-                            audio_files = [f for f in os.listdir(audio_dir) 
-                                        if f.lower().endswith(('.mp3', '.wav', '.ogg', '.aac', '.m4a'))]
-                            if audio_files:
-                                # Sort by creation time (newest first)
-                                audio_files.sort(key=lambda x: os.path.getctime(os.path.join(audio_dir, x)), reverse=True)
-                                audio_path = os.path.join(audio_dir, audio_files[0])
-                                print(f"[DEBUG] Found recent audio file to use instead: {audio_path}")
-                                
-                                # Get path information for the video
-                                video_dir = os.path.dirname(video_path)
-                                video_name = os.path.basename(video_path)
-                                video_name_no_ext, video_ext = os.path.splitext(video_name)
-                                
-                                # Generate output path with timestamp
-                                timestamp = int(time.time() * 1000)
-                                output_filename = f"{timestamp}-{video_name_no_ext}_with_audio{video_ext}"
-                                output_path = os.path.join(video_dir, output_filename)
-                                
-                                try:
-                                    # Directly execute ffmpeg command
-                                    ffmpeg_cmd = f"ffmpeg -i \"{video_path}\" -i \"{audio_path}\" -c:v copy -map 0:v:0 -map 1:a:0 -shortest \"{output_path}\""
-                                    print(f"[DEBUG] Executing ffmpeg command: {ffmpeg_cmd}")
-                                    
-                                    result = subprocess.run(
-                                        ffmpeg_cmd, 
-                                        shell=True, 
-                                        stdout=subprocess.PIPE, 
-                                        stderr=subprocess.PIPE,
-                                        text=True
-                                    )
-                                    
-                                    if result.returncode == 0:
-                                        success_msg = f"I've successfully replaced the audio in your video using {os.path.basename(audio_path)} since I couldn't find {audio_filename}."
-                                        print(f"[DEBUG] Audio replacement successful: {output_path}")
-                                        return jsonify({'assistant': {
-                                            'role': 'assistant',
-                                            'content': success_msg,
-                                            'request_id': request_id,
-                                            'timestamp': int(time.time() * 1000)
-                                        }})
-                                    else:
-                                        error_msg = f"Error replacing audio: {result.stderr}"
-                                        print(f"[DEBUG] ffmpeg error: {error_msg}")
-                                except Exception as e:
-                                    print(f"[DEBUG] Error executing ffmpeg: {str(e)}")
-                    
-                    # If we get here, we couldn't find any audio file
-                    print(f"[DEBUG] Could not find any audio file to use")
-                    return jsonify({'assistant': {
-                        'role': 'assistant',
-                        'content': f"I couldn't find the audio file '{audio_filename}' or any other audio file. Please upload an audio file first.",
-                        'request_id': request_id,
-                        'timestamp': int(time.time() * 1000)
-                    }})
+                    # Fall back to the most recently uploaded audio file
+                    latest_audio = catalog.latest('audio')
+                    if latest_audio:
+                        audio_path = os.path.join(AUDIO_FOLDER, latest_audio['filename'])
+                        substitute = True
+                        print(f"[DEBUG] Found recent audio file to use instead: {audio_path}")
+                
+                if audio_path:
+                    print(f"[DEBUG] Using audio file: {audio_path}")
+                    plan = replace_audio_plan(video_path, audio_path)
+                    plan['command'] = 'replace_audio'
+                    if substitute:
+                        plan['summary'] += f" since I couldn't find {audio_filename}"
+                    return reply_without_client(session_id, request_id, message, plan=plan)
+                
+                # If we get here, we couldn't find any audio file
+                print(f"[DEBUG] Could not find any audio file to use")
+                reply = f"I couldn't find the audio file '{audio_filename}' or any other audio file. Please upload an audio file first."
             else:
                 print(f"[DEBUG] Could not extract audio filename from message")
-                return jsonify({'assistant': {
-                    'role': 'assistant',
-                    'content': "I need an audio file to replace the current audio track. Please specify a file like 'Replace the audio with music.mp3'.",
-                    'request_id': request_id,
-                    'timestamp': int(time.time() * 1000)
-                }})
+                reply = "I need an audio file to replace the current audio track. Please specify a file like 'Replace the audio with music.mp3'."
         else:
             print(f"[DEBUG] No video path found in message")
             # We need to notify the user that we need a video first
-            message = "I'll replace the audio in the currently displayed video. Please make sure you have a video loaded in the preview first."
-            print(f"[DEBUG] Set message to: {message}")
-            return jsonify({'assistant': {
-                'role': 'assistant',
-                'content': message,
-                'request_id': request_id,
-                'timestamp': int(time.time() * 1000)
-            }})
+            reply = "I'll replace the audio in the currently displayed video. Please make sure you have a video loaded in the preview first."
+        return reply_without_client(session_id, request_id, message, reply=reply)
     
     # Process video trimming requests to ensure they work correctly
     elif ('trim' in message.lower() and any(x in message.lower() for x in ['sec', 'second', 'minute', 'min'])):
         print(f"[DEBUG] Pre-processing video trim command: {message}")
         import re
         
-        # Extract video path
-        video_paths = re.findall(r'[A-Za-z]:\\[^\s]+\.(?:mp4|mov|avi|mkv|webm)', message)
-        if video_paths:
-            video_path = video_paths[0]  # Use the first video path
+        if video_path:
             
             # Get path information
-            dir_name = os.path.dirname(video_path)
             base_name = os.path.basename(video_path)
             name, ext = os.path.splitext(base_name)
+            name = re.sub(r'^\d+-', '', name)
             
             # Generate the output filename with _trimmed suffix
             timestamp = int(time.time() * 1000)
             new_output_filename = f"{timestamp}-{name}_trimmed{ext}"
-            new_output_path = os.path.join(dir_name, new_output_filename)
+            new_output_path = os.path.join(VIDEOS_FOLDER, new_output_filename)
             
             # Extract time values using regex
             start_time = "0"  # Default start time
@@ -534,12 +607,32 @@ def send_message():
                 duration = trim_n_sec.group(1)
                 print(f"[DEBUG] Detected trim {duration} seconds")
             
+            # Check the requested range against the probed duration
+            video_duration = get_media_duration(video_path)
+            if video_duration and (end_time or duration):
+                if float(start_time) >= video_duration:
+                    print(f"[DEBUG] Trim start {start_time}s is beyond video duration {video_duration}s")
+                    return jsonify({'assistant': {
+                        'role': 'assistant',
+                        'content': f"The video is only {video_duration:.1f} seconds long, so I can't start a trim at {start_time} seconds.",
+                        'request_id': request_id,
+                        'timestamp': int(time.time() * 1000)
+                    }})
+                if end_time and float(end_time) > video_duration:
+                    end_time = f"{video_duration:g}"
+                    print(f"[DEBUG] Clamped trim end to video duration: {end_time}")
+                elif duration and float(start_time) + float(duration) > video_duration:
+                    duration = f"{video_duration - float(start_time):g}"
+                    print(f"[DEBUG] Clamped trim duration to video length: {duration}")
+            
             # Rewrite the command to explicitly use re-encoding instead of stream copying
             # This ensures frame-accurate trimming at the expense of some quality loss
             if end_time:
                 message = f"trim video with re-encoding {video_path} {new_output_path} {start_time} {end_time}"
+                rewrite_output = (new_output_path, f"{name}_trimmed{ext}", timestamp)
             elif duration:
                 message = f"trim video with re-encoding {video_path} {new_output_path} {start_time} {duration}"
+                rewrite_output = (new_output_path, f"{name}_trimmed{ext}", timestamp)
             else:
                 # Fallback to original message if we couldn't parse the times
                 pass
@@ -703,10 +796,7 @@ def send_message():
         print(f"[DEBUG] Pre-processing Instagram format conversion command: {message}")
         import re
         
-        # Extract video path
-        video_paths = re.findall(r'[A-Za-z]:\\[^\s]+\.(?:mp4|mov|avi|mkv|webm)', message)
-        if video_paths:
-            video_path = video_paths[0]  # Use the first video path
+        if video_path:
             
             # Determine which Instagram format to use
             aspect_ratio = "9:16"  # Default to vertical/portrait (stories/reels format)
@@ -716,19 +806,21 @@ def send_message():
                 aspect_ratio = "1:1"  # Square format
             
             # Get path information
-            dir_name = os.path.dirname(video_path)
             base_name = os.path.basename(video_path)
             name, ext = os.path.splitext(base_name)
+            name = re.sub(r'^\d+-', '', name)
             
             # Generate the output filename with _instagram suffix
-            new_output_filename = f"{name}_instagram{ext}"
-            new_output_path = os.path.join(dir_name, new_output_filename)
+            timestamp = int(time.time() * 1000)
+            new_output_filename = f"{timestamp}-{name}_instagram{ext}"
+            new_output_path = os.path.join(VIDEOS_FOLDER, new_output_filename)
             
             print(f"[DEBUG] Using aspect ratio {aspect_ratio} for Instagram format conversion")
             print(f"[DEBUG] Using output path: {new_output_path}")
             
             # Rewrite the command to explicitly set the aspect ratio
             message = f"convert video to {aspect_ratio} aspect ratio {video_path} {new_output_path}"
+            rewrite_output = (new_output_path, f"{name}_instagram{ext}", timestamp)
             print(f"[DEBUG] Rewritten Instagram format command: {message}")
     
     # Check if this is a merge_audio_video command that might use the same input and output
@@ -737,18 +829,9 @@ def send_message():
         
         # Extract any file paths in the message
         import re
-        # Match video files
-        video_paths = re.findall(r'[A-Za-z]:\\[^\s]+\.(?:mp4|mov|avi|mkv|webm)', message)
-        # Match audio files
-        audio_paths = re.findall(r'[A-Za-z]:\\[^\s]+\.(?:mp3|wav|aac|ogg)', message)
-        
         # If we have both video and audio paths
-        if video_paths and audio_paths:
-            video_path = video_paths[0]  # Use the first video path
-            audio_path = audio_paths[0]  # Use the first audio path
-            
+        if video_path and audio_path:
             # Always generate a new unique output path for audio merged videos
-            dir_name = os.path.dirname(video_path)
             base_name = os.path.basename(video_path)
             name, ext = os.path.splitext(base_name)
             
@@ -766,7 +849,8 @@ def send_message():
             # Generate new timestamped filename with _with_audio suffix
             timestamp = int(time.time() * 1000)
             new_output_filename = f"{timestamp}-{clean_name}_with_audio{ext}"
-            new_output_path = os.path.join(dir_name, new_output_filename)
+            new_output_path = os.path.join(VIDEOS_FOLDER, new_output_filename)
+            rewrite_output = (new_output_path, f"{clean_name}_with_audio{ext}", timestamp)
             
             print(f"[DEBUG] Using new output path for audio merging: {new_output_path}")
             
@@ -785,88 +869,22 @@ def send_message():
         'timestamp': time.time(),
         'request_id': request_id
     }
-    chat_history.append(user_message)
-    
-    # If MCP process is not running, start it
-    if mcp_process is None or mcp_process.poll() is not None:
-        print("[DEBUG] Starting MCP client")
-        start_mcp_client()
+    chat_store.append(session_id, user_message)
     
+    worker = None
     try:
-        # Direct approach - run the client as a one-off process for each message
+        # Each session has its own long-lived client with its own Gemini chat
+        # and working directory, so sessions run in parallel without sharing
+        # output files
         print(f"[DEBUG] Running MCP client for message: '{message}'")
+        response = ""
+        response_lines = []
+        all_output = []
+        in_response_block = False
         try:
-            # Run client.py directly with the message as input
-            client_process = subprocess.Popen(
-                [sys.executable, "../client.py", mcp_server_path, "--stdio"],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                cwd=os.path.dirname(os.path.abspath(__file__))
-            )
-            
-            # Send message to stdin
-            client_process.stdin.write(f"{message}\n")
-            client_process.stdin.flush()
-            
-            # Read response with timeout - Windows-compatible approach
-            all_output = []
-            response_lines = []
-            in_response_block = False
-            response = ""
-            start_time = time.time()
-            timeout = 60  # seconds, increased for longer outputs
-            
+            worker = mcp_pool.acquire(session_id)
             print("[DEBUG] Waiting for response...")
-            
-            # Set stdout to non-blocking mode
-            msvcrt.setmode(client_process.stdout.fileno(), os.O_BINARY)
-            
-            # Read all output from the process until we see the complete response
-            while time.time() - start_time < timeout:
-                # Check if process has exited
-                if client_process.poll() is not None and len(all_output) > 0:
-                    print(f"[DEBUG] Process exited with code {client_process.returncode}")
-                    stderr = client_process.stderr.read()
-                    if stderr:
-                        print(f"[DEBUG] Process stderr: {stderr}")
-                    break
-                
-                # Read a line from stdout
-                try:
-                    line = client_process.stdout.readline().strip()
-                    if line:
-                        print(f"[DEBUG] Got line: '{line}'")
-                    
-                        # Check for response markers
-                        if line == "Response: RESPONSE_START":
-                            print("[DEBUG] Found response start marker")
-                            in_response_block = True
-                            continue
-                        elif line == "RESPONSE_END":
-                            print("[DEBUG] Found response end marker")
-                            in_response_block = False
-                            break
-                        
-                        # If we're in a response block, add this line to our response
-                        if in_response_block:
-                            print(f"[DEBUG] Added to response: '{line}'")
-                            response_lines.append(line)
-                        else:
-                            # Skip debug messages from the MCP client
-                            print(f"[DEBUG] Skipping debug message: '{line}'")
-                            # Add to general output for fallback
-                            all_output.append(line)
-                    else:
-                        # No data, check if process is done
-                        if client_process.poll() is not None:
-                            break
-                except Exception as e:
-                    print(f"[DEBUG] Error reading from stdout: {e}")
-                
-                # Sleep a bit to avoid busy waiting
-                time.sleep(0.1)
+            response_lines, all_output, in_response_block = worker.ask(message, media_context)
             
             # Construct the response from the collected lines
             if response_lines:
@@ -879,10 +897,9 @@ def send_message():
                 
                 # Check if this was an audio merge operation and add file path to response
                 if "add audio" in message.lower():
-                    # Extract output path from message for audio merge operations
-                    output_match = re.search(r'([A-Za-z]:\\[^\s]+_with_audio\.(?:mp4|mov|avi|mkv|webm))', message)
-                    if output_match:
-                        output_path = output_match.group(1)
+                    # Report the output path chosen during preprocessing
+                    if rewrite_output:
+                        output_path = rewrite_output[0]
                         # Return a modified response with file path for frontend detection (will be cleaned later)
                         response = f"The audio file has been successfully merged with the video. The output is in `{output_path}`."
                         print(f"[DEBUG] Added output path to empty audio merge response: {output_path}")
@@ -965,25 +982,26 @@ def send_message():
             if response.startswith("\n"):
                 response = response[1:]
             
-            
-            # Clean up
-            if client_process.poll() is None:
-                client_process.terminate()
-                
-            # Check stderr for any errors
-            stderr = client_process.stderr.read()
-            if stderr:
-                print(f"[DEBUG] Process stderr: {stderr}")
-                
+        except WorkerBusyError as e:
+            print(f"[DEBUG] {e}")
+            response = "The server is busy with other chats right now. Please try again in a moment."
         except Exception as e:
             print(f"[DEBUG] Error running client: {e}")
+        
+        # Catalog the output a preprocessing rewrite asked for, so it shows
+        # up like any other new video
+        if rewrite_output and os.path.exists(rewrite_output[0]):
+            try:
+                register_media_file(*rewrite_output)
+            except Exception as e:
+                print(f"[DEBUG] Error registering output file {rewrite_output[0]}: {e}")
             
         # Add the response to chat history if we got one
         if response:
-            # Check for output.mp4 in the backend directory
-            output_mp4_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output.mp4')
-            if os.path.exists(output_mp4_path):
-                print(f"[DEBUG] Found output.mp4 in backend directory, moving to videos folder")
+            # Check for output.mp4 in the session's working directory
+            output_mp4_path = os.path.join(worker.cwd, 'output.mp4') if worker else None
+            if output_mp4_path and os.path.exists(output_mp4_path):
+                print(f"[DEBUG] Found output.mp4 in session directory, moving to videos folder")
                 new_path = handle_output_file(output_mp4_path)
                 
                 if new_path:
@@ -994,34 +1012,23 @@ def send_message():
                         response = response.replace('output.mp4', os.path.basename(new_path))
                         print(f"[DEBUG] Updated response with new path (will be cleaned up): {response}")
             
-            # Create the assistant message
-            assistant_message = {
-                'role': 'assistant',
-                'content': response,
-                'timestamp': time.time(),
-                'request_id': request_id  # Pass the request ID to link question and answer
-            }
-            chat_history.append(assistant_message)
+            post_assistant_message(session_id, request_id, response)
         else:
             print("[DEBUG] No response received")
             # Add a default response if we didn't get one
-            assistant_message = {
-                'role': 'assistant',
-                'content': "I'm sorry, I couldn't process your request. Please try again.",
-                'timestamp': time.time(),
-                'request_id': request_id  # Include request ID even for error responses
-            }
-            chat_history.append(assistant_message)
+            post_assistant_message(session_id, request_id,
+                                   "I'm sorry, I couldn't process your request. Please try again.")
         
         # Wait a short time for the response to be processed
         # This ensures we have the assistant's response before returning
         time.sleep(0.5)
         
-        # Return both the user message and the latest assistant message
-        if len(chat_history) >= 2 and chat_history[-1]['role'] == 'assistant':
+        # Return both the user message and its assistant message
+        exchange = chat_store.get_request(session_id, request_id)
+        if exchange and 'assistant' in exchange:
             return jsonify({
                 'user': user_message,
-                'assistant': chat_history[-1]
+                'assistant': exchange['assistant']
             })
         else:
             return jsonify({
@@ -1029,64 +1036,38 @@ def send_message():
                 'status': 'processing'
             })
     except Exception as e:
-        # Print any stderr output from the MCP client for debugging
-        if mcp_process and mcp_process.stderr:
-            try:
-                err_output = mcp_process.stderr.read()
-                if err_output:
-                    print("[MCP client stderr]:", err_output)
-            except Exception as serr:
-                print(f"[MCP client stderr read error]: {serr}")
+        # The worker's stderr is already echoed to the log by its reader thread
         return jsonify({'error': f'Error processing message: {str(e)}'}), 500
+    finally:
+        if worker is not None:
+            mcp_pool.release(worker)
 
 @app.route('/api/chat/response', methods=['GET'])
 def get_latest_response():
-    # Get the last assistant message from chat history
-    assistant_messages = [msg for msg in chat_history if msg['role'] == 'assistant']
+    """Get the session's latest assistant message, or the one for ?request_id="""
+    session_id = get_chat_session_id()
+    request_id = request.args.get('request_id')
+    if request_id:
+        exchange = chat_store.get_request(session_id, request_id)
+        last_message = exchange.get('assistant') if exchange else None
+    else:
+        last_message = chat_store.latest_assistant(session_id)
     
-    if assistant_messages:
-        last_message = assistant_messages[-1]
+    if last_message:
         return jsonify(last_message)
     else:
         return jsonify({'status': 'waiting'})
 
-def start_mcp_client():
-    """Start the MCP client as a subprocess"""
-    global mcp_process, mcp_server_path
-    
-    if mcp_server_path is None:
-        print("Error: MCP server path not set")
-        return
-    
-    try:
-        # Close any existing process
-        if mcp_process and mcp_process.poll() is None:
-            mcp_process.terminate()
-            mcp_process.wait(timeout=5)
-        
-        # Start a new MCP client process
-        mcp_process = subprocess.Popen(
-            [sys.executable, "-m", "uv", "run", "../client.py", mcp_server_path, "--stdio"],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1,  # Line buffered
-            cwd=os.path.dirname(os.path.abspath(__file__))
-        )
-        
-        print(f"Started MCP client with server: {mcp_server_path}")
-    except Exception as e:
-        print(f"Failed to start MCP client: {e}")
-
-# Wrap the Flask app with ASGI middleware
-asgi_app = WSGIMiddleware(app)
+# Wrap the Flask app with ASGI middleware; media file GETs are answered by
+# MediaFileApp directly (Range support, zero-copy send) and never reach Flask,
+# and EventSocketApp pushes chat/job/media events over /api/events
+asgi_app = EventSocketApp(MediaFileApp(WSGIMiddleware(app)))
 
 if __name__ == "__main__":
     # Get the MCP server path from command line arguments
     if len(sys.argv) > 1:
-        mcp_server_path = sys.argv[1]
-        print(f"Using MCP server: {mcp_server_path}")
+        mcp_pool.configure(sys.argv[1])
+        print(f"Using MCP server: {mcp_pool.server_path}")
     else:
         print("Warning: No MCP server script path provided. Chat functionality will not work.")
     
@@ -0,0 +1,108 @@
+import gzip
+import os
+import shutil
+from email.utils import parsedate_to_datetime
+
+try:
+    import brotli
+except ImportError:  # Brotli variants are optional; gzip is always available
+    brotli = None
+
+# Build output worth compressing ahead of time
+COMPRESSIBLE_EXTENSIONS = ['.js', '.css', '.html', '.json', '.map', '.svg', '.txt', '.ico']
+
+# Files this small gain nothing from compression
+MIN_COMPRESS_SIZE = 1024
+
+# Pre-built variants by Content-Encoding, in order of preference
+ENCODING_SUFFIXES = [('br', '.br'), ('gzip', '.gz')]
+
+# create-react-app puts content-hashed bundles under static/; their names
+# change whenever their contents do, so browsers may keep them forever.
+# Everything else (index.html, manifest.json, ...) must be revalidated.
+HASHED_ASSET_PREFIX = 'static/'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+def precompress_build(directory):
+    """Write .gz (and, with the brotli module, .br) variants of build files
+
+    Variants are only (re)written when missing or older than their source,
+    so this is cheap to run on every start.
+
+    Args:
+        directory (str): Frontend build directory
+
+    Returns:
+        int: Number of variants written
+    """
+    count = 0
+    if not os.path.isdir(directory):
+        return count
+
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if os.path.splitext(filename)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            source_path = os.path.join(root, filename)
+            stats = os.stat(source_path)
+            if stats.st_size < MIN_COMPRESS_SIZE:
+                continue
+
+            for encoding, suffix in ENCODING_SUFFIXES:
+                if encoding == 'br' and brotli is None:
+                    continue
+                variant_path = source_path + suffix
+                if os.path.exists(variant_path) and os.path.getmtime(variant_path) >= stats.st_mtime:
+                    continue
+                try:
+                    temp_path = variant_path + '.tmp'
+                    if encoding == 'br':
+                        with open(source_path, 'rb') as src, open(temp_path, 'wb') as dst:
+                            dst.write(brotli.compress(src.read(), quality=11))
+                    else:
+                        with open(source_path, 'rb') as src, gzip.open(temp_path, 'wb', compresslevel=9) as dst:
+                            shutil.copyfileobj(src, dst)
+                    os.replace(temp_path, variant_path)
+                    count += 1
+                except Exception as e:
+                    print(f"Error compressing {source_path}: {e}")
+    return count
+
+def select_static_variant(directory, path, accept_encoding=''):
+    """Pick the best pre-built variant of a build file for a request
+
+    Args:
+        directory (str): Frontend build directory
+        path (str): Requested path relative to the directory
+        accept_encoding (str): Accept-Encoding header of the request
+
+    Returns:
+        tuple: (path to serve, Content-Encoding or None)
+    """
+    accepted = {token.split(';')[0].strip().lower() for token in (accept_encoding or '').split(',')}
+    for encoding, suffix in ENCODING_SUFFIXES:
+        if encoding in accepted and os.path.isfile(os.path.join(directory, path + suffix)):
+            return path + suffix, encoding
+    return path, None
+
+def static_cache_control(path):
+    """Cache-Control value for a build file"""
+    if path.replace(os.sep, '/').startswith(HASHED_ASSET_PREFIX):
+        return IMMUTABLE_CACHE_CONTROL
+    return REVALIDATE_CACHE_CONTROL
+
+def static_etag(stats):
+    """Strong ETag of a build file (or variant) from its os.stat() results"""
+    return f'"{stats.st_size:x}-{stats.st_mtime_ns:x}"'
+
+def static_not_modified(if_none_match, if_modified_since, etag, stats):
+    """Evaluate If-None-Match (or, without it, If-Modified-Since) for a build file"""
+    if if_none_match:
+        return any(tag.strip().removeprefix('W/') in (etag, '*') for tag in if_none_match.split(','))
+    if not if_modified_since:
+        return False
+    try:
+        return int(stats.st_mtime) <= int(parsedate_to_datetime(if_modified_since).timestamp())
+    except (TypeError, ValueError):
+        return False
@@ -0,0 +1,268 @@
+import json
+import os
+import threading
+import time
+import uuid
+from werkzeug.utils import secure_filename
+from media_utils import UPLOADS_FOLDER, MEDIA_FOLDERS, COPY_CHUNK_SIZE, get_media_type, register_media_file, sync_catalog_entry, describe_media_file
+
+# Partially received uploads live here until they are complete. It sits
+# inside UPLOADS_FOLDER so finished files can be renamed into place.
+INCOMING_FOLDER = os.path.join(UPLOADS_FOLDER, 'incoming')
+os.makedirs(INCOMING_FOLDER, exist_ok=True)
+
+# Sessions not touched for this long are discarded
+SESSION_TTL_SECONDS = 24 * 60 * 60
+
+# Chunk size suggested to clients
+RECOMMENDED_CHUNK_SIZE = 8 * 1024 * 1024
+
+# One lock per session guards its range bookkeeping; chunk data itself is
+# written without holding it so chunks can arrive in parallel
+_session_locks = {}
+_session_locks_guard = threading.Lock()
+
+class UploadError(Exception):
+    """Raised for invalid upload session requests"""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+def _session_lock(upload_id):
+    with _session_locks_guard:
+        return _session_locks.setdefault(upload_id, threading.Lock())
+
+def _drop_session_lock(upload_id):
+    with _session_locks_guard:
+        _session_locks.pop(upload_id, None)
+
+def _paths(upload_id):
+    """Get the (state file, data file) paths of a session"""
+    if not upload_id or not all(c.isalnum() or c == '-' for c in upload_id):
+        raise UploadError('Invalid upload ID', 404)
+    return (os.path.join(INCOMING_FOLDER, f"{upload_id}.json"),
+            os.path.join(INCOMING_FOLDER, f"{upload_id}.part"))
+
+def _load(upload_id):
+    state_path, _ = _paths(upload_id)
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise UploadError('Upload session not found', 404)
+
+def _store(session):
+    state_path, _ = _paths(session['uploadId'])
+    session['updatedAt'] = int(time.time() * 1000)
+    temp_path = state_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(session, f)
+    os.replace(temp_path, state_path)
+
+def _merge_range(ranges, start, end):
+    """Add the half-open byte range [start, end) to a sorted list of ranges"""
+    merged = []
+    for range_start, range_end in sorted(ranges + [[start, end]]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_end)
+        else:
+            merged.append([range_start, range_end])
+    return merged
+
+def describe_session(session):
+    """Build the API view of a session"""
+    ranges = session['ranges']
+    # The resume offset is the end of the contiguous prefix
+    offset = ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+    return {
+        'uploadId': session['uploadId'],
+        'filename': session['filename'],
+        'size': session['size'],
+        'offset': offset,
+        'received': sum(end - start for start, end in ranges),
+        'ranges': ranges,
+        'chunkSize': RECOMMENDED_CHUNK_SIZE,
+        'complete': session.get('media') is not None,
+        'media': session.get('media'),
+        'error': session.get('error')
+    }
+
+def create_session(filename, size):
+    """Start a resumable upload
+
+    Args:
+        filename (str): Original filename of the upload
+        size (int): Total size of the file in bytes
+
+    Returns:
+        dict: Session description (see describe_session)
+    """
+    filename = secure_filename(filename or '')
+    if not filename:
+        raise UploadError('No filename given')
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError('Invalid upload size')
+    if size <= 0:
+        raise UploadError('Invalid upload size')
+
+    clean_stale_sessions()
+
+    upload_id = uuid.uuid4().hex
+    _, data_path = _paths(upload_id)
+    # Pre-size the data file so chunks can be written at any offset
+    with open(data_path, 'wb') as f:
+        f.truncate(size)
+
+    session = {
+        'uploadId': upload_id,
+        'filename': filename,
+        'size': size,
+        'ranges': [],
+        'createdAt': int(time.time() * 1000),
+        'media': None
+    }
+    _store(session)
+    print(f"Created upload session {upload_id} for {filename} ({size} bytes)")
+    return describe_session(session)
+
+def get_session(upload_id):
+    """Get the current state of an upload session"""
+    return describe_session(_load(upload_id))
+
+def write_chunk(upload_id, offset, stream, length=None):
+    """Write a chunk of an upload at the given byte offset
+
+    Chunks may arrive out of order or in parallel. Once every byte has been
+    received the file is finalized into the media library.
+
+    Args:
+        upload_id (str): Session ID
+        offset (int): Byte offset of the chunk in the file
+        stream: Readable binary stream with the chunk data
+        length (int): Expected chunk length, if known (Content-Length)
+
+    Returns:
+        dict: Updated session description
+    """
+    session = _load(upload_id)
+    if session.get('error'):
+        raise UploadError(session['error'], 409)
+    if session.get('storedAs'):
+        # Already moved into the library; the data file is gone
+        return describe_session(session)
+
+    try:
+        offset = int(offset)
+    except (TypeError, ValueError):
+        raise UploadError('Missing or invalid Upload-Offset')
+    if offset < 0 or offset >= session['size']:
+        raise UploadError('Upload-Offset outside of file', 416)
+    if length is not None and offset + length > session['size']:
+        raise UploadError('Chunk extends past end of file', 416)
+
+    _, data_path = _paths(upload_id)
+    written = 0
+    try:
+        with open(data_path, 'r+b') as f:
+            f.seek(offset)
+            while offset + written < session['size']:
+                chunk = stream.read(min(COPY_CHUNK_SIZE, session['size'] - offset - written))
+                if not chunk:
+                    break
+                f.write(chunk)
+                written += len(chunk)
+    except FileNotFoundError:
+        # A parallel chunk completed the upload and moved the data file away
+        return describe_session(_load(upload_id))
+
+    if written == 0:
+        return describe_session(session)
+
+    with _session_lock(upload_id):
+        # Reload under the lock so parallel chunks don't lose each other's ranges
+        session = _load(upload_id)
+        session['ranges'] = _merge_range(session['ranges'], offset, offset + written)
+        complete = session['ranges'] == [[0, session['size']]] and not session.get('storedAs')
+        if complete:
+            session['storedAs'] = _store_upload(session)
+        _store(session)
+
+    if complete:
+        # Hashing, probing and thumbnails run outside the lock; later chunks
+        # of this session see 'storedAs' and return right away
+        _finalize(session)
+        _drop_session_lock(upload_id)
+        if session.get('error'):
+            raise UploadError(session['error'], 500)
+
+    return describe_session(session)
+
+def _store_upload(session):
+    """Move a fully received upload into its media folder
+
+    Returns:
+        str: Stored filename ('{timestamp}-{filename}')
+    """
+    _, data_path = _paths(session['uploadId'])
+    media_type = get_media_type(session['filename'])
+    stored_filename = f"{int(time.time() * 1000)}-{session['filename']}"
+    os.replace(data_path, os.path.join(MEDIA_FOLDERS[media_type], stored_filename))
+    print(f"Upload session {session['uploadId']} complete, stored as {stored_filename}")
+    return stored_filename
+
+def _finalize(session):
+    """Catalog a stored upload and record the result in its session
+
+    If registration fails (hashing, probing, thumbnails), the file is still
+    added to the catalog without its derived data, which the library
+    listing backfills later. Only if that fails too is the session marked
+    failed.
+    """
+    filename = session['filename']
+    media_type = get_media_type(filename)
+    stored_filename = session['storedAs']
+    file_path = os.path.join(MEDIA_FOLDERS[media_type], stored_filename)
+    media, error = None, None
+    try:
+        media = register_media_file(file_path, filename, int(stored_filename.split('-', 1)[0]))
+    except Exception as e:
+        print(f"Error registering upload {session['uploadId']}: {e}")
+        try:
+            sync_catalog_entry(media_type, stored_filename)
+            media = describe_media_file(media_type, stored_filename)
+        except Exception as e:
+            print(f"Error cataloguing upload {session['uploadId']}: {e}")
+            error = f"Upload was stored as {stored_filename} but could not be catalogued: {e}"
+
+    with _session_lock(session['uploadId']):
+        session.update(_load(session['uploadId']), media=media, error=error)
+        _store(session)
+
+def abort_session(upload_id):
+    """Discard an upload session and any data received so far"""
+    state_path, data_path = _paths(upload_id)
+    found = False
+    for path in (state_path, data_path):
+        if os.path.exists(path):
+            os.remove(path)
+            found = True
+    _drop_session_lock(upload_id)
+    return found
+
+def clean_stale_sessions():
+    """Remove sessions that have not been touched within SESSION_TTL_SECONDS"""
+    count = 0
+    cutoff = time.time() - SESSION_TTL_SECONDS
+    for filename in os.listdir(INCOMING_FOLDER):
+        if not filename.endswith('.json'):
+            continue
+        state_path = os.path.join(INCOMING_FOLDER, filename)
+        try:
+            if os.path.getmtime(state_path) < cutoff:
+                abort_session(filename[:-len('.json')])
+                count += 1
+        except Exception as e:
+            print(f"Error cleaning upload session {filename}: {e}")
+    return count
@@ -1,8 +1,15 @@
 import asyncio
+import hashlib
+import math
 import os
+import random
+import re
+import sqlite3
 import sys
+import time
 from typing import Optional, List, Dict, Any
-from contextlib import AsyncExitStack
+from contextlib import AsyncExitStack, asynccontextmanager
+from collections import OrderedDict
 import json
 
 # MCP Imports
@@ -12,6 +19,7 @@ from mcp.client.stdio import stdio_client
 # Gemini Imports
 import google.generativeai as genai
 from google.generativeai.types import GenerationConfig, Tool as GeminiTool, FunctionDeclaration
+from google.api_core import exceptions as google_exceptions
 
 # Env variable loader
 from dotenv import load_dotenv
@@ -23,8 +31,74 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 if not GOOGLE_API_KEY:
     raise ValueError("GOOGLE_API_KEY not found in environment variables or .env file.")
 genai.configure(api_key=GOOGLE_API_KEY)
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+
+# Request limits per model. requests_per_minute and burst size a token bucket
+# shared by every client process; max_concurrency caps calls in flight across
+# them. Failed calls are retried with exponential backoff and full jitter.
+# Any value can be overridden with GEMINI_<NAME> (e.g. GEMINI_REQUESTS_PER_MINUTE).
+DEFAULT_MODEL_LIMITS = {
+    "requests_per_minute": 60,
+    "burst": 10,
+    "max_concurrency": 8,
+    "max_retries": 4,
+    "backoff_base": 1.0,  # Seconds
+    "backoff_max": 16.0,
+    "timeout": 60
+}
+GEMINI_MODEL_LIMITS = {
+    "gemini-1.5-flash": {},
+    "gemini-1.5-pro": {"requests_per_minute": 20, "burst": 4, "max_concurrency": 4}
+}
+
+# Shared limiter state, and how long a call may wait for its turn before the
+# query is answered with a busy message instead
+GEMINI_LIMITS_PATH = os.getenv("GEMINI_LIMITS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "gemini_limits.sqlite3"))
+GEMINI_QUEUE_TIMEOUT = 30
+
+# Errors worth another attempt: quota, overload and transient server failures
+RETRYABLE_GEMINI_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+    asyncio.TimeoutError
+)
 # --- End Gemini Configuration ---
 
+# --- Plan Cache Configuration ---
+# Tool-call plans Gemini produced, keyed by query template and shared by every
+# client process through one SQLite file
+PLAN_CACHE_PATH = os.getenv("PLAN_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "plan_cache.sqlite3"))
+PLAN_CACHE_TTL = int(os.getenv("PLAN_CACHE_TTL", 6 * 60 * 60))  # Seconds
+PLAN_CACHE_MAX_ENTRIES = int(os.getenv("PLAN_CACHE_MAX_ENTRIES", 500))
+# --- End Plan Cache Configuration ---
+
+# --- Tool Retrieval Configuration ---
+# At most this many tool declarations are sent with a Gemini turn; servers
+# with no more tools than TOOL_RETRIEVAL_MIN_TOOLS always send them all
+TOOL_RETRIEVAL_TOP_K = int(os.getenv("TOOL_RETRIEVAL_TOP_K", 6))
+TOOL_RETRIEVAL_MIN_TOOLS = 8
+# --- End Tool Retrieval Configuration ---
+
+# --- Tool Result Configuration ---
+# Tool results longer than these limits reach Gemini as an excerpt plus a
+# reference ID; the full text stays here for fetch_tool_result. Tokens are
+# estimated at TOOL_RESULT_CHARS_PER_TOKEN characters each. Limits can be set
+# per tool with TOOL_RESULT_LIMITS='{"tool_name": {"max_bytes": ..., "max_tokens": ...}}'.
+DEFAULT_TOOL_RESULT_LIMITS = {"max_bytes": 4000, "max_tokens": 1000}
+TOOL_RESULT_LIMITS = json.loads(os.getenv("TOOL_RESULT_LIMITS") or "{}")
+TOOL_RESULT_CHARS_PER_TOKEN = 4
+# Full results kept for fetching, most recent first
+TOOL_RESULT_STORE_SIZE = 20
+FETCH_TOOL_NAME = "fetch_tool_result"
+# --- End Tool Result Configuration ---
+
+def marked_response(text: str) -> str:
+    """Wraps a reply in the markers the server's workers read up to; every reply needs them."""
+    return f"RESPONSE_START\n{text}\nRESPONSE_END"
+
 def convert_mcp_tool_to_gemini(mcp_tool: McpTool) -> FunctionDeclaration:
     """Converts MCP Tool schema to Gemini FunctionDeclaration."""
     gemini_params = {
@@ -48,6 +122,521 @@ def convert_mcp_tool_to_gemini(mcp_tool: McpTool) -> FunctionDeclaration:
     )
     return func_decl
 
+def get_model_limits(model_name: str) -> Dict[str, Any]:
+    """Request limits of a model: defaults, then the model's entry, then environment overrides."""
+    limits = dict(DEFAULT_MODEL_LIMITS)
+    limits.update(GEMINI_MODEL_LIMITS.get(model_name, {}))
+    for name, value in limits.items():
+        override = os.getenv(f"GEMINI_{name.upper()}")
+        if override:
+            limits[name] = type(value)(override)
+    return limits
+
+class GeminiBusyError(Exception):
+    """Raised when a Gemini call can't get a turn within GEMINI_QUEUE_TIMEOUT, or can't finish before the query's deadline."""
+
+class GeminiRateLimiter:
+    """Token bucket and concurrency cap for one model, shared through SQLite.
+
+    Every client process (one per chat session) opens the same file, so the
+    limits hold for the server as a whole. Concurrency slots are leases that
+    expire, so a crashed process can't hold one forever.
+    """
+
+    def __init__(self, model_name: str, limits: Dict[str, Any], path: str = GEMINI_LIMITS_PATH):
+        self.model_name = model_name
+        self.limits = limits
+        try:
+            self.db = sqlite3.connect(path, timeout=10, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.Error as e:
+            print(f"Warning: shared Gemini limits unavailable, limiting this process only: {e}")
+            self.db = sqlite3.connect(":memory:", isolation_level=None)
+        self.db.execute("CREATE TABLE IF NOT EXISTS buckets (model TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS slots (id INTEGER PRIMARY KEY AUTOINCREMENT, model TEXT, expires REAL)")
+
+    def _transaction(self, func):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            result = func()
+            self.db.execute("COMMIT")
+            return result
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def _take_token(self) -> float:
+        """Take a token from the bucket; returns 0, or the seconds until one is available."""
+        def take():
+            now = time.time()
+            rate = self.limits["requests_per_minute"] / 60
+            row = self.db.execute("SELECT tokens, updated FROM buckets WHERE model = ?", (self.model_name,)).fetchone()
+            tokens, updated = row if row else (self.limits["burst"], now)
+            tokens = min(self.limits["burst"], tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self.db.execute("INSERT OR REPLACE INTO buckets (model, tokens, updated) VALUES (?, ?, ?)",
+                            (self.model_name, tokens, now))
+            return wait
+        return self._transaction(take)
+
+    def _take_slot(self) -> Optional[int]:
+        """Lease a concurrency slot; returns its ID, or None if all are taken."""
+        def take():
+            now = time.time()
+            self.db.execute("DELETE FROM slots WHERE expires < ?", (now,))
+            in_flight = self.db.execute("SELECT COUNT(*) FROM slots WHERE model = ?", (self.model_name,)).fetchone()[0]
+            if in_flight >= self.limits["max_concurrency"]:
+                return None
+            # Outlive the call's own timeout, so only a crashed holder's lease expires
+            expires = now + 2 * self.limits["timeout"]
+            return self.db.execute("INSERT INTO slots (model, expires) VALUES (?, ?)",
+                                   (self.model_name, expires)).lastrowid
+        return self._transaction(take)
+
+    def drain(self):
+        """Empty the bucket after a quota error, so every process slows down."""
+        self._transaction(lambda: self.db.execute(
+            "INSERT OR REPLACE INTO buckets (model, tokens, updated) VALUES (?, 0, ?)", (self.model_name, time.time())))
+
+    @asynccontextmanager
+    async def turn(self, queue_timeout: float = GEMINI_QUEUE_TIMEOUT):
+        """Wait for a token and a concurrency slot, and hold the slot for the block."""
+        deadline = time.time() + queue_timeout
+        wait = self._take_token()
+        while wait > 0:
+            if time.time() + wait > deadline:
+                raise GeminiBusyError("Gemini request rate limit reached")
+            await asyncio.sleep(wait)
+            wait = self._take_token()
+
+        slot = self._take_slot()
+        while slot is None:
+            if time.time() > deadline:
+                raise GeminiBusyError("Too many Gemini requests in flight")
+            await asyncio.sleep(random.uniform(0.1, 0.5))
+            slot = self._take_slot()
+        try:
+            yield
+        finally:
+            self._transaction(lambda: self.db.execute("DELETE FROM slots WHERE id = ?", (slot,)))
+
+# Words that say nothing about which tool is needed
+TOOL_STOPWORDS = {
+    "a", "an", "the", "to", "of", "and", "or", "in", "on", "for", "with", "from", "by", "at", "as",
+    "it", "is", "be", "this", "that", "my", "me", "i", "you", "can", "please", "video", "file",
+    "path", "input", "output", "tool", "use", "using", "make", "want", "should", "will"
+}
+
+# Groups of words that point to the same kind of tool; each word is indexed
+# under the first word of its group
+TOOL_SYNONYMS = [
+    ["trim", "cut", "clip", "shorten", "shorter", "segment", "start", "end", "second", "minute"],
+    ["audio", "sound", "music", "song", "soundtrack", "track", "voice", "mp3", "wav", "m4a"],
+    ["merge", "combine", "join", "concatenate", "concat", "append", "add"],
+    ["convert", "format", "transcode", "export", "encode", "codec", "mp4", "webm", "mov", "mkv", "avi"],
+    ["aspect", "ratio", "instagram", "tiktok", "reel", "story", "vertical", "square", "portrait",
+     "landscape", "resize", "scale", "resolution", "crop", "width", "height"],
+    ["speed", "fast", "faster", "slow", "slower", "slowmo", "timelapse"],
+    ["text", "caption", "subtitle", "title", "overlay", "watermark", "font"],
+    ["filter", "effect", "color", "colour", "grayscale", "blur", "sharpen", "brightness", "contrast",
+     "saturation", "vintage", "sepia", "black", "white", "monochrome", "batman", "madmax", "style", "look"],
+    ["rotate", "rotation", "flip", "mirror", "orientation", "degree"],
+    ["thumbnail", "frame", "screenshot", "snapshot", "image", "picture", "photo"],
+    ["info", "metadata", "probe", "detail", "property", "duration", "length"],
+    ["volume", "loud", "louder", "quiet", "quieter", "mute", "silence", "normalize"],
+    ["fade", "transition", "crossfade"],
+    ["reverse", "backward", "rewind"]
+]
+
+def _stem(word: str) -> str:
+    """Crude suffix stripping, so 'trimming', 'trimmed' and 'trims' index alike."""
+    for suffix in ("ing", "ed", "s"):
+        if (len(word) - len(suffix) >= 3 and word.endswith(suffix)
+                and not word.endswith("ss") and not word.endswith("eed")):
+            word = word[:-len(suffix)]
+            break
+    # Undo the doubled consonant left by 'trimming' / 'trimmed'
+    if len(word) > 3 and word[-1] == word[-2] and word[-1] not in "aeiouls":
+        word = word[:-1]
+    return word
+
+_SYNONYM_INDEX = {_stem(word): _stem(group[0]) for group in TOOL_SYNONYMS for word in group}
+
+def tool_terms(text: str) -> List[str]:
+    """Split text (including snake_case and camelCase names) into canonical index terms."""
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text or "").lower()
+    terms = []
+    for word in re.findall(r"[a-z0-9]+", text):
+        if word in TOOL_STOPWORDS:
+            continue
+        word = _stem(word)
+        terms.append(_SYNONYM_INDEX.get(word, word))
+    return terms
+
+class ToolRetriever:
+    """Keyword index over the MCP server's tools, built once at connect time.
+
+    Tools are scored against a query by the canonical terms they share,
+    weighted by how rare each term is across tools; terms from a tool's name
+    count three times as much as terms from its description and parameters.
+    """
+
+    NAME_WEIGHT = 3
+
+    def __init__(self, mcp_tools: List[McpTool], declarations: List[FunctionDeclaration]):
+        self.declarations = {decl.name: decl for decl in declarations}
+        self.term_weights: Dict[str, Dict[str, float]] = {}
+        for tool in mcp_tools:
+            weights: Dict[str, float] = {}
+            for term in tool_terms(tool.description or ""):
+                weights[term] = max(weights.get(term, 0), 1)
+            for name, schema in (tool.inputSchema or {}).get("properties", {}).items():
+                for term in tool_terms(f"{name} {schema.get('description', '') if isinstance(schema, dict) else ''}"):
+                    weights[term] = max(weights.get(term, 0), 1)
+            for term in tool_terms(tool.name):
+                weights[term] = self.NAME_WEIGHT
+            self.term_weights[tool.name] = weights
+
+        tool_count = max(1, len(self.term_weights))
+        document_frequency: Dict[str, int] = {}
+        for weights in self.term_weights.values():
+            for term in weights:
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+        self.idf = {term: math.log(1 + tool_count / count) for term, count in document_frequency.items()}
+
+    def select(self, text: str, keep=()) -> List[FunctionDeclaration]:
+        """Pick the declarations relevant to text, plus the tools named in keep.
+
+        Falls back to every declaration when the server has few tools or
+        nothing in the text matches any tool.
+        """
+        if len(self.declarations) <= TOOL_RETRIEVAL_MIN_TOOLS:
+            return list(self.declarations.values())
+
+        query_terms = set(tool_terms(text))
+        scores = {}
+        for name, weights in self.term_weights.items():
+            score = sum(weights[term] * self.idf[term] for term in query_terms if term in weights)
+            if score > 0:
+                scores[name] = score
+        if not scores:
+            return list(self.declarations.values())
+
+        ranked = sorted(scores, key=scores.get, reverse=True)[:TOOL_RETRIEVAL_TOP_K]
+        names = ranked + [name for name in keep if name in self.declarations and name not in ranked]
+        return [self.declarations[name] for name in names if name in self.declarations]
+
+# Lines of a long text result worth keeping in its excerpt: outcomes,
+# problems, stream details and file paths
+KEY_LINE_PATTERN = re.compile(
+    r"error|warn|fail|invalid|denied|not found|no such|success|saved|output|created|written|"
+    r"duration|stream #|video:|audio:|[\\/][^\\/\s]+\.(?:mp4|mov|avi|webm|mkv|mp3|wav|ogg|aac|m4a|jpg|jpeg|png)",
+    re.IGNORECASE
+)
+EXCERPT_HEAD_LINES = 5
+EXCERPT_TAIL_LINES = 5
+EXCERPT_LINE_CHARS = 300
+
+# Shape of JSON results after summarizing
+JSON_MAX_DEPTH = 3
+JSON_MAX_ITEMS = 5
+JSON_MAX_KEYS = 30
+JSON_STRING_CHARS = 200
+
+def summarize_json(value: Any, depth: int = 0) -> Any:
+    """Keep a JSON value's structure and key fields, cutting long lists, strings and deep nesting."""
+    if isinstance(value, dict):
+        if depth >= JSON_MAX_DEPTH:
+            return f"{{... {len(value)} keys}}"
+        items = list(value.items())
+        summary = {key: summarize_json(item, depth + 1) for key, item in items[:JSON_MAX_KEYS]}
+        if len(items) > JSON_MAX_KEYS:
+            summary["..."] = f"{len(items) - JSON_MAX_KEYS} more keys"
+        return summary
+    if isinstance(value, list):
+        if depth >= JSON_MAX_DEPTH:
+            return f"[... {len(value)} items]"
+        summary = [summarize_json(item, depth + 1) for item in value[:JSON_MAX_ITEMS]]
+        if len(value) > JSON_MAX_ITEMS:
+            summary.append(f"... {len(value) - JSON_MAX_ITEMS} more items")
+        return summary
+    if isinstance(value, str) and len(value) > JSON_STRING_CHARS:
+        return value[:JSON_STRING_CHARS] + "..."
+    return value
+
+def excerpt_text(text: str, max_chars: int) -> str:
+    """Keep the first and last lines of a text and the key lines between them, within max_chars."""
+    lines = [line if len(line) <= EXCERPT_LINE_CHARS else line[:EXCERPT_LINE_CHARS] + "..."
+             for line in text.splitlines()]
+    # Candidates in order of priority: the end (where tools report their
+    # outcome), the start, then key lines
+    candidates = list(range(max(0, len(lines) - EXCERPT_TAIL_LINES), len(lines)))
+    candidates += list(range(min(EXCERPT_HEAD_LINES, len(lines))))
+    candidates += [i for i, line in enumerate(lines) if KEY_LINE_PATTERN.search(line)]
+
+    chosen, used = set(), 0
+    for i in candidates:
+        if i in chosen:
+            continue
+        if used + len(lines[i]) + 1 > max_chars:
+            break
+        chosen.add(i)
+        used += len(lines[i]) + 1
+
+    excerpt, previous = [], -1
+    for i in sorted(chosen):
+        if i > previous + 1:
+            excerpt.append(f"[... {i - previous - 1} lines omitted ...]")
+        excerpt.append(lines[i])
+        previous = i
+    if previous < len(lines) - 1:
+        excerpt.append(f"[... {len(lines) - 1 - previous} lines omitted ...]")
+    return "\n".join(excerpt)
+
+class ToolResultStore:
+    """Shapes tool results for Gemini and keeps the full text of shortened ones.
+
+    A result over its tool's limit is replaced with an excerpt: JSON keeps
+    its structure with long lists and strings cut, plain text (e.g. an ffmpeg
+    log) keeps its first and last lines and the lines that report outcomes,
+    errors or file paths. The excerpt carries a reference ID that Gemini can
+    pass to fetch_tool_result to page through the full text.
+    """
+
+    def __init__(self, size: int = TOOL_RESULT_STORE_SIZE):
+        self.size = size
+        self.results: OrderedDict = OrderedDict()
+        self.next_id = 1
+
+    @staticmethod
+    def limit(tool_name: str) -> int:
+        """Character budget of a tool's results."""
+        limits = dict(DEFAULT_TOOL_RESULT_LIMITS)
+        limits.update(TOOL_RESULT_LIMITS.get(tool_name, {}))
+        return min(limits["max_bytes"], limits["max_tokens"] * TOOL_RESULT_CHARS_PER_TOKEN)
+
+    def shape(self, tool_name: str, text: str) -> str:
+        """The text to send to Gemini for a tool result."""
+        max_chars = self.limit(tool_name)
+        if len(text.encode("utf-8")) <= max_chars:
+            return text
+
+        ref_id = f"result-{self.next_id}"
+        self.next_id += 1
+        self.results[ref_id] = text
+        while len(self.results) > self.size:
+            self.results.popitem(last=False)
+
+        excerpt = None
+        try:
+            summary = json.dumps(summarize_json(json.loads(text)), ensure_ascii=False)
+            if len(summary) <= max_chars:
+                excerpt = summary
+        except ValueError:
+            pass
+        if excerpt is None:
+            excerpt = excerpt_text(text, max_chars)
+        print(f"Shortened '{tool_name}' result from {len(text)} to {len(excerpt)} characters as {ref_id}", flush=True)
+        return (f"[Shortened from {len(text)} characters; call {FETCH_TOOL_NAME} with "
+                f"ref_id '{ref_id}' for the full text]\n{excerpt}")
+
+    def fetch(self, ref_id: str, offset: int = 0) -> str:
+        """One page of a stored result, starting at offset."""
+        text = self.results.get(ref_id)
+        if text is None:
+            return f"No stored result with ref_id '{ref_id}'; only the last {self.size} shortened results are kept."
+        page_size = DEFAULT_TOOL_RESULT_LIMITS["max_bytes"]
+        offset = max(0, min(int(offset or 0), len(text)))
+        page = text[offset:offset + page_size]
+        end = offset + len(page)
+        more = f"; call again with offset {end} for more" if end < len(text) else ""
+        return f"[{ref_id} characters {offset}-{end} of {len(text)}{more}]\n{page}"
+
+    def declaration(self) -> FunctionDeclaration:
+        return FunctionDeclaration(
+            name=FETCH_TOOL_NAME,
+            description="Get the full text of an earlier tool result that was shortened, one page at a time.",
+            parameters={
+                "type": "object",
+                "properties": {
+                    "ref_id": {"type": "string", "description": "Reference ID given in the shortened result"},
+                    "offset": {"type": "integer", "description": "Character offset to start from (default 0)"}
+                },
+                "required": ["ref_id"]
+            }
+        )
+
+# Politeness that doesn't change what a query asks for
+QUERY_FILLER = re.compile(r"^(?:please|pls|ok|okay|now|can you|could you|would you|will you)\s+|\s+(?:please|pls|thanks|thank you)$")
+
+# Tool arguments that still name a specific file after templating make a plan
+# unsafe to replay for other media
+LITERAL_MEDIA_PATH = re.compile(r"[\\/][^\\/]+\.(?:mp4|mov|avi|webm|mkv|mp3|wav|ogg|aac|m4a|jpg|jpeg|png)\b", re.IGNORECASE)
+
+# Words that make a query refer back to earlier turns ("do the same again",
+# "undo that"); mid-conversation, such queries mean something else each time
+CONTEXT_DEPENDENT_QUERY = re.compile(
+    r"\b(?:it|its|that|this|those|these|them|same|again|undo|redo|revert|previous|instead|also|too|"
+    r"more|less|shorter|longer|another)\b", re.IGNORECASE)
+
+class PlanCache:
+    """Cache of the tool calls Gemini chose for a query.
+
+    Plans are stored under two keys: the exact query text and a normalized
+    template of it. In both, the selected media appear as parameters, not
+    values: paths, IDs and file names are replaced with <<placeholders>> in
+    the query, the tool arguments and the final reply, so a plan learned
+    on one video replays on any other. Entries expire after PLAN_CACHE_TTL
+    seconds, and the least recently used ones are dropped past
+    PLAN_CACHE_MAX_ENTRIES.
+    """
+
+    def __init__(self, path: str = PLAN_CACHE_PATH, ttl: int = PLAN_CACHE_TTL, max_entries: int = PLAN_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Fingerprint of the server's tools; plans from another tool set never match
+        self.tools_fingerprint = ""
+        self.stats = {"exact_hits": 0, "normalized_hits": 0, "misses": 0, "stores": 0, "invalidations": 0}
+        self.db = sqlite3.connect(path, timeout=5)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS plans ("
+            "key TEXT PRIMARY KEY, template TEXT, plan TEXT, "
+            "created REAL, last_used REAL, hits INTEGER DEFAULT 0)"
+        )
+        self.db.commit()
+
+    def set_tools(self, tool_names: List[str]):
+        self.tools_fingerprint = hashlib.sha1(",".join(sorted(tool_names)).encode()).hexdigest()[:12]
+
+    @staticmethod
+    def media_params(media_context: Optional[Dict[str, Any]]) -> Dict[str, str]:
+        """Values of the selected media that are turned into placeholders."""
+        params = {}
+        for kind in ("video", "audio"):
+            media_path = (media_context or {}).get(f"{kind}_path")
+            media_id = (media_context or {}).get(f"{kind}_id")
+            if media_path:
+                params[f"{kind}_path"] = media_path
+                params[f"{kind}_stem"] = os.path.splitext(media_path)[0]
+                params[f"{kind}_name"] = os.path.basename(media_path)
+            if media_id:
+                params[f"{kind}_id"] = str(media_id)
+        return params
+
+    @staticmethod
+    def to_template(value: Any, params: Dict[str, str]) -> Any:
+        """Replace media values in a string (or the strings of a dict or list) with placeholders."""
+        if isinstance(value, str):
+            # Longest first, so a full path wins over its stem
+            for name, literal in sorted(params.items(), key=lambda item: -len(item[1])):
+                value = value.replace(literal, f"<<{name}>>")
+            return value
+        if isinstance(value, dict):
+            return {key: PlanCache.to_template(item, params) for key, item in value.items()}
+        if isinstance(value, list):
+            return [PlanCache.to_template(item, params) for item in value]
+        return value
+
+    @staticmethod
+    def from_template(value: Any, params: Dict[str, str]) -> Any:
+        """Fill placeholders back in with the current media values."""
+        if isinstance(value, str):
+            return re.sub(r"<<(\w+)>>", lambda m: params.get(m.group(1), m.group(0)), value)
+        if isinstance(value, dict):
+            return {key: PlanCache.from_template(item, params) for key, item in value.items()}
+        if isinstance(value, list):
+            return [PlanCache.from_template(item, params) for item in value]
+        return value
+
+    def keys(self, query: str, media_context: Optional[Dict[str, Any]]):
+        """Exact and normalized cache keys of a query, plus the normalized template."""
+        params = self.media_params(media_context)
+        # Which media are selected is part of the key; their values are not
+        slots = ",".join(sorted(params))
+        exact = self.to_template(query.strip(), params)
+        template = " ".join(re.sub(r"[^\w\s:.<>-]|(?<!\d)\.|\.(?!\d)", " ", exact.lower()).split())
+        while True:
+            stripped = QUERY_FILLER.sub("", template).strip()
+            if stripped == template:
+                break
+            template = stripped
+        prefix = f"{self.tools_fingerprint}|{slots}|"
+        return prefix + "exact:" + exact, prefix + "norm:" + template, template
+
+    def lookup(self, query: str, media_context: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Get the cached plan for a query, or None."""
+        exact_key, normalized_key, template = self.keys(query, media_context)
+        now = time.time()
+        for key, stat in ((exact_key, "exact_hits"), (normalized_key, "normalized_hits")):
+            row = self.db.execute("SELECT plan, created FROM plans WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                continue
+            if now - row[1] > self.ttl:
+                self.db.execute("DELETE FROM plans WHERE key = ?", (key,))
+                self.db.commit()
+                continue
+            self.db.execute("UPDATE plans SET last_used = ?, hits = hits + 1 WHERE key = ?", (now, key))
+            self.db.commit()
+            self.stats[stat] += 1
+            self.log(f"{stat[:-5]} hit for '{template}'")
+            return json.loads(row[0])
+        self.stats["misses"] += 1
+        self.log(f"miss for '{template}'")
+        return None
+
+    def store(self, query: str, media_context: Optional[Dict[str, Any]], calls: List[Dict[str, Any]], final_text: str) -> bool:
+        """Remember the tool calls that answered a query.
+
+        Returns:
+            bool: False if the plan refers to files other than the selected
+            media and was not cached
+        """
+        params = self.media_params(media_context)
+        plan = {
+            "calls": [{"name": call["name"], "args": self.to_template(call["args"], params)} for call in calls],
+            "reply": self.to_template(final_text, params)
+        }
+        if LITERAL_MEDIA_PATH.search(json.dumps(plan["calls"])):
+            self.log("plan names specific files, not cached")
+            return False
+
+        exact_key, normalized_key, template = self.keys(query, media_context)
+        now = time.time()
+        encoded = json.dumps(plan)
+        for key in (exact_key, normalized_key):
+            self.db.execute(
+                "INSERT OR REPLACE INTO plans (key, template, plan, created, last_used, hits) VALUES (?, ?, ?, ?, ?, 0)",
+                (key, template, encoded, now, now)
+            )
+        # Drop expired entries, then the least recently used beyond the limit
+        self.db.execute("DELETE FROM plans WHERE created < ?", (now - self.ttl,))
+        self.db.execute(
+            "DELETE FROM plans WHERE key NOT IN (SELECT key FROM plans ORDER BY last_used DESC LIMIT ?)",
+            (self.max_entries,)
+        )
+        self.db.commit()
+        self.stats["stores"] += 1
+        self.log(f"stored {len(calls)} tool call(s) for '{template}'")
+        return True
+
+    def invalidate(self, query: str, media_context: Optional[Dict[str, Any]]):
+        """Forget a query's plan, under every phrasing of its template, e.g. after it failed on replay."""
+        exact_key, normalized_key, template = self.keys(query, media_context)
+        prefix = normalized_key[:-len("norm:" + template)]
+        self.db.execute("DELETE FROM plans WHERE key = ? OR (template = ? AND substr(key, 1, ?) = ?)",
+                        (exact_key, template, len(prefix), prefix))
+        self.db.commit()
+        self.stats["invalidations"] += 1
+
+    def log(self, event: str):
+        counts = ", ".join(f"{name}={count}" for name, count in self.stats.items())
+        print(f"[Plan cache] {event} ({counts})", flush=True)
+
 class MCPClient:
     def __init__(self):
         """Initializes the MCP Client."""
@@ -56,7 +645,7 @@ class MCPClient:
         # --- Gemini Model Initialization ---
         try:
             self.model = genai.GenerativeModel(
-                'gemini-1.5-flash',
+                GEMINI_MODEL,
                 generation_config=GenerationConfig(
                     temperature=0.7
                 )
@@ -65,8 +654,20 @@ class MCPClient:
         except Exception as e:
             print(f"Error initializing Gemini model: {e}")
             raise
+        self.model_limits = get_model_limits(GEMINI_MODEL)
+        self.rate_limiter = GeminiRateLimiter(GEMINI_MODEL, self.model_limits)
         # --- End Gemini Model Initialization ---
         self.available_gemini_tools: Optional[List[GeminiTool]] = None
+        self.tool_retriever: Optional[ToolRetriever] = None
+        # Tools already called in this chat; their calls are in the history,
+        # so they stay declared on every later turn
+        self.called_tool_names = set()
+        self.tool_results = ToolResultStore()
+        try:
+            self.plan_cache: Optional[PlanCache] = PlanCache()
+        except sqlite3.Error as e:
+            print(f"Warning: plan cache unavailable, every query goes to Gemini: {e}")
+            self.plan_cache = None
 
     async def connect_to_server(self, server_script_path: str):
         """Connects to an MCP server via stdio."""
@@ -93,12 +694,15 @@ class MCPClient:
             # List available tools from MCP Server
             response = await self.session.list_tools()
             mcp_tools = response.tools
+            if self.plan_cache:
+                self.plan_cache.set_tools([tool.name for tool in mcp_tools])
 
             # Convert MCP tools to Gemini format
             gemini_func_declarations = [convert_mcp_tool_to_gemini(tool) for tool in mcp_tools]
 
             if gemini_func_declarations:
                 self.available_gemini_tools = [GeminiTool(function_declarations=gemini_func_declarations)]
+                self.tool_retriever = ToolRetriever(mcp_tools, gemini_func_declarations)
             else:
                 self.available_gemini_tools = None
 
@@ -108,12 +712,188 @@ class MCPClient:
             await self.cleanup()
             raise
 
-    async def process_query(self, query: str) -> str:
-        """Processes a query using Gemini and available MCP tools."""
+    def load_history(self, summary: Optional[str], messages: List[Dict[str, Any]]):
+        """Restarts the Gemini chat session with earlier conversation history.
+
+        summary is a digest of compacted older messages; messages are the
+        most recent exchanges as {role: 'user'|'assistant', content}.
+        """
+        history = []
+        if summary:
+            history.append({"role": "user", "parts": [f"[Summary of our earlier conversation]\n{summary}"]})
+            history.append({"role": "model", "parts": ["Understood, I'll keep that context in mind."]})
+        for message in messages:
+            content = message.get("content")
+            if content:
+                role = "user" if message.get("role") == "user" else "model"
+                history.append({"role": role, "parts": [content]})
+        self.chat_session = self.model.start_chat(history=history, enable_automatic_function_calling=False)
+        self.called_tool_names = set()
+        return len(history)
+
+    @staticmethod
+    def _format_media_context(media_context: Optional[Dict[str, Any]]) -> Optional[str]:
+        """Renders the structured media context as a compact note for Gemini."""
+        if not media_context:
+            return None
+        known = {key: value for key, value in media_context.items() if value}
+        if not known:
+            return None
+        return f"[Selected media: {json.dumps(known)}. Use these file paths for tool arguments.]"
+
+    @staticmethod
+    def _resolve_media_ids(tool_args: Dict[str, Any], media_context: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Replaces media IDs that Gemini put into tool arguments with their storage paths."""
+        if not media_context:
+            return tool_args
+        id_to_path = {}
+        for kind in ("video", "audio"):
+            media_id = media_context.get(f"{kind}_id")
+            media_path = media_context.get(f"{kind}_path")
+            if media_id and media_path:
+                id_to_path[str(media_id)] = media_path
+        return {key: id_to_path.get(value, value) if isinstance(value, str) else value
+                for key, value in tool_args.items()}
+
+    def _plan_cache_applies(self, query: str) -> bool:
+        """Whether a query's plan may be looked up and stored.
+
+        Once the chat has history, queries that point back at it ("undo
+        that", "the same but shorter") depend on the conversation, which the
+        cache key doesn't capture.
+        """
+        if not self.plan_cache:
+            return False
+        history = getattr(self.chat_session, "history", None)
+        return not (history and CONTEXT_DEPENDENT_QUERY.search(query))
+
+    def _record_exchange(self, query: str, reply: str):
+        """Adds an exchange answered without Gemini to its chat history."""
+        try:
+            self.chat_session.history.extend([
+                genai.protos.Content(role="user", parts=[genai.protos.Part(text=query)]),
+                genai.protos.Content(role="model", parts=[genai.protos.Part(text=reply)])
+            ])
+        except Exception as e:
+            print(f"Warning: could not add cached exchange to the chat history: {e}")
+
+    async def _run_cached_plan(self, query: str, plan: Dict[str, Any], media_context: Optional[Dict[str, Any]]) -> Optional[str]:
+        """Replays a cached tool-call plan without asking Gemini.
+
+        The plan is dropped if a tool call fails. If the first call failed,
+        nothing has happened yet and None is returned, so the query goes to
+        Gemini as usual. A later failure is reported instead: the earlier
+        calls already ran, and asking again would repeat them.
+        """
+        params = PlanCache.media_params(media_context)
+        text_parts = []
+        for index, call in enumerate(plan["calls"]):
+            tool_args = PlanCache.from_template(call["args"], params)
+            text_parts.append(f"[Tool call: {call['name']} with arguments: {json.dumps(tool_args)}]")
+            error = None
+            try:
+                mcp_result = await self.session.call_tool(call["name"], tool_args)
+                if getattr(mcp_result, "isError", False):
+                    error = self._tool_result_text(mcp_result)
+            except Exception as tool_error:
+                error = str(tool_error)
+            if error is None:
+                continue
+
+            print(f"Cached plan call to '{call['name']}' failed: {error}")
+            self.plan_cache.invalidate(query, media_context)
+            if index == 0:
+                return None
+            reply = (f"The '{call['name']}' step failed ({error}), so I stopped there. "
+                     f"The steps before it have already run.")
+            text_parts.append(reply)
+            self._record_exchange(query, reply)
+            response_text = "\n".join(text_parts)
+            return marked_response(response_text)
+
+        reply = PlanCache.from_template(plan["reply"], params)
+        text_parts.append(reply)
+        self._record_exchange(query, reply)
+        response_text = "\n".join(text_parts)
+        return marked_response(response_text)
+
+    def _select_tools(self, text: str) -> Optional[List[GeminiTool]]:
+        """Declarations to send with a turn about text: the relevant tools plus those already called."""
+        if not self.tool_retriever:
+            return self.available_gemini_tools
+        declarations = self.tool_retriever.select(text, keep=self.called_tool_names)
+        print(f"Declaring {len(declarations)} of {len(self.tool_retriever.declarations)} tools: "
+              f"{', '.join(decl.name for decl in declarations)}", flush=True)
+        if self.tool_results.results:
+            declarations = declarations + [self.tool_results.declaration()]
+        return [GeminiTool(function_declarations=declarations)]
+
+    @staticmethod
+    def _tool_result_text(mcp_result) -> str:
+        """The text of an MCP tool result; non-text content is noted rather than dumped."""
+        content = getattr(mcp_result, 'content', None)
+        if not isinstance(content, list):
+            return str(content if content is not None else mcp_result)
+        texts = []
+        for item in content:
+            if hasattr(item, 'text'):
+                texts.append(item.text)
+            else:
+                texts.append(f"[{type(item).__name__} omitted]")
+        return "\n".join(texts)
+
+    async def _send_to_gemini(self, content, tools: Optional[List[GeminiTool]], deadline: Optional[float] = None):
+        """Sends a message in the chat session, within the model's limits and with retries.
+
+        deadline is the time.time() by which the query must be answered;
+        waits, call timeouts and backoffs are cut to fit it, and
+        GeminiBusyError is raised once it can't be met.
+        """
+        limits = self.model_limits
+        for attempt in range(limits["max_retries"] + 1):
+            queue_timeout = GEMINI_QUEUE_TIMEOUT
+            if deadline is not None:
+                queue_timeout = min(queue_timeout, deadline - time.time())
+                if queue_timeout <= 0:
+                    raise GeminiBusyError("Query deadline reached")
+            async with self.rate_limiter.turn(queue_timeout):
+                call_timeout = limits["timeout"]
+                if deadline is not None:
+                    call_timeout = max(1, min(call_timeout, deadline - time.time()))
+                try:
+                    return await self.chat_session.send_message_async(
+                        content,
+                        tools=tools,
+                        request_options={"timeout": call_timeout}
+                    )
+                except RETRYABLE_GEMINI_ERRORS as e:
+                    if deadline is not None and time.time() >= deadline:
+                        raise GeminiBusyError(f"Query deadline reached ({e})") from e
+                    if attempt == limits["max_retries"]:
+                        raise
+                    if isinstance(e, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+                        self.rate_limiter.drain()
+                    error = e
+            delay = random.uniform(0, min(limits["backoff_max"], limits["backoff_base"] * 2 ** attempt))
+            if deadline is not None and time.time() + delay >= deadline:
+                raise GeminiBusyError(f"No time left to retry ({error})")
+            print(f"Gemini call failed ({error}), retry {attempt + 1}/{limits['max_retries']} in {delay:.1f}s", flush=True)
+            await asyncio.sleep(delay)
+
+    async def process_query(self, query: str, media_context: Optional[Dict[str, Any]] = None,
+                            budget: Optional[float] = None) -> str:
+        """Processes a query using Gemini and available MCP tools.
+
+        media_context carries the selected media as IDs and resolved paths
+        (video_id, video_path, audio_id, audio_path). budget is the seconds
+        the caller will wait for the reply; Gemini waits and retries stop
+        in time to answer within it.
+        """
+        deadline = time.time() + budget if budget else None
         if not self.session:
-            return "Error: Not connected to an MCP server."
+            return marked_response("Error: Not connected to an MCP server.")
         if not self.chat_session:
-            return "Error: Gemini chat session not initialized."
+            return marked_response("Error: Gemini chat session not initialized.")
             
         # Handle special queries directly
         query_lower = query.lower().strip()
@@ -128,20 +908,32 @@ class MCPClient:
                 if tool_names:
                     tools_list = f"Available tools: {', '.join(tool_names)}"
                     # Wrap the response in the markers expected by the server
-                    return f"RESPONSE_START\n{tools_list}\nRESPONSE_END"
+                    return marked_response(tools_list)
             
             # Fallback if we can't extract tool names
             fallback_msg = "Please ask Gemini about the available tools for more information."
-            return f"RESPONSE_START\n{fallback_msg}\nRESPONSE_END"
+            return marked_response(fallback_msg)
+
+        # Replay the tool calls Gemini chose the last time this was asked
+        plan_cache_applies = self._plan_cache_applies(query)
+        if plan_cache_applies:
+            plan = self.plan_cache.lookup(query, media_context)
+            if plan:
+                cached_response = await self._run_cached_plan(query, plan, media_context)
+                if cached_response:
+                    return cached_response
 
         final_text_parts = []
+        # Tool calls made for this query, cached as its plan if all succeed
+        executed_calls = []
+        plan_cacheable = True
 
         try:
-            # Send the user query to Gemini, providing the tools definition
-            response = await self.chat_session.send_message_async(
-                query,
-                tools=self.available_gemini_tools
-            )
+            # Send the user query (plus the selected media, if any) to Gemini,
+            # providing the tools definition
+            context_note = self._format_media_context(media_context)
+            tools = self._select_tools(query)
+            response = await self._send_to_gemini([query, context_note] if context_note else query, tools, deadline)
 
             # --- Gemini Function Calling Loop ---
             while True:
@@ -163,67 +955,73 @@ class MCPClient:
                     break  # Exit the loop if no function call is found
 
                 tool_name = function_call.name
-                tool_args = dict(function_call.args)
+                tool_args = self._resolve_media_ids(dict(function_call.args), media_context)
 
                 final_text_parts.append(f"[Gemini requested tool '{tool_name}' with arguments: {json.dumps(tool_args)}]")
 
-                # Execute the tool call via MCP
+                # Shortened results are fetched locally, never from the server
+                if tool_name == FETCH_TOOL_NAME:
+                    fetched_text = self.tool_results.fetch(tool_args.get("ref_id", ""), tool_args.get("offset", 0))
+                    response = await self._send_to_gemini(
+                        genai.protos.Part(text=f"[Tool '{tool_name}' result]: {fetched_text}"), tools, deadline)
+                    continue
+
+                # Execute the tool call via MCP. Only the call itself is
+                # guarded here; Gemini send errors (busy, retries exhausted)
+                # go to the handlers below
                 try:
+                    self.called_tool_names.add(tool_name)
                     mcp_result = await self.session.call_tool(tool_name, tool_args)
-
-                    # Extract the text content from mcp_result.content
-                    extracted_text = None
-                    if hasattr(mcp_result, 'content'):
-                        if (isinstance(mcp_result.content, list) and
-                                len(mcp_result.content) == 1 and
-                                type(mcp_result.content[0]).__name__ == 'TextContent' and
-                                hasattr(mcp_result.content[0], 'text')):
-                            extracted_text = mcp_result.content[0].text
-                        else:
-                            extracted_text = str(mcp_result.content)
-                    else:
-                        # Handle case where content might be directly accessible
-                        extracted_text = str(mcp_result)
-
-                    # Send the result as a text part
-                    tool_response_part = genai.protos.Part(
-                        text=f"[Tool '{tool_name}' result]: {extracted_text}"
-                    )
-
-                    response = await self.chat_session.send_message_async(
-                        tool_response_part,
-                        tools=self.available_gemini_tools
-                    )
-
                 except Exception as tool_error:
+                    plan_cacheable = False
                     final_text_parts.append(f"[Error executing tool '{tool_name}': {tool_error}]")
 
                     # Send an error back to Gemini as a text part
                     error_response_part = genai.protos.Part(
                         text=f"[Error executing tool '{tool_name}']: {str(tool_error)}"
                     )
-                    try:
-                        response = await self.chat_session.send_message_async(
-                            error_response_part,
-                            tools=self.available_gemini_tools
-                        )
-                    except Exception as send_error:
-                        final_text_parts.append("[Failed to inform Gemini about the tool execution error.]")
-                        break
+                    response = await self._send_to_gemini(error_response_part, tools, deadline)
+                    continue
+
+                executed_calls.append({"name": tool_name, "args": tool_args})
+                if getattr(mcp_result, "isError", False):
+                    plan_cacheable = False
+
+                # Extract the text content, shortening it if it is too big
+                # to carry through the rest of the conversation
+                extracted_text = self.tool_results.shape(tool_name, self._tool_result_text(mcp_result))
+
+                # Send the result as a text part
+                tool_response_part = genai.protos.Part(
+                    text=f"[Tool '{tool_name}' result]: {extracted_text}"
+                )
+
+                # The next step may need other tools than the query suggested
+                tools = self._select_tools(f"{query} {extracted_text[:2000]}")
+                response = await self._send_to_gemini(tool_response_part, tools, deadline)
 
             # After handling tool calls, get the final text response
             final_text = "".join(part.text for part in response.candidates[0].content.parts if hasattr(part, 'text'))
             # Add the final response from Gemini without a prefix
             final_text_parts.append(final_text)
 
+            if plan_cache_applies and executed_calls and plan_cacheable and final_text:
+                try:
+                    self.plan_cache.store(query, media_context, executed_calls, final_text)
+                except (sqlite3.Error, TypeError) as cache_error:
+                    print(f"Warning: could not cache plan: {cache_error}")
+
+        except GeminiBusyError as e:
+            print(f"Gemini busy: {e}", flush=True)
+            return marked_response("I'm handling a lot of requests right now. Please try again in a moment.")
         except Exception as e:
-            return f"Error processing query with Gemini: {str(e)}"
+            return marked_response(f"Error processing query with Gemini: {str(e)}")
 
         # Format multi-line responses with special markers to help the server capture them properly
         response_text = "\n".join(final_text_parts)
         
         # Add start and end markers for multi-line responses, but don't include any prefix like "Response:"
-        return f"RESPONSE_START\n{response_text}\nRESPONSE_END"
+        return marked_response(response_text)
 
     async def chat_loop(self):
         """Runs an interactive chat loop."""
@@ -266,15 +1064,35 @@ async def stdio_chat_loop(client: MCPClient):
                 break
                 
             query = line.strip()
+            media_context = None
+            budget = None
+            # The server sends {"query": ..., "context": {...}, "budget": seconds} as one JSON line;
+            # plain text lines are still accepted
+            if query.startswith("{"):
+                try:
+                    payload = json.loads(query)
+                    # {"history": {"summary": ..., "messages": [...]}} restores a
+                    # session's earlier conversation; it gets no response
+                    if "history" in payload:
+                        history = payload["history"] or {}
+                        count = client.load_history(history.get("summary"), history.get("messages") or [])
+                        print(f"History loaded: {count} turns", flush=True)
+                        continue
+                    query = str(payload.get("query", "")).strip()
+                    media_context = payload.get("context")
+                    budget = payload.get("budget")
+                except json.JSONDecodeError:
+                    pass
             print(f"Received query: {query}", flush=True)
             
             if not query:
                 print("Empty query, skipping.", flush=True)
+                print(f"Response: {marked_response('Please enter a message.')}", flush=True)
                 continue
                 
             # Process the query
             print(f"Processing query: {query}", flush=True)
-            response = await client.process_query(query)
+            response = await client.process_query(query, media_context, budget)
             
             # Output the full response - this will include both tool call info and final Gemini response
             # The response formatting is already handled in process_query
@@ -283,6 +1101,8 @@ async def stdio_chat_loop(client: MCPClient):
             
         except Exception as e:
             print(f"Error in stdio_chat_loop: {e}", flush=True)
+            # The server waits for a marked reply to every query
+            print(f"Response: {marked_response(f'Error processing query: {e}')}", flush=True)
             sys.stdout.flush()
 
 async def main():
@@ -1,26 +1,81 @@
 import http.server
-import socketserver
 import os
 import sys
+from email.utils import formatdate
+
+# Precompression, variant selection and caching rules are shared with the
+# backend, which serves the same build
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend'))
+from static_assets import precompress_build, select_static_variant, static_cache_control, static_etag, static_not_modified
 
 # Default port
 PORT = 3000
 DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'build')
 
 class Handler(http.server.SimpleHTTPRequestHandler):
+    """Static file handler with pre-compressed variants and validators"""
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=DIRECTORY, **kwargs)
 
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            path = os.path.join(path, 'index.html')
+        if not os.path.isfile(path):
+            return super().send_head()
+
+        relative_path = os.path.relpath(path, DIRECTORY)
+        served_path, encoding = select_static_variant(
+            DIRECTORY, relative_path, self.headers.get('Accept-Encoding', ''))
+
+        try:
+            file = open(os.path.join(DIRECTORY, served_path), 'rb')
+        except OSError:
+            self.send_error(404, "File not found")
+            return None
+
+        stats = os.fstat(file.fileno())
+        etag = static_etag(stats)
+        cache_control = static_cache_control(relative_path)
+
+        if static_not_modified(self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since'),
+                               etag, stats):
+            file.close()
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', cache_control)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return None
+
+        self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(stats.st_size))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Last-Modified', formatdate(stats.st_mtime, usegmt=True))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', cache_control)
+        self.end_headers()
+        return file
+
 if __name__ == "__main__":
     # Check if build directory exists
     if not os.path.exists(DIRECTORY):
         print(f"Error: Build directory not found at {DIRECTORY}")
         print("Please run 'npm run build' in the frontend directory first.")
         sys.exit(1)
-        
+
+    print(f"Compressed {precompress_build(DIRECTORY)} build files")
+    if '--precompress' in sys.argv:
+        sys.exit(0)
+
     print(f"Serving at http://localhost:{PORT} from {DIRECTORY}")
-    
-    with socketserver.TCPServer(("", PORT), Handler) as httpd:
+
+    # One thread per connection so a slow client never blocks the others
+    with http.server.ThreadingHTTPServer(("", PORT), Handler) as httpd:
         print("Press Ctrl+C to stop the server")
         try:
             httpd.serve_forever()
@@ -1,5 +1,5 @@
-import React, { useState, useEffect, useCallback } from 'react';
-import { uploadFile, getAllMedia, deleteTempFile, clearTempFiles } from './utils/apiClient';
+import React, { useState, useEffect, useCallback, useRef } from 'react';
+import { uploadFile, getAllMedia, deleteTempFile, clearTempFiles, chatSessionHeaders, openEventSocket, prepareMedia } from './utils/apiClient';
 import axios from 'axios';
 import { 
   Box, 
@@ -399,13 +399,27 @@ function App() {
     }
   };
   
+  // Whether the server's event socket is connected; polling is only used without it
+  const [eventsConnected, setEventsConnected] = useState(false);
+  
   // Load saved media from server on component mount
   useEffect(() => {
     loadServerMedia();
-    // Fetch media periodically to check for updates
+  }, []); 
+  
+  // Fetch media periodically to check for updates, unless changes are pushed
+  useEffect(() => {
+    if (eventsConnected) return;
     const intervalId = setInterval(loadServerMedia, 5000);
     return () => clearInterval(intervalId);
-  }, []); 
+  }, [eventsConnected]);
+  
+  // Let the server warm a selected video before the first edit request
+  useEffect(() => {
+    if (selectedVideo && selectedVideo.id && !selectedVideo.isTemp) {
+      prepareMedia(selectedVideo.id);
+    }
+  }, [selectedVideo?.id, selectedVideo?.isTemp]);
   
   // Clean up temp files on component unmount
   useEffect(() => {
@@ -512,15 +526,46 @@ function App() {
       }
     };
     
-    // Start polling if needed
-    if (isPolling) {
+    // Start polling if needed; with the event socket, responses are pushed
+    if (isPolling && !eventsConnected) {
       pollForResponse();
     }
     
     return () => {
       if (pollingTimeout) clearTimeout(pollingTimeout);
     };
-  }, [isPolling]);
+  }, [isPolling, eventsConnected]);
+  
+  // The socket handlers are set up once, so they call the latest render's handler
+  const chatHandlerRef = useRef(null);
+  chatHandlerRef.current = (message) => handleChatResponse(message);
+  
+  // Subscribe to pushed chat messages, job progress and media changes
+  useEffect(() => {
+    let refreshTimeout = null;
+    // Several events often arrive together (e.g. thumbnail and sprite jobs); refresh once
+    const scheduleMediaRefresh = () => {
+      clearTimeout(refreshTimeout);
+      refreshTimeout = setTimeout(loadServerMedia, 300);
+    };
+    
+    const closeSocket = openEventSocket({
+      onOpen: () => setEventsConnected(true),
+      onClose: () => setEventsConnected(false),
+      onEvent: (event) => {
+        if (event.type === 'chat.message') {
+          chatHandlerRef.current(event.data);
+        } else if (event.type === 'media.added' || event.type === 'jobs.done') {
+          scheduleMediaRefresh();
+        }
+      }
+    });
+    
+    return () => {
+      clearTimeout(refreshTimeout);
+      closeSocket();
+    };
+  }, []);
 
   const fetchVideos = async () => {
     try {
@@ -628,11 +673,20 @@ function App() {
       // If we're not currently waiting for a response, don't poll
       if (!isPolling) return;
       
-      const response = await axios.get('/api/chat/response');
+      const response = await axios.get('/api/chat/response', { headers: chatSessionHeaders });
       
-      if (response.data.role === 'assistant') {
+      await handleChatResponse(response.data);
+    } catch (error) {
+      console.error('Error fetching chat response:', error);
+    }
+  };
+
+  // Handle an assistant message, whether it was polled or pushed over the event socket
+  const handleChatResponse = async (data) => {
+    try {
+      if (data.role === 'assistant') {
         // Check if we have a request ID and haven't processed this response yet
-        const requestId = response.data.request_id;
+        const requestId = data.request_id;
         
         // Only process this response if:
         // 1. It has a request ID that we haven't seen before, OR
@@ -650,7 +704,7 @@ function App() {
               msg.role === 'assistant' && msg.request_id === requestId);
               
             // Only add if it's not already there
-            return messageExists ? prev : [...prev, response.data];
+            return messageExists ? prev : [...prev, data];
           });
           
           // Stop polling once we have a response for our current request
@@ -661,24 +715,24 @@ function App() {
           
           // If the response contains text that suggests a video processing operation has completed,
           // refresh the videos list and load the processed video into the preview
-          if (response.data.content.includes('processed') || 
-              response.data.content.includes('created') ||
-              response.data.content.includes('edited') ||
-              response.data.content.includes('merged') ||
-              response.data.content.includes('trimmed') ||
-              response.data.content.includes('extracted') ||
-              response.data.content.includes('saved to') ||
-              response.data.content.includes('output.mp4') ||
-              response.data.content.includes('_with_audio') ||
-              response.data.content.includes('-with-audio') ||
-              response.data.content.includes('operation was performed successfully') ||
-              response.data.content.includes('successfully')) {
+          if (data.content.includes('processed') || 
+              data.content.includes('created') ||
+              data.content.includes('edited') ||
+              data.content.includes('merged') ||
+              data.content.includes('trimmed') ||
+              data.content.includes('extracted') ||
+              data.content.includes('saved to') ||
+              data.content.includes('output.mp4') ||
+              data.content.includes('_with_audio') ||
+              data.content.includes('-with-audio') ||
+              data.content.includes('operation was performed successfully') ||
+              data.content.includes('successfully')) {
                 
             console.log('Processing result detected in response, refreshing videos');
             await fetchVideos();
               
             // Look for output file patterns in the response
-            const content = response.data.content;
+            const content = data.content;
             // Enhanced pattern matching for finding output filenames
             const outputPathMatch = content.match(/output(?:Path|File)\s*:\s*"?([^"\s,\n]+)"?/i) ||
                                content.match(/saved(?:\s+(?:as|to))?\s*:?\s*"?([^"\s,\n]+\.(?:mp4|mov|avi|webm|mkv))"?/i) ||
@@ -742,12 +796,12 @@ function App() {
         } else if (!requestId) {
           console.log('Response missing request ID, using timestamp as fallback');
           // Fallback to timestamp if no request ID (for backward compatibility)
-          const responseTimestamp = response.data.timestamp || 0;
+          const responseTimestamp = data.timestamp || 0;
           const lastMessage = chatMessages[chatMessages.length - 1];
           const lastTimestamp = lastMessage?.timestamp || 0;
           
           if (responseTimestamp > lastTimestamp) {
-            setChatMessages(prev => [...prev, response.data]);
+            setChatMessages(prev => [...prev, data]);
             setIsPolling(false);
           }
         } else {
@@ -755,7 +809,7 @@ function App() {
         }
       }
     } catch (error) {
-      console.error('Error fetching chat response:', error);
+      console.error('Error handling chat response:', error);
     }
   };
 
@@ -927,7 +981,7 @@ function App() {
         message: processedMessage,
         videoContext: includesVideoPath ? selectedVideo : null,  // selectedVideo will be the most recent one in the preview
         audioContext: audioFile  // Include the audio file if found
-      });
+      }, { headers: chatSessionHeaders });
       
       // If we get an immediate response (rare but possible)
       if (response.data && response.data.assistant) {
@@ -741,7 +741,7 @@ const VideoList = ({ videos = [], selectedVideo, onSelectVideo, onTabChange, act
                           {video.thumbnailPath ? (
                             <>
                               <img 
-                                src={`http://localhost:8001${video.thumbnailPath}`} 
+                                src={`http://localhost:8001${video.thumbnailPath}?size=small`} 
                                 alt={video.name}
                                 style={{
                                   width: '100%',
@@ -17,6 +17,21 @@ import PlayArrowIcon from '@mui/icons-material/PlayArrow';
 import Replay10Icon from '@mui/icons-material/Replay10';
 import Forward10Icon from '@mui/icons-material/Forward10';
 
+// Browsers with native HLS (Safari, iOS) can play the adaptive-bitrate
+// package; everywhere else the progressive file is used.
+const supportsNativeHls = typeof document !== 'undefined' &&
+  document.createElement('video').canPlayType('application/vnd.apple.mpegurl') !== '';
+
+// A packaged HLS stream is preferred where it plays natively, since it
+// adapts to the connection. Otherwise the low-resolution editing proxy is
+// used once it exists, so seeking stays responsive on big sources, and
+// only then the original. Edits always render the original.
+const getPreviewSource = (video) => {
+  if (supportsNativeHls && video.hlsPath) return video.hlsPath;
+  if (video.proxyPath) return video.proxyPath;
+  return video.path;
+};
+
 const VideoPreview = ({ video }) => {
   // Only show video if it was explicitly dragged and dropped (has isDropped flag)
   const shouldShowVideo = video && video.isDropped;
@@ -30,6 +45,9 @@ const VideoPreview = ({ video }) => {
   const [isVolumeSliderOpen, setIsVolumeSliderOpen] = useState(false);
   const [isControlsVisible, setIsControlsVisible] = useState(true);
   const [idleTimer, setIdleTimer] = useState(null);
+  // Scrubbing preview: cues parsed from the video's sprite VTT and the tile under the cursor
+  const [spriteCues, setSpriteCues] = useState([]);
+  const [scrubPreview, setScrubPreview] = useState(null);
   
   // Refs
   const videoRef = useRef(null);
@@ -177,6 +195,18 @@ const VideoPreview = ({ video }) => {
   
 
 
+  // Show the sprite tile for the hovered position on the progress bar
+  const handleProgressHover = (e) => {
+    if (!progressRef.current || spriteCues.length === 0 || !duration) return;
+    
+    const rect = progressRef.current.getBoundingClientRect();
+    const pos = Math.max(0, Math.min((e.clientX - rect.left) / rect.width, 1));
+    const hoverTime = pos * duration;
+    const cue = spriteCues.find(c => hoverTime >= c.start && hoverTime < c.end) || spriteCues[spriteCues.length - 1];
+    
+    setScrubPreview({ cue, time: hoverTime, left: e.clientX - rect.left });
+  };
+  
   // Skip forward/backward
   const skipTime = (seconds) => {
     if (!videoRef.current) return;
@@ -259,6 +289,40 @@ const VideoPreview = ({ video }) => {
     }
   }, [video]);
 
+  // Load the scrubbing sprite index (one small VTT) when the video changes
+  useEffect(() => {
+    setSpriteCues([]);
+    setScrubPreview(null);
+    if (!video?.sprite?.vttPath) return;
+    
+    const toSeconds = (stamp) => {
+      const [h, m, s] = stamp.split(':');
+      return Number(h) * 3600 + Number(m) * 60 + Number(s);
+    };
+    
+    let cancelled = false;
+    const vttUrl = `http://localhost:8001${video.sprite.vttPath}`;
+    fetch(vttUrl)
+      .then(response => response.ok ? response.text() : '')
+      .then(text => {
+        if (cancelled) return;
+        const cues = [];
+        const blocks = text.split(/\r?\n\r?\n/);
+        blocks.forEach(block => {
+          const lines = block.trim().split(/\r?\n/);
+          if (lines.length < 2 || !lines[0].includes('-->')) return;
+          const [start, end] = lines[0].split('-->').map(t => toSeconds(t.trim()));
+          const [image, fragment] = lines[1].split('#xywh=');
+          const [x, y, w, h] = (fragment || '').split(',').map(Number);
+          cues.push({ start, end, url: new URL(image, vttUrl).toString(), x, y, w, h });
+        });
+        setSpriteCues(cues);
+      })
+      .catch(err => console.error('Error loading sprite index:', err));
+    
+    return () => { cancelled = true; };
+  }, [video]);
+
   // Update current time when video is playing
   useEffect(() => {
     const videoElement = videoRef.current;
@@ -402,7 +466,7 @@ const VideoPreview = ({ video }) => {
           {shouldShowVideo && video?.path ? (
             <video
               ref={videoRef}
-              src={video.path}
+              src={getPreviewSource(video)}
               style={{
                 width: '100%',
                 maxHeight: '100%',
@@ -450,6 +514,8 @@ const VideoPreview = ({ video }) => {
                 ref={progressRef}
                 onClick={handleProgressClick}
                 onMouseDown={handleProgressClick}
+                onMouseMove={handleProgressHover}
+                onMouseLeave={() => setScrubPreview(null)}
                 sx={{
                   width: '100%',
                   height: '4px',
@@ -478,6 +544,30 @@ const VideoPreview = ({ video }) => {
                     borderRadius: '2px'
                   }} 
                 />
+                {/* Scrubbing preview tile from the sprite sheet */}
+                {scrubPreview && (
+                  <Box sx={{
+                    position: 'absolute',
+                    bottom: '12px',
+                    left: `${scrubPreview.left}px`,
+                    transform: 'translateX(-50%)',
+                    pointerEvents: 'none',
+                    textAlign: 'center'
+                  }}>
+                    <Box sx={{
+                      width: `${scrubPreview.cue.w}px`,
+                      height: `${scrubPreview.cue.h}px`,
+                      backgroundImage: `url(${scrubPreview.cue.url})`,
+                      backgroundPosition: `-${scrubPreview.cue.x}px -${scrubPreview.cue.y}px`,
+                      backgroundRepeat: 'no-repeat',
+                      borderRadius: '4px',
+                      border: '1px solid rgba(255,255,255,0.6)'
+                    }} />
+                    <Typography variant="caption" sx={{ color: 'white' }}>
+                      {formatTime(scrubPreview.time)}
+                    </Typography>
+                  </Box>
+                )}
               </Box>
               
               {/* Controls Row */}
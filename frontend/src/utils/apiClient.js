@@ -5,6 +5,150 @@
 // Base URL for API requests
 const API_BASE_URL = 'http://localhost:8001/api';
 
+// Chat session of this browser tab; the server keeps a separate history per
+// session. Knowing the ID is all it takes to read a session's history and
+// events, so it is 128 random bits from the browser's CSPRNG (IDs stored by
+// older versions are replaced)
+const SESSION_ID_PATTERN = /^[0-9a-f]{32}$/;
+
+export const CHAT_SESSION_ID = (() => {
+  let sessionId = sessionStorage.getItem('chatSessionId');
+  if (!sessionId || !SESSION_ID_PATTERN.test(sessionId)) {
+    const bytes = crypto.getRandomValues(new Uint8Array(16));
+    sessionId = Array.from(bytes, (byte) => byte.toString(16).padStart(2, '0')).join('');
+    sessionStorage.setItem('chatSessionId', sessionId);
+  }
+  return sessionId;
+})();
+
+// Headers identifying the chat session on /api/chat requests
+export const chatSessionHeaders = { 'X-Session-Id': CHAT_SESSION_ID };
+
+// Delay before reconnecting a dropped event socket
+const EVENT_SOCKET_RETRY_MS = 3000;
+
+// Files larger than this use the resumable chunked upload protocol
+const RESUMABLE_UPLOAD_THRESHOLD = 32 * 1024 * 1024;
+// Number of chunks sent in parallel during a resumable upload
+const RESUMABLE_UPLOAD_PARALLEL = 3;
+// Attempts per chunk before the upload is abandoned (it can still be resumed later)
+const RESUMABLE_CHUNK_RETRIES = 5;
+
+/**
+ * Upload a large file in chunks, resuming a previous session for the same file if possible
+ * @param {File} file - The file to upload
+ * @returns {Promise} Promise that resolves to the uploaded file data
+ */
+export const uploadFileResumable = async (file) => {
+  const storageKey = `upload:${file.name}:${file.size}:${file.lastModified}`;
+  let session = null;
+  
+  // Resume an earlier session for this exact file if the server still has it
+  const savedId = localStorage.getItem(storageKey);
+  if (savedId) {
+    const response = await fetch(`${API_BASE_URL}/uploads/${savedId}`);
+    if (response.ok) {
+      session = await response.json();
+      console.log(`Resuming upload ${savedId} at ${session.received}/${session.size} bytes`);
+    }
+  }
+  
+  if (!session) {
+    const response = await fetch(`${API_BASE_URL}/uploads`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ filename: file.name, size: file.size })
+    });
+    if (!response.ok) {
+      throw new Error(`Upload failed: ${response.status} ${response.statusText}`);
+    }
+    session = await response.json();
+    localStorage.setItem(storageKey, session.uploadId);
+  }
+  
+  // Work out which chunks are still missing
+  const isReceived = (start, end) => session.ranges.some(([s, e]) => s <= start && end <= e);
+  const pending = [];
+  for (let start = 0; start < file.size; start += session.chunkSize) {
+    const end = Math.min(start + session.chunkSize, file.size);
+    if (!isReceived(start, end)) {
+      pending.push([start, end]);
+    }
+  }
+  
+  const sendChunk = async ([start, end]) => {
+    for (let attempt = 1; ; attempt++) {
+      try {
+        const response = await fetch(`${API_BASE_URL}/uploads/${session.uploadId}`, {
+          method: 'PATCH',
+          headers: { 'Upload-Offset': String(start), 'Content-Type': 'application/octet-stream' },
+          body: file.slice(start, end)
+        });
+        if (!response.ok) {
+          throw new Error(`Chunk upload failed: ${response.status} ${response.statusText}`);
+        }
+        return await response.json();
+      } catch (error) {
+        if (attempt >= RESUMABLE_CHUNK_RETRIES) throw error;
+        // Back off before retrying the same chunk
+        await new Promise(resolve => setTimeout(resolve, 500 * 2 ** attempt));
+      }
+    }
+  };
+  
+  // A few workers pull chunks off the queue in parallel
+  let finalState = session;
+  const worker = async () => {
+    while (pending.length > 0) {
+      const state = await sendChunk(pending.shift());
+      if (state.complete) {
+        finalState = state;
+      }
+    }
+  };
+  await Promise.all(Array.from({ length: RESUMABLE_UPLOAD_PARALLEL }, worker));
+  
+  if (!finalState.complete) {
+    // Every chunk was already on the server; fetch the finalized state
+    const response = await fetch(`${API_BASE_URL}/uploads/${session.uploadId}`);
+    finalState = await response.json();
+  }
+  
+  localStorage.removeItem(storageKey);
+  console.log('File uploaded with resumable upload:', finalState.media);
+  return finalState.media;
+};
+
+/**
+ * Upload a file as the raw request body so the server can write it straight to storage
+ * @param {File} file - The file to upload
+ * @returns {Promise} Promise that resolves to the uploaded file data
+ */
+export const uploadFileStream = async (file) => {
+  try {
+    const response = await fetch(`${API_BASE_URL}/upload/stream`, {
+      method: 'PUT',
+      headers: {
+        'Content-Type': 'application/octet-stream',
+        'X-Filename': encodeURIComponent(file.name)
+      },
+      body: file
+    });
+    
+    if (!response.ok) {
+      throw new Error(`Upload failed: ${response.status} ${response.statusText}`);
+    }
+    
+    const data = await response.json();
+    console.log('File uploaded to permanent storage:', data);
+    
+    return data;
+  } catch (error) {
+    console.error('Error uploading file:', error);
+    throw error;
+  }
+};
+
 /**
  * Upload a media file to the server
  * @param {File} file - The file to upload
@@ -12,6 +156,13 @@ const API_BASE_URL = 'http://localhost:8001/api';
  * @returns {Promise} Promise that resolves to the uploaded file data
  */
 export const uploadFile = async (file, isTemp = false) => {
+  if (!isTemp && file.size > RESUMABLE_UPLOAD_THRESHOLD) {
+    return uploadFileResumable(file);
+  }
+  if (!isTemp) {
+    return uploadFileStream(file);
+  }
+  
   const endpoint = isTemp ? `${API_BASE_URL}/upload/temp` : `${API_BASE_URL}/upload`;
   
   // Create form data
@@ -113,3 +264,63 @@ export const clearTempFiles = async () => {
     throw error;
   }
 };
+
+/**
+ * Hint that a media file was selected so the server can warm it for editing
+ * (metadata, keyframes, proxy, chat worker); failures are only logged
+ * @param {string} mediaId - ID of the selected media file
+ * @returns {Promise} Promise that resolves to the server's reply, or null
+ */
+export const prepareMedia = async (mediaId) => {
+  try {
+    const response = await fetch(`${API_BASE_URL}/media/${encodeURIComponent(mediaId)}/prepare`, {
+      method: 'POST',
+      headers: chatSessionHeaders
+    });
+    
+    if (!response.ok) {
+      throw new Error(`Failed to prepare media: ${response.status} ${response.statusText}`);
+    }
+    
+    return await response.json();
+  } catch (error) {
+    console.error('Error preparing media:', error);
+    return null;
+  }
+};
+
+/**
+ * Subscribe to server-pushed events (chat messages, job progress, media changes)
+ * over the /api/events WebSocket, reconnecting when the connection drops
+ * @param {Object} handlers - onEvent(event), onOpen(), onClose()
+ * @returns {Function} - Call to close the socket and stop reconnecting
+ */
+export const openEventSocket = ({ onEvent, onOpen, onClose }) => {
+  const url = `${API_BASE_URL.replace(/^http/, 'ws')}/events?session=${encodeURIComponent(CHAT_SESSION_ID)}`;
+  let socket = null;
+  let retryTimeout = null;
+  let closed = false;
+  
+  const connect = () => {
+    socket = new WebSocket(url);
+    socket.onopen = () => onOpen && onOpen();
+    socket.onmessage = (message) => {
+      try {
+        onEvent(JSON.parse(message.data));
+      } catch (error) {
+        console.error('Error handling server event:', error);
+      }
+    };
+    socket.onclose = () => {
+      if (onClose) onClose();
+      if (!closed) retryTimeout = setTimeout(connect, EVENT_SOCKET_RETRY_MS);
+    };
+  };
+  
+  connect();
+  return () => {
+    closed = true;
+    clearTimeout(retryTimeout);
+    if (socket) socket.close();
+  };
+};